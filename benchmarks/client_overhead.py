@@ -0,0 +1,103 @@
+"""
+Compares the native client (`question_extractor.client`) with the previous LangChain path,
+on import time and per-call overhead, against a local server answering instantly.
+
+Usage: python3 benchmarks/client_overhead.py [nb_calls]
+"""
+import sys
+import time
+import asyncio
+import subprocess
+from pathlib import Path
+from aiohttp import web
+
+# makes the package importable when running from a clone
+repository_folder = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(repository_folder))
+from question_extractor.client import OpenAICompatibleBackend
+
+# canned answer of the local server
+completion = {'choices': [{'message': {'role': 'assistant', 'content': '1. What is this?'}, 'finish_reason': 'stop'}],
+              'usage': {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15}}
+messages = [{'role': 'system', 'content': 'You are a benchmark.'}, {'role': 'user', 'content': 'Hello.'}]
+
+#----------------------------------------------------------------------------------------
+# IMPORT TIME
+
+def measure_import_time(module, nb_runs=5):
+    """
+    Returns the best wall time (in seconds) of importing a module in a fresh interpreter, or None if it cannot be imported.
+    """
+    best_time = None
+    for _ in range(nb_runs):
+        start = time.perf_counter()
+        completed = subprocess.run([sys.executable, '-c', f"import {module}"], capture_output=True, cwd=repository_folder)
+        duration = time.perf_counter() - start
+        if completed.returncode != 0:
+            return None
+        best_time = duration if best_time is None else min(best_time, duration)
+    return best_time
+
+#----------------------------------------------------------------------------------------
+# CALL OVERHEAD
+
+async def start_server():
+    """
+    Starts a local OpenAI-compatible server answering every chat completion instantly, returns its runner and base url.
+    """
+    async def handle_chat_completion(request):
+        await request.json()
+        return web.json_response(completion)
+
+    app = web.Application()
+    app.router.add_post('/v1/chat/completions', handle_chat_completion)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/v1"
+
+
+async def time_native_calls(base_url, nb_calls):
+    backend = OpenAICompatibleBackend(base_url, ['key'])
+    start = time.perf_counter()
+    for _ in range(nb_calls):
+        await backend.chat_completion('gpt-3.5-turbo', messages, temperature=0.0, max_tokens=16)
+    duration = time.perf_counter() - start
+    await backend.close()
+    return duration
+
+
+async def time_langchain_calls(base_url, nb_calls):
+    try:
+        from langchain.chat_models import ChatOpenAI
+        from langchain.schema import HumanMessage, SystemMessage
+    except ImportError:
+        return None
+    langchain_messages = [SystemMessage(content=messages[0]['content']), HumanMessage(content=messages[1]['content'])]
+    start = time.perf_counter()
+    for _ in range(nb_calls):
+        # the previous code built one model per call
+        model = ChatOpenAI(temperature=0.0, max_tokens=16, openai_api_key='key', openai_api_base=base_url)
+        await model._agenerate(langchain_messages)
+    return time.perf_counter() - start
+
+
+async def main(nb_calls):
+    runner, base_url = await start_server()
+    try:
+        results = {'native': await time_native_calls(base_url, nb_calls),
+                   'langchain': await time_langchain_calls(base_url, nb_calls)}
+    finally:
+        await runner.cleanup()
+
+    for name, module in [('native', 'question_extractor.client'), ('langchain', 'langchain.chat_models')]:
+        import_time = measure_import_time(module)
+        import_text = 'unavailable' if import_time is None else f"{import_time * 1000:.0f} ms"
+        call_text = 'unavailable' if results[name] is None else f"{results[name] / nb_calls * 1000:.2f} ms/call"
+        print(f"{name:>10}: import {import_text}, {call_text} over {nb_calls} sequential calls")
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 500))
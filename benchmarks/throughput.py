@@ -0,0 +1,166 @@
+"""
+End-to-end throughput benchmark: runs `extract_questions_from_directory` on a synthetic markdown corpus,
+against the in-process fake model (no network, no cost), and saves the measures in `benchmarks/results/`.
+
+Usage:
+    python3 benchmarks/throughput.py --nb-files 200 --depth 3 --rpm 3500 --tpm 90000
+    python3 benchmarks/throughput.py --compare
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+from pathlib import Path
+
+# makes the package importable when running from a clone
+repository_folder = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(repository_folder))
+import question_extractor
+from question_extractor import cache, state, rate_limiting, instrumentation, calibration, scheduling, retrying, models, token_counting
+from question_extractor.fake_server import FakeModel, FakeBackend
+
+results_folder = Path(__file__).resolve().parent / 'results'
+
+#----------------------------------------------------------------------------------------
+# SYNTHETIC CORPUS
+
+def write_synthetic_corpus(folder, nb_files, depth, sections_per_level, paragraph_words, seed=0):
+    """
+    Writes `nb_files` markdown files, each with `sections_per_level` sections per heading level down to `depth` levels.
+    """
+    generator = random.Random(seed)
+    vocabulary = ["cluster", "node", "job", "queue", "module", "storage", "quota", "login", "network", "compiler",
+                  "library", "scratch", "partition", "allocation", "container", "account", "python", "gpu"]
+
+    def write_section(lines, level, title):
+        lines.append(f"{'#' * level} {title}")
+        lines.append(' '.join(generator.choice(vocabulary) for _ in range(paragraph_words)) + '.')
+        lines.append('')
+        if level < depth:
+            for index in range(sections_per_level):
+                write_section(lines, level + 1, f"{title} {index + 1}")
+
+    for file_index in range(nb_files):
+        lines = []
+        write_section(lines, 1, f"Page {file_index}")
+        (Path(folder) / f"page_{file_index}.md").write_text('\n'.join(lines), encoding='utf-8')
+
+#----------------------------------------------------------------------------------------
+# MEASURES
+
+def get_git_commit():
+    """
+    Returns the short hash of the current commit, or 'unknown'.
+    """
+    completed = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=repository_folder)
+    return completed.stdout.strip() or 'unknown'
+
+
+def run_benchmark(arguments):
+    """
+    Runs the pipeline on a synthetic corpus and returns the measures.
+    """
+    working_folder = Path(tempfile.mkdtemp(prefix='question_extractor_benchmark_'))
+    corpus_folder = working_folder / 'docs'
+    corpus_folder.mkdir()
+    write_synthetic_corpus(corpus_folder, arguments.nb_files, arguments.depth, arguments.sections_per_level, arguments.paragraph_words)
+
+    # Isolate the run: no response cache, fresh state, rate limits matching the fake model
+    cache.cache_enabled = False
+    state.state_folder = working_folder / 'state'
+    calibration.calibration_path = working_folder / 'token_statistics.json'
+    for model in set(models.stage_models.values()):
+        models.models[model]['rate_limits'] = {'requests_per_minute': arguments.rpm, 'tokens_per_minute': arguments.tpm}
+    rate_limiting.rate_limiters.clear()
+    scheduling.scheduling_policy = arguments.scheduling_policy
+    fake_model = FakeModel(latency_mean=arguments.latency_mean, latency_sigma=arguments.latency_sigma,
+                           requests_per_minute=arguments.rpm, tokens_per_minute=arguments.tpm,
+                           failure_rate=arguments.failure_rate, max_concurrent_requests=arguments.max_concurrent_requests, seed=arguments.seed)
+    question_extractor.backend = FakeBackend(fake_model)
+
+    instrumentation.metrics_folder = working_folder / 'metrics'
+    retrying.dead_letters_path = working_folder / 'dead_letters.jsonl'
+
+    start = time.perf_counter()
+    results = question_extractor.extract_questions_from_directory(corpus_folder, verbose=arguments.verbose)
+    duration = time.perf_counter() - start
+
+    retry_sleep = question_extractor.metrics.get_summary('retry_sleep_seconds')
+    file_completions = question_extractor.metrics.get_summary('file_completion_seconds')
+    nb_tokens = fake_model.stats['prompt_tokens'] + fake_model.stats['completion_tokens']
+    token_count_cache_stats = token_counting.get_token_count_cache_stats()
+    return {
+        'commit': get_git_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': vars(arguments),
+        'duration_seconds': duration,
+        'nb_files': arguments.nb_files,
+        'nb_qa_pairs': len(results),
+        'files_per_second': arguments.nb_files / duration,
+        'qa_pairs_per_second': len(results) / duration,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        # fraction of the budget the server could have admitted during the run (initial burst included)
+        'requests_rate_limit_usage': fake_model.stats['nb_completions'] / (arguments.rpm * (1 + duration / 60)),
+        'tokens_rate_limit_usage': nb_tokens / (arguments.tpm * (1 + duration / 60)),
+        'nb_retries': retry_sleep['count'],
+        'nb_dead_letters': question_extractor.metrics.get_counter('dead_letters_total'),
+        'final_concurrency_limit': question_extractor.metrics.get_gauge('concurrency_limit', model=models.get_stage_model('answering')),
+        'retry_sleep_seconds': retry_sleep['sum'],
+        'rate_limiter_wait_seconds': question_extractor.metrics.get_summary('rate_limiter_wait_seconds')['sum'],
+        'first_file_completion_seconds': question_extractor.metrics.get_gauge('first_file_completion_seconds'),
+        'mean_file_completion_seconds': file_completions['sum'] / max(1, file_completions['count']),
+        'token_count_cache_hit_rate': token_count_cache_stats['hit_rate'],
+        'tokenization_cpu_seconds': token_count_cache_stats['encoding_seconds'],
+        'tokenization_cpu_seconds_saved': token_count_cache_stats['seconds_saved'],
+        'server_stats': fake_model.stats,
+    }
+
+
+def print_results(results):
+    print(f"[{results['commit']} {results['date']}] {results['nb_files']} files, {results['nb_qa_pairs']} QA pairs in {results['duration_seconds']:.1f}s: "
+          f"{results['files_per_second']:.2f} files/s, {results['qa_pairs_per_second']:.1f} QA/s, peak RSS {results['peak_rss_mb']:.0f} MB, "
+          f"rate limit usage {results['requests_rate_limit_usage']:.0%} (requests) {results['tokens_rate_limit_usage']:.0%} (tokens), "
+          f"{results['nb_retries']} retries sleeping {results['retry_sleep_seconds']:.1f}s, {results.get('nb_dead_letters', 0)} dead letters, "
+          f"first file after {results.get('first_file_completion_seconds') or 0.0:.1f}s, mean file completion {results.get('mean_file_completion_seconds', 0.0):.1f}s "
+          f"({results['config'].get('scheduling_policy', 'fifo')} scheduling), "
+          f"tokenization {results.get('tokenization_cpu_seconds', 0.0):.2f}s CPU ({results.get('tokenization_cpu_seconds_saved', 0.0):.2f}s saved by the cache)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the question extraction pipeline against a fake model.")
+    parser.add_argument('--nb-files', type=int, default=100)
+    parser.add_argument('--depth', type=int, default=3, help="number of heading levels per file")
+    parser.add_argument('--sections-per-level', type=int, default=3)
+    parser.add_argument('--paragraph-words', type=int, default=80)
+    parser.add_argument('--latency-mean', type=float, default=0.5)
+    parser.add_argument('--latency-sigma', type=float, default=0.5)
+    parser.add_argument('--rpm', type=float, default=3500)
+    parser.add_argument('--tpm', type=float, default=90000)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--max-concurrent-requests', type=int, default=None, help="number of calls in progress above which the server answers with a 429")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scheduling-policy', choices=['priority', 'fifo'], default='priority')
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--compare', action='store_true', help="print the saved results instead of running a benchmark")
+    arguments = parser.parse_args()
+
+    if arguments.compare:
+        for results_path in sorted(results_folder.glob('*.json')):
+            print_results(json.loads(results_path.read_text()))
+        return
+
+    results = run_benchmark(arguments)
+    print_results(results)
+
+    results_folder.mkdir(exist_ok=True)
+    results_path = results_folder / f"{time.strftime('%Y%m%d-%H%M%S')}-{results['commit']}.json"
+    results_path.write_text(json.dumps(results, indent=2))
+    print(f"Results have been saved to {results_path}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,43 +1,27 @@
-import json
 from pathlib import Path
+from question_extractor import fine_tuning
+from question_extractor.fine_tuning import convert_to_fine_tuning_formats, fine_tune_types
 
 # Define the input and output paths
+# (the input can be the `.json` or `.jsonl` output of `question_extractor.py`, or a normalized output folder)
 input_filepath = Path('./data/questions.json')
-output_filepath = Path('./data/fine_tune_openai.jsonl')
+output_directory = Path('./data/fine_tune')
 system_prompt = "TODO: Your system prompt."
 system_prompt = system_prompt.replace("\n", " ").strip()
-fine_tune_types = ["openai", "azure_openai", "palm2", "anyscale"]
-fine_tune_type = "anyscale"
-if fine_tune_type not in fine_tune_types:
-    raise Exception("Invalid fine tune type")
 
-# Expecting the questions.json with an array of { source, question, answer } pair tuples.
-with open(input_filepath, 'r') as input_file:
-    input_json = json.load(input_file)
-    # Save the extracted questions as a JSON file
-    with open(output_filepath, 'w') as output_file:
-        for input_tuple in input_json:
-            qna = {}
-            if fine_tune_type in ["openai", "anyscale"]:
-                qna = {
-                    'messages': [
-                        {'role': 'system', 'content': system_prompt},
-                        {'role': 'user', 'content': input_tuple['question']},
-                        {'role': 'assistant', 'content': input_tuple['answer']}
-                    ]
-                }
-            elif fine_tune_type == "azure_openai":
-                qna = {
-                    'prompt': input_tuple['question'],
-                    'completion': input_tuple['answer']
-                }
-            elif fine_tune_type == "palm2":
-                qna = {
-                    'input_text': input_tuple['question'],
-                    'output_text': input_tuple['answer']
-                }
+# Formats written in a single pass over the input, one `fine_tune_<type>.jsonl` file (or set of shards) each
+# (previous files of these formats are replaced, shard sizes and the number of processes are set in `question_extractor/fine_tuning.py`)
+fine_tune_types_to_write = ["openai", "azure_openai", "palm2", "anyscale"]
+for fine_tune_type in fine_tune_types_to_write:
+    if fine_tune_type not in fine_tune_types:
+        raise Exception("Invalid fine tune type")
 
-            json.dump(qna, output_file)
-            output_file.write('\n')
+# Examples with more tokens than this are left out (and the largest ones reported), None keeps all examples
+# (set it to the maximum length of a training example accepted by your provider)
+fine_tuning.max_example_tokens = None
 
-        print(f"Results have been saved to {output_filepath}.")
+# Worker processes re-import this script, only the main process runs it
+if __name__ == '__main__':
+    # Expecting records of { source, question, answer } pairs.
+    convert_to_fine_tuning_formats(input_filepath, output_directory, system_prompt, output_types=fine_tune_types_to_write)
+    print(f"Results have been saved to {output_directory}.")
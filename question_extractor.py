@@ -1,16 +1,73 @@
+import os
 import json
+import argparse
 from pathlib import Path
-from question_extractor import extract_questions_from_directory
+from question_extractor import extract_questions_from_directory, stream_questions_from_directory, plan_questions_from_directory, export_normalized_output
+from question_extractor.sharding import run_sharded, merge_shards, merge_normalized_shards
+from question_extractor.batching import batch_questions_from_directory
 
 # Define the input and output paths
 input_directory = Path('./data/docs')
 output_filepath = Path('./data/questions.json')
 
+# Set to True to write question/answer pairs to a `.jsonl` file as they are produced
+# (flat memory usage on large corpora, partial results survive a crash);
+# the file is rewritten on each run, a resumed run serves the records of finished files again from the manifest
+streaming = False
+streaming_output_filepath = Path('./data/questions.jsonl')
+
+# Set to True to also write the question/answer pairs in a compact normalized format (see `question_extractor/output.py`):
+# a table of chunks, storing the text of each chunk once, and a table of question/answer pairs referencing them
+normalized_output = False
+normalized_output_directory = Path('./data/questions')
+
+# Run with `--plan` to predict the cost and duration of the run without calling the model
+plan_breakdown_filepath = Path('./data/plan.csv')
+
+# Run with `--shards N` to process the corpus with several processes (and hosts), coordinated through this folder
+shards_directory = Path('./data/shards')
+
 # Before running the code, one must replace the "API_KEY" in question_extractor/__init__.py with his own API key
 
-# Run the question extraction on the input directory
-extracted_questions = extract_questions_from_directory(input_directory)
-# Save the extracted questions as a JSON file
-with open(output_filepath, 'w') as output_file:
-    json.dump(extracted_questions, output_file, indent=4)
-    print(f"Results have been saved to {output_filepath}.")
\ No newline at end of file
+# Shard processes re-import this script, only the main process runs it
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Extracts question/answer pairs from a folder of markdown files.")
+    parser.add_argument('--plan', action='store_true', help="predict the number of calls, cost and wall time, without calling the model")
+    parser.add_argument('--batch', action='store_true', help="use the batch API of the provider (half price, results within hours), run it again to resume an interrupted run")
+    parser.add_argument('--shards', type=int, default=None, help="split the corpus into this many shards, processed by separate processes (possibly on several hosts sharing `shards_directory`)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="number of processes running shards on this host")
+    parser.add_argument('--total-workers', type=int, default=None, help="number of processes running shards on all hosts, used to share the rate limits")
+    parser.add_argument('--merge', action='store_true', help="merge the outputs of all shards into `output_filepath`")
+    arguments = parser.parse_args()
+
+    if arguments.plan:
+        # Predict the cost of the run, writing the plan of each file to a CSV file
+        plan_questions_from_directory(input_directory, breakdown_path=plan_breakdown_filepath)
+    elif arguments.shards is not None:
+        # Process the shards claimed by this host, then merge the outputs if asked to (and all shards are done)
+        all_shards_done = run_sharded(input_directory, shards_directory, arguments.shards, arguments.workers, total_nb_workers=arguments.total_workers)
+        if arguments.merge and all_shards_done:
+            nb_records = merge_shards(shards_directory, arguments.shards, output_filepath)
+            print(f"{nb_records} question/answer pairs have been saved to {output_filepath}.")
+            if normalized_output:
+                nb_records = merge_normalized_shards(shards_directory, arguments.shards, normalized_output_directory)
+                print(f"{nb_records} question/answer pairs have been saved to '{normalized_output_directory}'.")
+    elif arguments.batch:
+        # Submit the extraction then the answering requests as batches, waiting for their results
+        extracted_questions = batch_questions_from_directory(input_directory)
+        with open(output_filepath, 'w') as output_file:
+            json.dump(extracted_questions, output_file, indent=4)
+            print(f"Results have been saved to {output_filepath}.")
+        if normalized_output: export_normalized_output(normalized_output_directory)
+    elif streaming:
+        # Run the question extraction on the input directory, writing results as they are produced
+        stream_questions_from_directory(input_directory, streaming_output_filepath)
+        if normalized_output: export_normalized_output(normalized_output_directory)
+    else:
+        # Run the question extraction on the input directory
+        extracted_questions = extract_questions_from_directory(input_directory)
+        # Save the extracted questions as a JSON file
+        with open(output_filepath, 'w') as output_file:
+            json.dump(extracted_questions, output_file, indent=4)
+            print(f"Results have been saved to {output_filepath}.")
+        if normalized_output: export_normalized_output(normalized_output_directory)
@@ -1,30 +1,78 @@
 import re
 import os
+import json
+import time
 import asyncio
-import openai
-from tenacity import (
-    retry,
-    wait_random_exponential,
-)  
-import openai.error
-from aiolimiter import AsyncLimiter
-from langchain.chat_models import ChatOpenAI
-from contextlib import asynccontextmanager
-from .markdown import load_markdown_files_from_directory, split_markdown
-from .token_counting import count_tokens_text, count_tokens_messages, get_available_tokens, are_tokens_available_for_both_conversations
-from .prompts import create_answering_conversation_messages, create_extraction_conversation_messages
+from itertools import groupby
+from .client import OpenAICompatibleBackend, APIError, RateLimitError, APIConnectionError
+from .markdown import load_markdown_files_from_directory, scan_markdown_files, parse_markdown_tree, cut_markdown_tree
+from .models import get_model, get_stage_model
+from .token_counting import (count_tokens_text, count_tokens_texts, count_tokens_messages, get_available_tokens, are_tokens_available_for_both_conversations, split_questions_into_batches,
+                             get_token_statistics, get_token_count_cache_stats, observe_extraction, observe_answer, get_max_tokens, estimate_extraction_output_tokens, estimate_answering_output_tokens)
+from .rate_limiting import get_rate_limiter
+from . import scheduling
+from .scheduling import start_file, get_priority
+from .cache import get_response_cache, hash_request
+from .state import get_manifest, hash_text
+from . import deduplication
+from .deduplication import get_deduplicator, compute_chunk_fingerprint, find_representative_chunk
+from .prompts import create_answering_conversation_messages, create_extraction_conversation_messages, create_batch_answering_conversation_messages
+from .instrumentation import metrics, report_progress, serve_metrics
+from .planning import plan_directory, print_plan, write_breakdown
+from .output import write_normalized_output
+from . import retrying
+from .retrying import AdaptiveConcurrencyLimiter, CircuitOpenError, get_circuit_breaker, get_retry_delay, record_dead_letter, clear_dead_letters
 
 # replace the "Key" with your own API key, you can provide multiply APIs in the list
-API_KEYS = ["Key1"，"Key2"]
-api_key_lock = asyncio.Lock()
-api_key_index = 0
+API_KEYS = ["Key1", "Key2"]
+
+# any OpenAI-compatible server can be used (such as a local vLLM or llama.cpp server)
+API_BASE_URL = os.environ.get('OPENAI_API_BASE', "https://api.openai.com/v1")
+
+# backend used to run the model, it can be replaced by any object with the same methods
+backend = OpenAICompatibleBackend(API_BASE_URL, API_KEYS)
+
 #---------------------------------------------------------------------------------------------
 # QUESTION PROCESSING
 
-# Ensure we do not run too many concurent requests
-model_rate_limits = 2000
-max_concurent_request = int(model_rate_limits * 0.75)
-throttler = asyncio.Semaphore(max_concurent_request)
+# Ensure we do not run too many concurent requests, the number of calls in flight adapts to the 429s, timeouts and latencies observed
+# (requests and tokens per minute are enforced by the rate limiters, see `rate_limiting.py`, retries are configured in `retrying.py`)
+# Each model has its own pool, capped by its `max_concurrency` (see `models.py`, which also sets the model used by each stage)
+max_concurent_request = 1500
+throttlers = {}  # model -> concurrency limiter, created on first use
+
+# Ensure we do not hold too many chunks being extracted in memory
+max_chunks_in_flight = 512
+chunk_throttler = asyncio.Semaphore(max_chunks_in_flight)
+
+# Number of files processed at the same time by the streaming pipeline
+max_files_in_flight = 64
+
+# Answer the questions extracted from a chunk in batches, sending the chunk once per batch rather than once per question
+batch_answering = True
+max_questions_per_batch = 10
+
+# Stream extraction outputs, answering questions while the following ones are still being generated
+streaming_extraction = True
+
+# Extractions and answers in progress, shared between the files being processed
+# so that a chunk contained in several files is extracted and answered once
+chunks_in_flight = {}  # chunk hash -> extraction task
+answers_in_flight = {}  # (chunk hash, question index) -> (answering task, position of the answer in the task output)
+
+# Number of chunks produced by splitting, with and without merging small sibling sections
+splitting_stats = {'nb_unpacked_chunks': 0, 'nb_chunks': 0}
+
+
+def get_throttler(model):
+    """
+    Returns the concurrency limiter of a model, creating it if needed.
+    """
+    throttler = throttlers.get(model)
+    if throttler is None:
+        throttler = AdaptiveConcurrencyLimiter(min(max_concurent_request, get_model(model)['max_concurrency']))
+        throttlers[model] = throttler
+    return throttler
 
 
 def flatten_nested_lists(nested_lists):
@@ -45,49 +93,185 @@ def flatten_nested_lists(nested_lists):
 
     return flattened_list
 
-@retry(
-    wait=wait_random_exponential(min=15, max=40),
-)
-async def run_model(messages):
+async def call_model(messages, model, stage, num_tokens_in_messages, max_tokens, circuit_breaker, on_text=None):
     """
-    Asynchronously runs the chat model with as many tokens as possible on the given messages.
-    
+    Asynchronously makes a single attempt at running a chat model, within its rate limits, its concurrency limit and the circuit breaker.
+
     Args:
-        messages (list): A list of input messages to be processed by the model.
+        messages (list of dict): A list of input messages to be processed by the model.
+        model (str): The name of the model called.
+        stage (str): The pipeline stage making the call, used to label metrics.
+        num_tokens_in_messages (int): The number of tokens in the input messages.
+        max_tokens (int): The maximum number of tokens to generate.
+        circuit_breaker (CircuitBreaker): The circuit breaker of the endpoint called.
+        on_text (callable): If not None, the output is streamed (see `run_model`).
 
     Returns:
-        str: The model-generated output text after processing the input messages.
+        dict: The output of the backend, exceptions raised by the backend are passed on.
     """
-    async with api_key_lock:  # Ensure that the rotation is thread-safe
-        global api_key_index
-        os.environ['OPENAI_API_KEY'] = API_KEYS[api_key_index]
-        api_key_index = (api_key_index + 1) % len(API_KEYS)
-    # Count the number of tokens in the input messages
-    num_tokens_in_messages = count_tokens_messages(messages)
+    # Fail immediately while the endpoint is known to be down
+    is_trial = circuit_breaker.check()
 
-    # Calculate the number of tokens available for processing
-    num_tokens_available = get_available_tokens(num_tokens_in_messages)
+    # Rotate between API keys
+    api_key = backend.next_api_key()
 
-    # Create an instance of the ChatOpenAI model with minimum imagination (temperature set to 0)
-    model = ChatOpenAI(temperature=0.0, max_tokens=num_tokens_available)
+    # Wait until both the prompt and the requested completion fit in the rate limits
+    rate_limiter = get_rate_limiter(model, api_key)
+    num_tokens_reserved = num_tokens_in_messages + max_tokens
+    with metrics.span('rate_limiter_wait', stage=stage):
+        try:
+            await rate_limiter.acquire(num_tokens_reserved, priority=get_priority(stage, num_tokens_reserved))
+        except BaseException:
+            # A trial call cancelled before being made lets another call try the endpoint
+            if is_trial: circuit_breaker.cancel_trial()
+            raise
 
+    # Limit the number of simultaneous calls, adapting the limit to the outcome of each call
+    outcome = 'failure'
+    throttler = get_throttler(model)
+    throttler_wait_start = time.time()
     try:
-        # Use a semaphore to limit the number of simultaneous calls
-        async with throttler:
-            # Asynchronously run the model on the input messages
-            output = await model._agenerate(messages)
-    except openai.error.RateLimitError as e:
+        start_time = await throttler.acquire()
+    except BaseException:
+        rate_limiter.refund(num_tokens_reserved, num_tokens_in_messages)
+        if is_trial: circuit_breaker.cancel_trial()
+        raise
+    metrics.record_span('throttler_wait', throttler_wait_start, stage=stage)
+    try:
+        # Asynchronously run the model on the input messages, with minimum imagination (temperature set to 0)
+        with metrics.span('api_call', stage=stage):
+            if on_text is not None: on_text(None)
+            output = await backend.chat_completion(model, messages, temperature=0.0, max_tokens=max_tokens, api_key=api_key, on_text=on_text)
+        outcome = 'success'
+    except RateLimitError as e:
+        # Rejected calls do not produce a completion, give back its reservation
+        rate_limiter.refund(num_tokens_reserved, num_tokens_in_messages)
+        outcome = 'congestion'
+        circuit_breaker.record_success(is_trial)
+        metrics.increment('requests_total', stage=stage, outcome='rate_limited')
         print(f"ERROR ({e}): Rate limit exceeded, retrying.")
-        raise  # Re-raise the exception to allow tenacity to handle the retry
-    except openai.error.APIConnectionError as e:
+        raise
+    except APIConnectionError as e:
+        rate_limiter.refund(num_tokens_reserved, num_tokens_in_messages)
+        # Timeouts signal an overloaded server, other connection errors a failing one
+        outcome = 'congestion' if isinstance(e.__cause__, asyncio.TimeoutError) else 'failure'
+        circuit_breaker.record_failure(is_trial)
+        metrics.increment('requests_total', stage=stage, outcome='connection_error')
         print(f"ERROR ({e}): Could not connect, retrying.")
-        raise  # Re-raise the exception to allow tenacity to handle the retry
-    except Exception as e:
-        print(f"ERROR ({e}): Could not generate text for an input.")
-        return 'ERROR'
+        raise
+    except BaseException as e:
+        rate_limiter.refund(num_tokens_reserved, num_tokens_in_messages)
+        # An error answered by the server (such as an invalid request) shows that the endpoint is up
+        if isinstance(e, APIError):
+            circuit_breaker.record_success(is_trial)
+        elif is_trial:
+            circuit_breaker.cancel_trial()
+        if isinstance(e, Exception):
+            metrics.increment('requests_total', stage=stage, outcome='error')
+            print(f"ERROR ({e}): Could not generate text for an input.")
+        raise
+    finally:
+        throttler.release(start_time, outcome, stage=stage)
+        metrics.set('concurrency_limit', throttler.limit, model=model)
+    circuit_breaker.record_success(is_trial)
+
+    # Give back the tokens that were reserved but not used
+    num_tokens_used = output['usage'].get('total_tokens', num_tokens_reserved)
+    rate_limiter.refund(num_tokens_reserved, num_tokens_used)
+    metrics.increment('requests_total', stage=stage, outcome='success')
+    metrics.increment('prompt_tokens_total', output['usage'].get('prompt_tokens', num_tokens_in_messages), stage=stage)
+    metrics.increment('completion_tokens_total', output['usage'].get('completion_tokens', num_tokens_used - num_tokens_in_messages), stage=stage)
+    metrics.increment('reserved_tokens_total', num_tokens_reserved, stage=stage)
+    return output
+
+async def run_model(messages, stage='unknown', expected_output_tokens=None, on_text=None):
+    """
+    Asynchronously runs the chat model of a stage (see `models.stage_models`) on the given messages.
+    Failed attempts are retried (see `retrying.py`), calls that still fail are added to the dead-letter list.
     
-    # Extract and return the generated text from the model output
-    return output.generations[0].text.strip()
+    Args:
+        messages (list of dict): A list of input messages to be processed by the model.
+        stage (str): The pipeline stage making the call ('extraction', 'answering', 'batch_answering'), used to label metrics.
+        expected_output_tokens (float): The predicted size of the output, used to request (and reserve) fewer tokens
+            than the remaining context. If None, or if the output is truncated, as many tokens as possible are requested.
+        on_text (callable): If not None, the output is streamed and this function is called on each piece of text as it is generated.
+            It is called with None whenever the call starts over (on retries), the text received previously should then be discarded.
+
+    Returns:
+        str: The model-generated output text after processing the input messages, None if the call failed.
+    """
+    # Count the number of tokens in the input messages
+    model = get_stage_model(stage)
+    num_tokens_in_messages = count_tokens_messages(messages, model=model)
+
+    # Calculate the number of tokens available for processing, given the context window of the model
+    num_tokens_available = get_available_tokens(num_tokens_in_messages, model=model)
+    max_tokens = num_tokens_available if expected_output_tokens is None else min(num_tokens_available, get_max_tokens(expected_output_tokens))
+
+    # Reuse the output of an identical previous call if there is one
+    # (keyed on the context available rather than on `max_tokens`, outputs truncated by a reduced `max_tokens` are never stored)
+    response_cache = get_response_cache()
+    if response_cache is not None:
+        cache_key = hash_request(model, 0.0, num_tokens_available, messages)
+        cached_output = await response_cache.get_async(cache_key)
+        if cached_output is not None:
+            metrics.increment('cache_hits_total', stage=stage)
+            if on_text is not None:
+                on_text(None)
+                on_text(cached_output)
+            return cached_output
+
+    # Retry the call until it succeeds, waiting between attempts (as long as asked to by the server, if it says)
+    circuit_breaker = get_circuit_breaker(f"{getattr(backend, 'base_url', type(backend).__name__)}/{model}")
+    output = None
+    attempt = 0
+    while attempt < retrying.max_attempts:
+        try:
+            output = await call_model(messages, model, stage, num_tokens_in_messages, max_tokens, circuit_breaker, on_text=on_text)
+            break
+        except CircuitOpenError as e:
+            # Calls wait for the endpoint to recover (end of the cooldown, or result of the trial call),
+            # this only uses up an attempt if the trial call failed
+            wait_start = time.time()
+            has_recovered = await circuit_breaker.wait_for_recovery()
+            metrics.observe('retry_sleep_seconds', time.time() - wait_start, reason=type(e).__name__)
+            if not has_recovered:
+                attempt += 1
+                error = e
+        except (RateLimitError, APIConnectionError) as e:
+            attempt += 1
+            error = e
+            if attempt < retrying.max_attempts:
+                reason = type(e).__name__
+                delay = get_retry_delay(attempt, getattr(e, 'retry_after', None))
+                metrics.increment('retries_total', reason=reason)
+                metrics.observe('retry_sleep_seconds', delay, reason=reason)
+                await asyncio.sleep(delay)
+        except Exception as e:
+            # Retrying will not fix the call (invalid request, unexpected output)
+            attempt += 1
+            error = e
+            break
+
+    # Calls that still fail are not stored anywhere, they are retried on the next run
+    if output is None:
+        metrics.increment('dead_letters_total', stage=stage)
+        record_dead_letter(stage, messages, error, attempt)
+        print(f"ERROR ({error}): Giving up on a call after {attempt} attempts, it will be retried on the next run.")
+        return None
+
+    # The output did not fit in the predicted size, run the call again with the full context
+    if (output.get('finish_reason') == 'length') and (max_tokens < num_tokens_available):
+        metrics.increment('truncated_outputs_total', stage=stage)
+        print(f"WARNING: Output truncated at {max_tokens} tokens, retrying with {num_tokens_available} tokens.")
+        return await run_model(messages, stage=stage, on_text=on_text)
+
+    # Extract the generated text from the model output and store it for future runs
+    output_text = output['text'].strip()
+    if response_cache is not None:
+        await response_cache.set_async(cache_key, output_text, nb_tokens=output['usage'].get('total_tokens', num_tokens_in_messages + max_tokens))
+
+    return output_text
 
 def extract_questions_from_output(output):
     """
@@ -114,6 +298,262 @@ def extract_questions_from_output(output):
     return questions
 
 
+class QuestionStreamParser:
+    """
+    Incremental version of `extract_questions_from_output`, fed with the output of the model as it is generated.
+    A question is emitted as soon as its line is complete and ends with punctuation or a parenthesis.
+    Other questions are emitted once the next question arrives (only the last question of the list can be incomplete),
+    so that the questions emitted are always those `extract_questions_from_output` would return on the full output.
+    """
+
+    question_pattern = re.compile(r"^\s*\d+\.\s*(.+)$")
+    complete_question_pattern = re.compile(r"[.!?)]$")
+
+    def __init__(self):
+        self.questions = []
+        self.reset()
+
+    def reset(self):
+        """
+        Discards the output received so far (the call starts over), questions already emitted are not emitted again.
+        """
+        self.partial_line = ''
+        self.held_question = None
+        self.nb_questions_seen = 0
+
+    def parse_line(self, line):
+        """
+        Returns the questions that can be emitted once a full line has been received.
+        """
+        match = self.question_pattern.match(line)
+        if match is None:
+            return []
+        question = match.group(1)
+        new_questions = []
+        if self.held_question is not None:
+            new_questions.append(self.held_question)
+            self.held_question = None
+        if self.complete_question_pattern.search(question.strip()):
+            new_questions.append(question)
+        else:
+            self.held_question = question
+        return new_questions
+
+    def emit(self, new_questions):
+        """
+        Records new questions, skipping those already emitted before the call started over.
+        """
+        emitted_questions = []
+        for question in new_questions:
+            self.nb_questions_seen += 1
+            if self.nb_questions_seen > len(self.questions):
+                self.questions.append(question)
+                emitted_questions.append(question)
+        return emitted_questions
+
+    def feed(self, text):
+        """
+        Adds a piece of output (None if the call starts over) and returns the questions completed by it.
+        """
+        if text is None:
+            self.reset()
+            return []
+        lines = (self.partial_line + text).split('\n')
+        self.partial_line = lines.pop()
+        new_questions = []
+        for line in lines:
+            new_questions.extend(self.parse_line(line))
+        return self.emit(new_questions)
+
+    def finish(self):
+        """
+        Parses the last line once the output is complete, and returns the questions completed by it.
+        """
+        new_questions = self.parse_line(self.partial_line)
+        self.partial_line = ''
+        if self.held_question is not None:
+            print(f"WARNING: Popping incomplete question: '{self.held_question}'")
+            self.held_question = None
+        return self.emit(new_questions)
+
+
+def extract_answers_from_output(output, nb_questions):
+    """
+    Takes the output of a batch answering conversation and returns the answers it contains.
+    The output is expected to be a JSON array of `{"id", "answer"}` objects, a numbered list is accepted as a fallback.
+
+    Args:
+        output (str): The output of the model.
+        nb_questions (int): The number of questions asked.
+
+    Returns:
+        dict: A dictionary mapping the (zero-based) index of each question answered to its answer.
+    """
+    answers = {}
+
+    # Parse the outermost JSON array, ignoring any prefix/suffix around it
+    try:
+        items = json.loads(output[output.index('['):output.rindex(']') + 1])
+        for item in items:
+            if isinstance(item, dict) and isinstance(item.get('answer'), str) and str(item.get('id')).strip().isdigit():
+                index = int(item.get('id')) - 1
+                if (0 <= index < nb_questions) and (len(item['answer'].strip()) > 0):
+                    answers[index] = item['answer'].strip()
+    except (ValueError, TypeError):
+        # Fall back on a numbered list
+        answers = extract_numbered_answers(output, nb_questions)
+
+    return answers
+
+
+def extract_numbered_answers(output, nb_questions):
+    """
+    Takes an output written as a numbered list of answers and returns the answers it contains, each answer running until the next one.
+    Numbered lists inside an answer are told apart from the answers by their indentation or, when they are not indented,
+    by their numbering restarting at 1 (such a list goes on for as long as its numbers follow each other).
+
+    Args:
+        output (str): The output of the model.
+        nb_questions (int): The number of questions asked.
+
+    Returns:
+        dict: A dictionary mapping the (zero-based) index of each question answered to its answer.
+    """
+    marker_pattern = re.compile(r"^(\s*)(\d+)[.)](?:\s+|$)(.*)$")
+    answer_lines = {}  # number of an answer -> its lines
+    answer_number = 0  # number of the answer being read
+    answer_indentation = None  # indentation of the answer markers
+    list_number = None  # number of the last item of the non-indented list being read inside the answer, if any
+    for line in output.split('\n'):
+        match = marker_pattern.match(line)
+        if match is not None:
+            indentation, number = len(match.group(1).expandtabs()), int(match.group(2))
+            is_top_level = (answer_indentation is None) or (indentation <= answer_indentation)
+            is_list_item = (list_number is not None) and (number == list_number + 1)
+            if is_top_level and (number == answer_number + 1) and not is_list_item:
+                answer_number = number
+                answer_indentation = indentation if answer_indentation is None else answer_indentation
+                list_number = None
+                answer_lines[answer_number] = [match.group(3)]
+                continue
+            if is_top_level and (answer_number > 0) and ((number == 1) or is_list_item):
+                list_number = number
+        if answer_number > 0:
+            answer_lines[answer_number].append(line)
+
+    answers = {}
+    for number, lines in answer_lines.items():
+        answer = '\n'.join(lines).strip()
+        if (number <= nb_questions) and (len(answer) > 0):
+            answers[number - 1] = answer
+    return answers
+
+
+def split_text_into_chunks(file_path, text, stats=None):
+    """
+    Splits a text into chunks small enough to be processed by the model, along its markdown headings.
+    
+    Args:
+        file_path (str): The file path of the markdown file.
+        text (str): The text content of the markdown file.
+        stats (dict): The chunk counters updated by the splitting (see `cut_markdown_tree`), defaults to `splitting_stats`
+            (which is only updated on the event loop thread, worker threads pass their own counters).
+
+    Returns:
+        list of tuple: A list of tuples, each containing the path and the text of a chunk.
+    """
+    # Build the heading tree of the text, tokenizing all lines at once
+    markdown_tree = parse_markdown_tree(text, count_tokens_text, count_tokens_texts)
+
+    # Select the largest sections (merging small siblings) that leave enough tokens for both conversations
+    chunks = cut_markdown_tree(markdown_tree, file_path, are_tokens_available_for_both_conversations, stats=splitting_stats if stats is None else stats)
+    if len(chunks) > 1:
+        print(f"WARNING: Splitting '{file_path}' into {len(chunks)} smaller chunks.")
+    return chunks
+
+
+def split_and_fingerprint_text(file_path, text):
+    """
+    Splits a text into chunks (see `split_text_into_chunks`) and computes the fingerprints of each chunk.
+    This runs in a worker thread (see `split_and_fingerprint_text_in_thread`), so its statistics are returned rather than recorded.
+
+    Args:
+        file_path (str): The file path of the markdown file.
+        text (str): The text content of the markdown file.
+
+    Returns:
+        tuple: A list of tuples, each containing the path, the text, the content hash and the near-duplicate fingerprint (see `deduplication.py`) of a chunk,
+            and the statistics of the splitting: its 'start' time, its 'duration' and the chunk counters of `splitting_stats`.
+    """
+    start = time.time()
+    stats = dict.fromkeys(splitting_stats, 0)
+    chunks = [(chunk_path, chunk_text, hash_text(chunk_text), compute_chunk_fingerprint(chunk_text))
+              for chunk_path, chunk_text in split_text_into_chunks(file_path, text, stats=stats)]
+    stats.update(start=start, duration=time.time() - start)
+    return chunks, stats
+
+
+async def split_and_fingerprint_text_in_thread(file_path, text):
+    """
+    Asynchronously splits and fingerprints a text (see `split_and_fingerprint_text`) in a worker thread, as it is CPU-bound and would stall the event loop on large files,
+    then records the statistics of the splitting on the event loop thread.
+
+    Returns:
+        list of tuple: The path, text, content hash and near-duplicate fingerprint of each chunk.
+    """
+    chunks, stats = await asyncio.to_thread(split_and_fingerprint_text, file_path, text)
+    for name in splitting_stats:
+        splitting_stats[name] += stats[name]
+    metrics.record_span('splitting', stats['start'], duration=stats['duration'])
+    return chunks
+
+
+async def extract_questions_from_chunk(file_path, text, on_question=None):
+    """
+    Asynchronously extracts questions from a chunk of text small enough to be processed by the model.
+    
+    Args:
+        file_path (str): The path of the chunk.
+        text (str): The text content of the chunk.
+        on_question (callable): If not None (and `streaming_extraction` is True), the output is streamed
+            and this function is called with the index and text of each question as soon as it is complete.
+
+    Returns:
+        list of tuple: A list of tuples, each containing the file path, text, and extracted question, None if the call failed.
+    """
+    # Run the model to extract questions
+    messages = create_extraction_conversation_messages(text)
+    text_token_count = count_tokens_text(text, model=get_stage_model('extraction'))
+    expected_output_tokens = estimate_extraction_output_tokens(text_token_count)
+    async with chunk_throttler:
+        with metrics.span('extraction'):
+            if streaming_extraction and (on_question is not None):
+                parser = QuestionStreamParser()
+
+                def notify(new_questions):
+                    first_index = len(parser.questions) - len(new_questions)
+                    for offset, question in enumerate(new_questions):
+                        on_question(first_index + offset, question.strip())
+
+                output = await run_model(messages, stage='extraction', expected_output_tokens=expected_output_tokens,
+                                         on_text=lambda text: notify(parser.feed(text)))
+                if output is None:
+                    return None
+                notify(parser.finish())
+                questions = parser.questions
+            else:
+                output = await run_model(messages, stage='extraction', expected_output_tokens=expected_output_tokens)
+                if output is None:
+                    return None
+                questions = extract_questions_from_output(output)
+    observe_extraction(text_token_count, questions)
+    metrics.increment('questions_extracted_total', len(questions))
+
+    # Associate questions with source information and return as a list of tuples
+    outputs = [(file_path, text, question.strip()) for question in questions]
+    return outputs
+
+
 async def extract_questions_from_text(file_path, text):
     """
     Asynchronously extracts questions from the given text.
@@ -125,36 +565,23 @@ async def extract_questions_from_text(file_path, text):
     Returns:
         list of tuple: A list of tuples, each containing the file path, text, and extracted question.
     """
-    # Ensure the text can be processed by the model
-    global api_key_index
-    text = text.strip()
-    num_tokens_text = count_tokens_text(text)
+    start = time.time()
 
-    if not are_tokens_available_for_both_conversations(num_tokens_text):
-        # Split text and call function recursively
-        print(f"WARNING: Splitting '{file_path}' into smaller chunks.")
+    # Ensure the text can be processed by the model, splitting it if needed
+    with metrics.span('splitting'):
+        chunks = split_text_into_chunks(file_path, text.strip())
 
-        # Build tasks for each subsection of the text
-        tasks = []
-        for sub_title, sub_text in split_markdown(text):
-            sub_file_path = file_path + '/' + sub_title.replace('# ', '#').replace(' ', '-').lower()
-            task = extract_questions_from_text(sub_file_path, sub_text)
-            tasks.append(task)
-
-        # Asynchronously run tasks and gather outputs
-        tasks_outputs = await asyncio.gather(*tasks)
+    # Build and run extraction tasks for each chunk
+    tasks = []
+    for chunk_path, chunk_text in chunks:
+        task = extract_questions_from_chunk(chunk_path, chunk_text)
+        tasks.append(task)
 
-        # Flatten and return the results
-        return flatten_nested_lists(tasks_outputs)
-    else:
-        # Run the model to extract questions
-        messages = create_extraction_conversation_messages(text)
-        output = await run_model(messages)
-        questions = extract_questions_from_output(output)
+    tasks_outputs = await asyncio.gather(*tasks)
+    metrics.record_span('text_extraction', start)
 
-        # Associate questions with source information and return as a list of tuples
-        outputs = [(file_path, text, question.strip()) for question in questions]
-        return outputs
+    # Flatten and return the results, skipping the chunks whose extraction failed
+    return flatten_nested_lists([outputs for outputs in tasks_outputs if outputs is not None])
 
 
 async def generate_answer(question, source):
@@ -166,19 +593,423 @@ async def generate_answer(question, source):
         source (str): The text containing relevant information for answering the question.
 
     Returns:
-        str: The generated answer to the question.
+        str: The generated answer to the question, None if the call failed.
     """
     # Create the input messages for the chat model
     messages = create_answering_conversation_messages(question, source)
     # Asynchronously run the chat model with the input messages
-    answer = await run_model(messages)
+    with metrics.span('answering'):
+        answer = await run_model(messages, stage='answering', expected_output_tokens=estimate_answering_output_tokens())
+    observe_answer(answer)
 
     return answer
 
+
+async def answer_question(file_path, text, question, result_queue=None):
+    """
+    Asynchronously answers a question and packages it as a result record.
+
+    Args:
+        file_path (str): The path of the chunk the question was extracted from.
+        text (str): The text of the chunk the question was extracted from.
+        question (str): The question to be answered.
+        result_queue (asyncio.Queue): If not None, the record is also put in this queue as soon as it is ready.
+
+    Returns:
+        dict: A dictionary containing source, question, and answer information (the answer is None if the call failed).
+    """
+    answer = await generate_answer(question, text)
+    record = {'source': file_path, 'question': question, 'answer': answer}
+    if (result_queue is not None) and (answer is not None):
+        await result_queue.put(record)
+    return record
+
+async def answer_question_batch(file_path, text, questions, result_queue=None):
+    """
+    Asynchronously answers several questions about the same text in a single call.
+    Questions whose answer cannot be found in the output are answered individually.
+
+    Args:
+        file_path (str): The path of the chunk the questions were extracted from.
+        text (str): The text of the chunk the questions were extracted from.
+        questions (list of str): The questions to be answered.
+        result_queue (asyncio.Queue): If not None, records are also put in this queue as soon as they are ready.
+
+    Returns:
+        list of dict: Dictionaries containing source, question, and answer information, in the order of the questions
+            (answers are None if the call failed).
+    """
+    if len(questions) == 1:
+        return [await answer_question(file_path, text, questions[0], result_queue=result_queue)]
+
+    messages = create_batch_answering_conversation_messages(questions, text)
+    with metrics.span('batch_answering'):
+        output = await run_model(messages, stage='batch_answering', expected_output_tokens=estimate_answering_output_tokens(len(questions)))
+    if output is None:
+        return [{'source': file_path, 'question': question, 'answer': None} for question in questions]
+    answers = extract_answers_from_output(output, len(questions))
+    for answer in answers.values():
+        observe_answer(answer)
+
+    records = [None] * len(questions)
+    retry_indices = []
+    for index, question in enumerate(questions):
+        if index in answers:
+            records[index] = {'source': file_path, 'question': question, 'answer': answers[index]}
+            if result_queue is not None:
+                await result_queue.put(records[index])
+        else:
+            retry_indices.append(index)
+
+    # Retry the questions that were not answered, one at a time
+    if len(retry_indices) > 0:
+        print(f"WARNING: {len(retry_indices)}/{len(questions)} answers missing from a batch on '{file_path}', answering them individually.")
+        metrics.increment('batch_answers_missing_total', len(retry_indices))
+        tasks = [answer_question(file_path, text, questions[index], result_queue=result_queue) for index in retry_indices]
+        for index, record in zip(retry_indices, await asyncio.gather(*tasks)):
+            records[index] = record
+
+    return records
+
+
+def get_question_batches(text, questions):
+    """
+    Groups questions about the same text into batches that can be answered in a single call.
+
+    Args:
+        text (str): The text the questions were extracted from.
+        questions (list of str): The questions to be answered.
+
+    Returns:
+        list of range: The indices of the questions in each batch.
+    """
+    model = get_stage_model('batch_answering')
+    text_token_count = count_tokens_text(text, model=model)
+    question_token_counts = count_tokens_texts(questions, model=model)
+    return split_questions_into_batches(text_token_count, question_token_counts, max_batch_size=max_questions_per_batch)
+
+
+async def answer_questions_in_batches(file_path, text, questions, result_queue=None):
+    """
+    Asynchronously answers all questions extracted from a chunk, grouping them in batches that fit the token budget.
+
+    Args:
+        file_path (str): The path of the chunk the questions were extracted from.
+        text (str): The text of the chunk the questions were extracted from.
+        questions (list of str): The questions to be answered.
+        result_queue (asyncio.Queue): If not None, records are also put in this queue as soon as they are ready.
+
+    Returns:
+        list of dict: Dictionaries containing source, question, and answer information, in the order of the questions.
+    """
+    tasks = []
+    for batch in get_question_batches(text, questions):
+        task = answer_question_batch(file_path, text, [questions[index] for index in batch], result_queue=result_queue)
+        tasks.append(task)
+
+    tasks_outputs = await asyncio.gather(*tasks)
+    return flatten_nested_lists(tasks_outputs)
+
 #---------------------------------------------------------------------------------------------
 # FILE PROCESSING
 
-async def process_file(file_path, text, progress_counter, verbose=True,max_qa_pairs=300):
+async def replay_file(file_path, max_qa_pairs, result_queue=None):
+    """
+    Asynchronously returns the records of a file that did not change since it was last processed, as stored in the manifest.
+
+    Args:
+        file_path (str): The file path of the markdown file.
+        max_qa_pairs (int): The maximum number of questions kept per file.
+        result_queue (asyncio.Queue): If not None, each record is put in this queue.
+
+    Returns:
+        list: A list of dictionaries containing source, question, and answer information.
+    """
+    result = get_manifest().get_records(file_path, max_qa_pairs)
+    metrics.increment('qa_pairs_total', len(result), origin='manifest')
+    if deduplication.deduplication_scope == 'corpus':
+        deduplicator = get_deduplicator()
+        for record in result:
+            deduplicator.add(record['question'])
+    if result_queue is not None:
+        for record in result:
+            await result_queue.put(record)
+    return result
+
+
+def get_chunk_representative(chunk_hash, fingerprint, pending_hashes):
+    """
+    Returns the hash of the chunk whose questions and answers are used for a chunk:
+    - the chunk itself if it is in the manifest, or the near-duplicate chunk the manifest maps it to (so that a chunk keeps its representative from run to run),
+    - otherwise a near-duplicate chunk seen during the run (see `find_representative_chunk`) that is in the manifest or in `pending_hashes` (being extracted),
+      the mapping being then recorded in the manifest,
+    - otherwise the chunk itself.
+
+    Args:
+        chunk_hash (str): The content hash of the chunk.
+        fingerprint (tuple): The fingerprint of the chunk (see `compute_chunk_fingerprint`).
+        pending_hashes (collection of str): The hashes of the chunks being extracted.
+
+    Returns:
+        str: The hash of the representative chunk.
+    """
+    manifest = get_manifest()
+    known_hash = manifest.get_representative(chunk_hash)
+    if known_hash is not None:
+        return known_hash
+    representative_hash = find_representative_chunk(chunk_hash, fingerprint)
+    if (representative_hash != chunk_hash) and ((representative_hash in manifest.chunks) or (representative_hash in pending_hashes)):
+        manifest.set_representative(chunk_hash, representative_hash)
+        return representative_hash
+    return chunk_hash
+
+
+def find_representative_chunks(fingerprinted_chunks):
+    """
+    Replaces the chunks that are exact or near copies of a known chunk by it (see `get_chunk_representative`),
+    their questions and answers being attributed to their own path.
+
+    Args:
+        fingerprinted_chunks (list of tuple): The path, text, content hash and fingerprint of each chunk (see `split_and_fingerprint_text`).
+
+    Returns:
+        list of tuple: The path, text and hash of each chunk (the hash of the chunk it is replaced by, if any).
+    """
+    chunks = []
+    for chunk_path, chunk_text, chunk_hash, fingerprint in fingerprinted_chunks:
+        representative_hash = get_chunk_representative(chunk_hash, fingerprint, chunks_in_flight)
+        if representative_hash != chunk_hash:
+            metrics.increment('duplicate_chunks_total', kind='near')
+        elif chunk_hash in chunks_in_flight:
+            metrics.increment('duplicate_chunks_total', kind='exact')
+        chunks.append((chunk_path, chunk_text, representative_hash))
+    return chunks
+
+
+class ChunkQuestionCollector:
+    """
+    Collects the questions of a chunk as they are extracted: near-duplicate questions are dropped (see `deduplication.py`)
+    and the questions kept are answered, in batches (see `start_answering`), as soon as a batch is full,
+    while the following questions are still being generated.
+
+    Args:
+        chunk_path (str): The path of the chunk.
+        chunk_text (str): The text of the chunk.
+        chunk_hash (str): The content hash of the chunk.
+        file_extraction (dict): The extraction of the file the chunk belongs to (see `process_file`): its 'deduplicator' (None if disabled),
+            its 'max_qa_pairs', the 'nb_questions_extracted' from its chunks so far and the 'answering_tasks' started during extraction.
+    """
+
+    def __init__(self, chunk_path, chunk_text, chunk_hash, file_extraction):
+        self.chunk_path = chunk_path
+        self.chunk_text = chunk_text
+        self.chunk_hash = chunk_hash
+        self.file_extraction = file_extraction
+        # Counted with the tokenizer of the model answering the batches, as in `get_question_batches`
+        self.batch_model = get_stage_model('batch_answering')
+        self.text_token_count = count_tokens_text(chunk_text, model=self.batch_model)
+        self.kept_questions = []  # questions that are not near-duplicates, their index in this list is their index in the manifest
+        self.nb_questions_seen = 0
+        self.pending_questions = []  # (index, question) of the questions kept but not answered yet
+        self.pending_question_token_counts = []
+
+    def keep(self, question):
+        """
+        Returns the index of a question in the chunk, None if it is a near-duplicate.
+        """
+        self.nb_questions_seen += 1
+        deduplicator = self.file_extraction['deduplicator']
+        if (deduplicator is not None) and deduplicator.is_duplicate(question):
+            return None
+        self.kept_questions.append(question)
+        return len(self.kept_questions) - 1
+
+    def on_question(self, _, question):
+        """
+        Keeps a question streamed by the extraction, starting to answer a batch of questions once it is full.
+        """
+        question_index = self.keep(question)
+        if question_index is None:
+            return
+        # Past the limit, a question might not be kept (the limit applies in the order of the chunks)
+        self.file_extraction['nb_questions_extracted'] += 1
+        if self.file_extraction['nb_questions_extracted'] > self.file_extraction['max_qa_pairs']:
+            return
+        self.pending_questions.append((question_index, question))
+        self.pending_question_token_counts.append(count_tokens_text(question, model=self.batch_model))
+        batch_size = len(self.pending_questions)
+        if batch_answering:
+            batch_size = len(split_questions_into_batches(self.text_token_count, self.pending_question_token_counts, max_batch_size=max_questions_per_batch)[0])
+        if (batch_size < len(self.pending_questions)) or (batch_size >= (max_questions_per_batch if batch_answering else 1)):
+            self.start_batch(self.pending_questions[:batch_size])
+            del self.pending_questions[:batch_size]
+            del self.pending_question_token_counts[:batch_size]
+
+    def answer_remaining_questions(self):
+        """
+        Starts answering the questions of the last, incomplete, batch.
+        """
+        if len(self.pending_questions) > 0:
+            for batch in split_questions_into_batches(self.text_token_count, self.pending_question_token_counts, max_batch_size=max_questions_per_batch):
+                self.start_batch([self.pending_questions[index] for index in batch])
+        self.pending_questions = []
+        self.pending_question_token_counts = []
+
+    def start_batch(self, pending_questions):
+        self.file_extraction['answering_tasks'].add(start_answering(self.chunk_path, self.chunk_text, self.chunk_hash,
+                                                                    [question_index for question_index, _ in pending_questions],
+                                                                    [question for _, question in pending_questions]))
+        metrics.increment('early_answered_questions_total', len(pending_questions))
+
+
+async def extract_and_record_chunk(chunk_path, chunk_text, chunk_hash, file_extraction):
+    """
+    Asynchronously extracts the questions of a chunk, answering them as they are extracted (see `ChunkQuestionCollector`),
+    and journals the questions kept as soon as they are known.
+    Chunks whose extraction failed are left out of the manifest, they are extracted again on the next run.
+
+    Args:
+        chunk_path (str): The path of the chunk.
+        chunk_text (str): The text of the chunk.
+        chunk_hash (str): The content hash of the chunk, it is registered in `chunks_in_flight` by the caller.
+        file_extraction (dict): The extraction of the file the chunk belongs to (see `ChunkQuestionCollector`).
+    """
+    collector = ChunkQuestionCollector(chunk_path, chunk_text, chunk_hash, file_extraction)
+    try:
+        chunk_questions = await extract_questions_from_chunk(chunk_path, chunk_text, on_question=collector.on_question)
+        if chunk_questions is None:
+            return
+        # Questions that were not streamed are deduplicated once the output is complete
+        for _, _, question in chunk_questions[collector.nb_questions_seen:]:
+            collector.keep(question)
+        record_duplicates(chunk_text, [question for _, _, question in chunk_questions], collector.kept_questions)
+        get_manifest().set_questions(chunk_hash, collector.kept_questions, text=chunk_text)
+    finally:
+        del chunks_in_flight[chunk_hash]
+    collector.answer_remaining_questions()
+
+
+async def extract_file_chunks(chunks, file_extraction):
+    """
+    Asynchronously extracts the questions of the chunks of a file that were never seen before,
+    and waits for its chunks being extracted for other files.
+
+    Args:
+        chunks (list of tuple): The path, text and hash of each chunk of the file.
+        file_extraction (dict): The extraction of the file (see `ChunkQuestionCollector`).
+    """
+    manifest = get_manifest()
+
+    # Near-duplicate questions are dropped as they are extracted, before any answering call is made
+    # (questions of chunks extracted during previous runs are indexed first so that new questions are checked against them)
+    deduplicator = file_extraction['deduplicator']
+    if deduplicator is not None:
+        for _, _, chunk_hash in chunks:
+            if chunk_hash in manifest.chunks:
+                for question in manifest.chunks[chunk_hash]['questions']:
+                    deduplicator.add(question)
+
+    for chunk_path, chunk_text, chunk_hash in chunks:
+        if (chunk_hash not in manifest.chunks) and (chunk_hash not in chunks_in_flight):
+            chunks_in_flight[chunk_hash] = asyncio.create_task(extract_and_record_chunk(chunk_path, chunk_text, chunk_hash, file_extraction))
+    await asyncio.gather(*{chunks_in_flight[chunk_hash] for _, _, chunk_hash in chunks if chunk_hash in chunks_in_flight})
+
+
+def list_file_questions(chunks, max_qa_pairs):
+    """
+    Lists the first `max_qa_pairs` questions of the chunks of a file, as stored in the manifest.
+
+    Args:
+        chunks (list of tuple): The path, text and hash of each chunk of the file.
+        max_qa_pairs (int): The maximum number of questions kept per file.
+
+    Returns:
+        tuple: The `(chunk path, chunk text, chunk hash, question index, question)` of each question, and its answer (None if it is unknown).
+    """
+    manifest = get_manifest()
+    questions = []
+    known_answers = []
+    for chunk_path, chunk_text, chunk_hash in chunks:
+        chunk = manifest.chunks.get(chunk_hash)
+        if chunk is None:
+            continue
+        for question_index, (question, answer) in enumerate(zip(chunk['questions'], chunk['answers'])):
+            questions.append((chunk_path, chunk_text, chunk_hash, question_index, question))
+            known_answers.append(answer)
+    return questions[:max_qa_pairs], known_answers[:max_qa_pairs]
+
+
+async def collect_answer(answer_in_flight, source, result_queue=None):
+    """
+    Asynchronously waits for the answer to a question being answered (see `start_answering`).
+
+    Args:
+        answer_in_flight (tuple): The answering task and the position of the answer in its output, as registered in `answers_in_flight`.
+        source (str): The path of the chunk in the file the answer is collected for.
+        result_queue (asyncio.Queue): If not None, the record is put in this queue.
+
+    Returns:
+        dict: The source, question and answer, None if the answer failed.
+    """
+    answering_task, position = answer_in_flight
+    record = (await answering_task)[position]
+    if record['answer'] is None:
+        return None
+    record = dict(record, source=source)
+    metrics.increment('qa_pairs_total', origin='model')
+    if result_queue is not None:
+        await result_queue.put(record)
+    return record
+
+
+async def answer_file_questions(questions, known_answers, result_queue=None):
+    """
+    Asynchronously answers the questions of a file: answers known from a previous run (or from another file) are reused,
+    questions that are not already being answered (during extraction, or for another file) are answered,
+    grouping consecutive questions of the same chunk into batches (a chunk contained several times in the file is answered once).
+
+    Args:
+        questions (list of tuple): The questions of the file (see `list_file_questions`).
+        known_answers (list of str): The answer to each question, None if it is unknown.
+        result_queue (asyncio.Queue): If not None, each record is put in this queue as soon as it is ready.
+
+    Returns:
+        list: A list of dictionaries containing source, question, and answer information, leaving out the questions whose answer failed
+            (they are answered again on the next run).
+    """
+    result = [None] * len(questions)
+    unanswered_indices = []
+    for index, (chunk_path, _, _, _, question) in enumerate(questions):
+        answer = known_answers[index]
+        if answer is None:
+            unanswered_indices.append(index)
+        else:
+            result[index] = {'source': chunk_path, 'question': question, 'answer': answer}
+            metrics.increment('qa_pairs_total', origin='manifest')
+            if result_queue is not None:
+                await result_queue.put(result[index])
+
+    new_indices = []
+    new_questions = set()
+    for index in unanswered_indices:
+        if (questions[index][2:4] not in answers_in_flight) and (questions[index][2:4] not in new_questions):
+            new_questions.add(questions[index][2:4])
+            new_indices.append(index)
+    for (chunk_path, chunk_text, chunk_hash), chunk_indices in groupby(new_indices, key=lambda index: questions[index][:3]):
+        chunk_indices = list(chunk_indices)
+        chunk_questions = [questions[index][4] for index in chunk_indices]
+        batches = get_question_batches(chunk_text, chunk_questions) if batch_answering else [range(index, index + 1) for index in range(len(chunk_questions))]
+        for batch in batches:
+            start_answering(chunk_path, chunk_text, chunk_hash, [questions[chunk_indices[i]][3] for i in batch], [chunk_questions[i] for i in batch])
+
+    answers = {index: answers_in_flight[questions[index][2:4]] for index in unanswered_indices}
+    records = await asyncio.gather(*[collect_answer(answers[index], questions[index][0], result_queue) for index in unanswered_indices])
+    for index, record in zip(unanswered_indices, records):
+        result[index] = record
+    return [record for record in result if record is not None]
+
+
+async def process_file(file_path, text, progress_counter, verbose=True, max_qa_pairs=300, result_queue=None):
     """
     Asynchronously processes a file, extracting questions and generating answers concurrently.
     
@@ -187,53 +1018,119 @@ async def process_file(file_path, text, progress_counter, verbose=True,max_qa_pa
         text (str): The text content of the markdown file.
         progress_counter (dict): A dictionary containing progress information ('nb_files_done' and 'nb_files').
         verbose (bool): If True, print progress information. Default is True.
+        max_qa_pairs (int): The maximum number of questions kept per file. Default is 300.
+        result_queue (asyncio.Queue): If not None, each record is put in this queue as soon as it is ready.
 
     Returns:
         list: A list of dictionaries containing source, question, and answer information.
     """
-    questions_file_name = f"{file_path}.json"
-    if Path(questions_file_name).is_file():
-        with open(questions_file_name, 'r') as input_file:
-            questions = json.loads(input_file.read())
-    else:
-        # Extract questions from the text
-        questions = await extract_questions_from_text(file_path, text)
-
-        # Limit the number of questions processed
-        questions = questions[:max_qa_pairs]
+    start = time.time()
+    start_file()
+    manifest = get_manifest()
+    file_hash = hash_text(text)
 
-        with open(questions_file_name, 'w') as output_file:
-            json.dump(questions, output_file, indent=2)
-
-    results_filename = f"{file_path}.result.json"
-    result = []
-    if Path(results_filename).is_file():
-        with open(results_filename, 'r') as input_file2:
-            result = json.loads(input_file2.read())
+    if manifest.is_file_done(file_path, file_hash, max_qa_pairs):
+        # The file did not change since it was last processed
+        result = await replay_file(file_path, max_qa_pairs, result_queue)
     else:
-        # Build and run answering tasks concurrently
-        tasks = []
-        for sub_file_path, sub_text, question in questions:
-            task = generate_answer(question, sub_text)
-            tasks.append(task)
+        # Split the text, replacing copies of chunks seen during the run
+        chunks = find_representative_chunks(await split_and_fingerprint_text_in_thread(file_path, text.strip()))
 
-        tasks_outputs = await asyncio.gather(*tasks)
+        # Extract questions from the new chunks, answering them as soon as they are extracted (each chunk is journaled as soon as its questions are known)
+        file_extraction = {'deduplicator': get_deduplicator(), 'max_qa_pairs': max_qa_pairs, 'nb_questions_extracted': 0, 'answering_tasks': set()}
+        await extract_file_chunks(chunks, file_extraction)
+        manifest.set_file(file_path, file_hash, [(chunk_path, chunk_hash) for chunk_path, _, chunk_hash in chunks])
 
-        # Merge results into a list of dictionaries
-        for (sub_file_path, sub_text, question), answer in zip(questions, tasks_outputs):
-            result.append({'source': sub_file_path, 'question': question, 'answer': answer})
+        # Answer the questions kept for the file, reusing known answers and the answers started during extraction
+        questions, known_answers = list_file_questions(chunks, max_qa_pairs)
+        result = await answer_file_questions(questions, known_answers, result_queue)
 
-        with open(results_filename, 'w') as output_file:
-            json.dump(result, output_file, indent=2)
+        # Answers started during extraction for questions past the limit are journaled for future runs
+        await asyncio.gather(*file_extraction['answering_tasks'])
+
+    # Commit the progress of the run from time to time, so that resuming it only replays a short journal
+    await manifest.checkpoint()
 
     # Update progress and display information if verbose is True
+    metrics.record_span('file', start)
     progress_counter['nb_files_done'] += 1  # No race condition as we are single-threaded
+    record_file_completion(progress_counter)
     if verbose:
         print(f"{progress_counter['nb_files_done']}/{progress_counter['nb_files']}: File '{file_path}' done!")
 
     return result
 
 
+def start_answering(chunk_path, chunk_text, chunk_hash, question_indices, questions):
+    """
+    Starts answering questions extracted from a chunk, in a single call, journaling the answers as soon as they are produced.
+    The task is registered in `answers_in_flight`, files containing the same chunk wait for it rather than answering the questions again.
+
+    Args:
+        chunk_path (str): The path of the chunk.
+        chunk_text (str): The text of the chunk.
+        chunk_hash (str): The content hash of the chunk (or of the chunk it is a near-duplicate of).
+        question_indices (list of int): The indices of the questions in the chunk.
+        questions (list of str): The questions to be answered.
+
+    Returns:
+        asyncio.Task: The task, returning the records of the questions in order.
+    """
+    async def answer_and_record():
+        try:
+            records = await answer_question_batch(chunk_path, chunk_text, questions)
+            # Answers can be produced while the chunk is still being extracted, they are journaled after its questions
+            extraction_task = chunks_in_flight.get(chunk_hash)
+            if extraction_task is not None:
+                await extraction_task
+            manifest = get_manifest()
+            for question_index, record in zip(question_indices, records):
+                # Failed answers (or answers to the questions of a chunk whose extraction failed) will be retried on the next run
+                if (record['answer'] is not None) and (chunk_hash in manifest.chunks):
+                    manifest.set_answer(chunk_hash, question_index, record['answer'])
+            return records
+        finally:
+            for question_index in question_indices:
+                del answers_in_flight[(chunk_hash, question_index)]
+
+    task = asyncio.create_task(answer_and_record())
+    for position, question_index in enumerate(question_indices):
+        answers_in_flight[(chunk_hash, question_index)] = (task, position)
+    return task
+
+
+def record_duplicates(text, questions, kept_questions):
+    """
+    Records the number of questions of a chunk dropped as near-duplicates, and the number of answering calls this saved.
+
+    Args:
+        text (str): The text of the chunk.
+        questions (list of str): The questions extracted from the chunk.
+        kept_questions (list of str): The questions kept after deduplication.
+    """
+    nb_duplicates = len(questions) - len(kept_questions)
+    if nb_duplicates == 0:
+        return
+    metrics.increment('duplicate_questions_total', nb_duplicates, scope=deduplication.deduplication_scope)
+    if batch_answering:
+        nb_calls_saved = len(get_question_batches(text, questions)) - (len(get_question_batches(text, kept_questions)) if len(kept_questions) > 0 else 0)
+    else:
+        nb_calls_saved = nb_duplicates
+    metrics.increment('answering_calls_saved_total', nb_calls_saved)
+
+
+def record_file_completion(progress_counter):
+    """
+    Records the time at which a file was completed, relative to the start of the run:
+    the first completion, the last completion (makespan) and the mean completion time measure the effect of the scheduling policy.
+    """
+    completion_time = time.time() - progress_counter['start_time']
+    if progress_counter['nb_files_done'] == 1:
+        metrics.set('first_file_completion_seconds', completion_time)
+    metrics.set('makespan_seconds', completion_time)
+    metrics.observe('file_completion_seconds', completion_time)
+
+
 async def process_files(files, verbose=True):
     """
     Asynchronously processes a list of files, extracting questions and generating answers concurrently.
@@ -247,7 +1144,7 @@ async def process_files(files, verbose=True):
     """
     # Set up progress information for display
     nb_files = len(files)
-    progress_counter = {'nb_files': nb_files, 'nb_files_done': 0}
+    progress_counter = {'nb_files': nb_files, 'nb_files_done': 0, 'start_time': time.time()}
     if verbose: print(f"Starting question extraction on {nb_files} files.")
 
     # Build and run tasks for each file concurrently
@@ -256,11 +1153,84 @@ async def process_files(files, verbose=True):
         task = process_file(file_path, text, progress_counter, verbose=verbose)
         tasks.append(task)
 
-    tasks_outputs = await asyncio.gather(*tasks)
+    progress_task = asyncio.create_task(report_progress(progress_counter)) if verbose else None
+    try:
+        tasks_outputs = await asyncio.gather(*tasks)
+    finally:
+        if progress_task is not None: progress_task.cancel()
 
     # Merge results from all tasks
     return flatten_nested_lists(tasks_outputs)
 
+
+async def stream_files(files, nb_files=None, verbose=True):
+    """
+    Asynchronously processes files with a bounded number of files in flight, yielding records as they are produced.
+    Files are pulled from the iterable only when a worker is free, and the records queue is bounded,
+    so memory usage does not grow with the size of the corpus.
+
+    Args:
+        files (iterable): An iterable of tuples containing file paths and their respective text content.
+        nb_files (int): The number of files, if known, used to display progress. Default is None.
+        verbose (bool): If True, print progress information. Default is True.
+
+    Yields:
+        dict: Dictionaries containing source, question, and answer information, in completion order.
+    """
+    progress_counter = {'nb_files': '?' if nb_files is None else nb_files, 'nb_files_done': 0, 'start_time': time.time()}
+    if verbose: print(f"Starting streaming question extraction on {progress_counter['nb_files']} files.")
+
+    files_iterator = iter(files)
+    result_queue = asyncio.Queue(maxsize=max_chunks_in_flight)
+    end_of_work = object()
+
+    async def worker():
+        # Each worker pulls the next file once it is done with the previous one
+        try:
+            for file_path, text in files_iterator:
+                await process_file(file_path, text, progress_counter, verbose=verbose, result_queue=result_queue)
+        finally:
+            await result_queue.put(end_of_work)
+
+    workers = [asyncio.create_task(worker()) for _ in range(max_files_in_flight)]
+    progress_task = asyncio.create_task(report_progress(progress_counter)) if verbose else None
+    try:
+        nb_workers_running = len(workers)
+        while nb_workers_running > 0:
+            record = await result_queue.get()
+            if record is end_of_work:
+                nb_workers_running -= 1
+            else:
+                yield record
+        # Surfaces worker exceptions, if any
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+        if progress_task is not None: progress_task.cancel()
+
+
+async def write_records_to_jsonl(records, output_path):
+    """
+    Asynchronously writes records to a JSONL file as they arrive, flushing after each record
+    so that partial results survive a crash. The file is rewritten from scratch:
+    on a resumed run, the records of completed files are served again from the manifest.
+
+    Args:
+        records (async iterable): An asynchronous iterable of dictionaries.
+        output_path (str): The path of the JSONL file to write.
+
+    Returns:
+        int: The number of records written.
+    """
+    nb_records = 0
+    with open(output_path, 'w', encoding='utf-8') as output_file:
+        async for record in records:
+            output_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            output_file.flush()
+            nb_records += 1
+    return nb_records
+
 #---------------------------------------------------------------------------------------------
 # MAIN
 
@@ -280,8 +1250,175 @@ def extract_questions_from_directory(input_folder, verbose=True):
     files = load_markdown_files_from_directory(input_folder)
 
     # Run question extraction tasks
+    clear_dead_letters()
     loop = asyncio.get_event_loop()
+    metrics_server = loop.run_until_complete(serve_metrics())
     results = loop.run_until_complete(process_files(files, verbose=verbose))
+    loop.run_until_complete(save_manifest([file_path for file_path, _ in files], verbose=verbose))
+    loop.run_until_complete(backend.close())
+    if metrics_server is not None: loop.run_until_complete(metrics_server.cleanup())
 
     if verbose: print(f"Done, {len(results)} question/answer pairs have been generated!")
+    report_statistics(verbose=verbose)
     return results
+
+
+def stream_questions_from_directory(input_folder, output_path, verbose=True, include_patterns=('*.md',), exclude_patterns=(), file_filter=None):
+    """
+    Extracts questions and answers from all markdown files in the input folder,
+    writing them to a JSONL file as they are produced (previous content is replaced, resumed runs serve finished files from the manifest).
+
+    Args:
+        input_folder (str): A path to a folder containing markdown files.
+        output_path (str): A path to the JSONL file the records are written to.
+        verbose (bool): If True, print progress information. Default is True.
+        include_patterns (tuple of str): Glob patterns of the files to process. Default is ('*.md',).
+        exclude_patterns (tuple of str): Glob patterns of the files and folders to skip. Default is ().
+        file_filter (callable): If not None, only the `MarkdownFile`s for which this function returns True are processed (see `sharding.py`).
+
+    Returns:
+        int: The number of question/answer pairs written.
+    """
+    # Scan the folder, without reading the files yet
+    if verbose: print(f"Scanning files from '{input_folder}'.")
+    markdown_files = list(scan_markdown_files(input_folder, include_patterns=include_patterns, exclude_patterns=exclude_patterns))
+    if file_filter is not None:
+        markdown_files = [markdown_file for markdown_file in markdown_files if file_filter(markdown_file)]
+
+    # Start with the largest files, so that they do not end up as a long tail
+    markdown_files.sort(key=lambda markdown_file: markdown_file.size, reverse=True)
+
+    # Files are read only when a worker picks them up
+    files = ((markdown_file.path, markdown_file.read()) for markdown_file in markdown_files)
+
+    # Run question extraction tasks, writing records as they complete
+    clear_dead_letters()
+    loop = asyncio.get_event_loop()
+    metrics_server = loop.run_until_complete(serve_metrics())
+    records = stream_files(files, nb_files=len(markdown_files), verbose=verbose)
+    nb_records = loop.run_until_complete(write_records_to_jsonl(records, output_path))
+    loop.run_until_complete(save_manifest([markdown_file.path for markdown_file in markdown_files], verbose=verbose))
+    loop.run_until_complete(backend.close())
+    if metrics_server is not None: loop.run_until_complete(metrics_server.cleanup())
+
+    if verbose: print(f"Done, {nb_records} question/answer pairs have been written to '{output_path}'!")
+    report_statistics(verbose=verbose)
+    return nb_records
+
+
+def plan_questions_from_directory(input_folder, breakdown_path=None, verbose=True, include_patterns=('*.md',), exclude_patterns=()):
+    """
+    Predicts the calls, tokens, cost and minimum wall time needed to process all markdown files in the input folder,
+    using the current configuration (API keys, batching) and without calling the model.
+
+    Args:
+        input_folder (str): A path to a folder containing markdown files.
+        breakdown_path (str): If not None, a path to a CSV file where the plan of each file is written.
+        verbose (bool): If True, print the plan. Default is True.
+        include_patterns (tuple of str): Glob patterns of the files to process. Default is ('*.md',).
+        exclude_patterns (tuple of str): Glob patterns of the files and folders to skip. Default is ().
+
+    Returns:
+        dict: The 'totals' of the run and the plan of each file ('files'), most expensive first.
+    """
+    plan = plan_directory(input_folder, api_keys=API_KEYS, batch_answering=batch_answering, max_questions_per_batch=max_questions_per_batch,
+                          include_patterns=include_patterns, exclude_patterns=exclude_patterns)
+    if verbose: print_plan(plan)
+    if breakdown_path is not None:
+        write_breakdown(plan, breakdown_path)
+        if verbose: print(f"Per-file plan has been saved to {breakdown_path}.")
+    return plan
+
+
+def export_normalized_output(output_folder, max_qa_pairs=300, verbose=True):
+    """
+    Writes the question/answer pairs of the last run, as kept in the manifest, to a normalized output folder (see `output.py`):
+    a table of chunks, storing the text of each chunk once, and a table of question/answer pairs referencing them.
+
+    Args:
+        output_folder (str): The folder where the tables are written.
+        max_qa_pairs (int): The maximum number of questions kept per file. Default is 300.
+        verbose (bool): If True, print the number of pairs written. Default is True.
+
+    Returns:
+        int: The number of question/answer pairs written.
+    """
+    nb_records = write_normalized_output(get_manifest(), output_folder, max_qa_pairs=max_qa_pairs)
+    if verbose: print(f"{nb_records} question/answer pairs have been saved to '{output_folder}'.")
+    return nb_records
+
+
+async def save_manifest(file_paths, verbose=True):
+    """
+    Asynchronously flushes the journal, drops the results of files that no longer exist from the manifest,
+    then saves it to the state folder (emptying the journal).
+
+    Args:
+        file_paths (list of str): The paths of all files processed during the run.
+        verbose (bool): If True, print the number of entries removed. Default is True.
+    """
+    manifest = get_manifest()
+    await manifest.journal.close()
+    nb_deleted_files, nb_deleted_chunks = manifest.prune(file_paths)
+    await asyncio.to_thread(manifest.save)
+    if verbose and (nb_deleted_files + nb_deleted_chunks > 0):
+        print(f"Manifest: dropped {nb_deleted_files} deleted files and {nb_deleted_chunks} outdated chunks.")
+
+
+def report_statistics(verbose=True):
+    """
+    Trims the response cache, reports the savings provided by the cache, by chunk packing and by the deduplication of chunks and questions,
+    saves the token statistics learned during the run (see `calibration.py`)
+    and exports the metrics and trace of the run (see `instrumentation.py`).
+
+    Args:
+        verbose (bool): If True, print the statistics. Default is True.
+    """
+    if verbose and (splitting_stats['nb_unpacked_chunks'] > splitting_stats['nb_chunks']):
+        print(f"Chunk packing: {splitting_stats['nb_unpacked_chunks']} sections merged into {splitting_stats['nb_chunks']} extraction calls.")
+
+    response_cache = get_response_cache()
+    if response_cache is not None:
+        response_cache.evict()
+        if verbose:
+            cache_stats = response_cache.stats()
+            print(f"Response cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['tokens_saved']} tokens saved.")
+
+    # Persist the token statistics learned during the run
+    if get_token_statistics().save() and verbose:
+        print("Token statistics drifted, the next run will split texts using the updated statistics.")
+
+    if verbose and (metrics.get_counter('duplicate_chunks_total') > 0):
+        print(f"Chunk deduplication: {metrics.get_counter('duplicate_chunks_total')} duplicate chunks extracted and answered once "
+              f"({metrics.get_counter('duplicate_chunks_total', kind='near')} of which were near-duplicates).")
+
+    if verbose and (metrics.get_counter('duplicate_questions_total') > 0):
+        print(f"Deduplication ({deduplication.deduplication_scope}): {metrics.get_counter('duplicate_questions_total')} near-duplicate questions dropped, "
+              f"saving about {metrics.get_counter('answering_calls_saved_total')} answering calls.")
+
+    # Time saved by counting the tokens of each text (chunk, question, system prompt) once, rather than once per call it is sent in
+    token_count_cache_stats = get_token_count_cache_stats()
+    metrics.set('token_count_cache_hits', token_count_cache_stats['hits'])
+    metrics.set('token_count_cache_misses', token_count_cache_stats['misses'])
+    metrics.set('tokenization_cpu_seconds', token_count_cache_stats['encoding_seconds'])
+    metrics.set('tokenization_cpu_seconds_saved', token_count_cache_stats['seconds_saved'])
+    if verbose and (token_count_cache_stats['hits'] > 0):
+        print(f"Token counting: {token_count_cache_stats['hit_rate']:.0%} of {token_count_cache_stats['hits'] + token_count_cache_stats['misses']} counts served from the cache, "
+              f"{token_count_cache_stats['encoding_seconds']:.2f}s of CPU spent tokenizing, about {token_count_cache_stats['seconds_saved']:.2f}s saved.")
+
+    if verbose and (len(retrying.dead_letters) > 0):
+        print(f"WARNING: {len(retrying.dead_letters)} calls failed and were listed in '{retrying.dead_letters_path}', "
+              "run the script again to retry them.")
+
+    metrics.export()
+    if verbose:
+        retry_sleep = metrics.get_summary('retry_sleep_seconds')
+        api_calls = metrics.get_summary('api_call_seconds')
+        mean_latency = api_calls['sum'] / api_calls['count'] if api_calls['count'] > 0 else 0.0
+        print(f"Metrics: {api_calls['count']} calls ({mean_latency:.2f}s mean latency), "
+              f"{metrics.get_counter('prompt_tokens_total')} prompt tokens, {metrics.get_counter('completion_tokens_total')} completion tokens, "
+              f"{retry_sleep['count']} retries sleeping {retry_sleep['sum']:.1f}s, time waited on rate limits {metrics.get_summary('rate_limiter_wait_seconds')['sum']:.1f}s.")
+        file_completions = metrics.get_summary('file_completion_seconds')
+        if file_completions['count'] > 0:
+            print(f"Scheduling ({scheduling.scheduling_policy}): first file completed after {metrics.get_gauge('first_file_completion_seconds'):.1f}s, "
+                  f"files completed after {file_completions['sum'] / file_completions['count']:.1f}s on average, makespan {metrics.get_gauge('makespan_seconds'):.1f}s.")
@@ -0,0 +1,475 @@
+import os
+import json
+import asyncio
+from pathlib import Path
+from . import state
+from .state import get_manifest, hash_text
+from .cache import get_response_cache, hash_request
+from .models import get_stage_model
+from .token_counting import count_tokens_text, count_tokens_messages, get_available_tokens, observe_extraction, observe_answer
+from .prompts import create_extraction_conversation_messages, create_answering_conversation_messages, create_batch_answering_conversation_messages
+from .deduplication import get_deduplicator
+from .retrying import record_dead_letter, clear_dead_letters
+from .instrumentation import metrics
+from .markdown import load_markdown_files_from_directory
+from .output import read_jsonl
+
+#----------------------------------------------------------------------------------------
+# CONFIGURATION
+
+# limits of a request file of the batch API (50,000 requests and 200MB for OpenAI), requests are split into several files to stay under them
+max_requests_per_file = 50000
+max_bytes_per_file = 190 * 1024**2
+
+# seconds between two polls of the batches in progress
+poll_interval = 60.0
+
+# time within which the provider commits to process a batch
+completion_window = '24h'
+
+# questions missing from the output of a batch answering request (or whose request failed) are asked again in the next round, one question per request
+max_answering_rounds = 3
+
+# batch statuses after which a batch will not change anymore
+terminal_statuses = {'completed', 'failed', 'expired', 'cancelled'}
+
+#----------------------------------------------------------------------------------------
+# REQUEST FILES
+
+def create_batch_request(custom_id, messages, stage):
+    """
+    Returns a line of a request file of the batch API, calling the chat model of a stage on the given messages.
+    As many tokens as the context allows are requested (the outputs of batches are not rerun when truncated),
+    the output can thus be stored in the response cache under the same key as a synchronous call.
+
+    Args:
+        custom_id (str): The id used to match the result of the request with its input.
+        messages (list of dict): The input messages.
+        stage (str): The pipeline stage of the request, which decides the model called (see `models.stage_models`).
+
+    Returns:
+        dict: The request.
+    """
+    model = get_stage_model(stage)
+    max_tokens = get_available_tokens(count_tokens_messages(messages, model=model), model=model)
+    body = {'model': model, 'messages': messages, 'temperature': 0.0, 'max_tokens': max_tokens}
+    return {'custom_id': custom_id, 'method': 'POST', 'url': '/v1/chat/completions', 'body': body}
+
+
+def get_cache_key(messages, stage):
+    """
+    Returns the key under which the output of a call on the given messages is stored in the response cache (see `run_model`).
+    """
+    model = get_stage_model(stage)
+    return hash_request(model, 0.0, get_available_tokens(count_tokens_messages(messages, model=model), model=model), messages)
+
+
+def write_request_files(requests, folder, prefix):
+    """
+    Writes requests to JSONL request files, starting a new file whenever `max_requests_per_file` or `max_bytes_per_file` would be exceeded.
+    A batch can only call one model, requests for different models are written to different files.
+
+    Args:
+        requests (iterable of dict): The requests (see `create_batch_request`).
+        folder (str): The folder where the files are written.
+        prefix (str): The prefix of the file names.
+
+    Returns:
+        list of Path: The paths of the request files (empty if there was no request).
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    paths = []
+    request_files = {}  # model -> [open file, number of requests, number of bytes]
+    try:
+        for request in requests:
+            line = (json.dumps(request, ensure_ascii=False) + '\n').encode('utf-8')
+            request_file = request_files.get(request['body']['model'])
+            if (request_file is None) or (request_file[1] >= max_requests_per_file) or (request_file[2] + len(line) > max_bytes_per_file):
+                if request_file is not None:
+                    request_file[0].close()
+                paths.append(folder / f"{prefix}-{len(paths):04d}.jsonl")
+                request_file = request_files[request['body']['model']] = [open(paths[-1], 'wb'), 0, 0]
+            request_file[0].write(line)
+            request_file[1] += 1
+            request_file[2] += len(line)
+    finally:
+        for request_file in request_files.values():
+            request_file[0].close()
+    return paths
+
+
+def read_batch_results(batch):
+    """
+    Yields the `(custom_id, output text or None, error or None, usage)` of each request of a batch whose results were downloaded.
+    """
+    for key in ('output_file', 'error_file'):
+        if batch.get(key) is None:
+            continue
+        for row in read_jsonl(batch[key]):
+            response = row.get('response') or {}
+            body = response.get('body') or {}
+            if (response.get('status_code') == 200) and (row.get('error') is None):
+                yield row['custom_id'], body['choices'][0]['message']['content'] or '', None, body.get('usage', {})
+            else:
+                error = row.get('error') or body.get('error') or {}
+                yield row['custom_id'], None, error.get('message', str(error)) if isinstance(error, dict) else str(error), {}
+
+#----------------------------------------------------------------------------------------
+# JOB
+
+class BatchJob:
+    """
+    Persistent state of a batch run: its current phase ('extraction', or 'answering' with the number of the answering round)
+    and the request files of the phase, with the id of the batch processing each of them and its result files once downloaded.
+    It is saved after every step, so that an interrupted run resumes where it stopped rather than submitting its requests again.
+
+    Args:
+        path (str): The file where the state is saved.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.phase = None
+        self.round = 0
+        self.batches = []
+        if self.path.is_file():
+            content = json.loads(self.path.read_text(encoding='utf-8'))
+            self.phase, self.round, self.batches = content['phase'], content['round'], content['batches']
+
+    def save(self):
+        """
+        Writes the state to disk, atomically.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = self.path.with_suffix('.tmp')
+        temporary_path.write_text(json.dumps({'phase': self.phase, 'round': self.round, 'batches': self.batches}, indent=1), encoding='utf-8')
+        os.replace(temporary_path, self.path)
+
+    def set_phase(self, phase, round=1):
+        """
+        Starts a new phase, deleting the files of the previous one.
+        """
+        self.delete_files()
+        self.phase, self.round, self.batches = phase, round, []
+        self.save()
+
+    def delete_files(self):
+        for batch in self.batches:
+            for key in ('request_file', 'output_file', 'error_file'):
+                if batch.get(key) is not None:
+                    Path(batch[key]).unlink(missing_ok=True)
+
+    def clear(self):
+        """
+        Deletes the state, once the run is complete.
+        """
+        self.delete_files()
+        self.phase, self.round, self.batches = None, 0, []
+        self.path.unlink(missing_ok=True)
+
+
+async def process_batches(job, backend, verbose=True):
+    """
+    Asynchronously submits the request files of a phase that were not submitted yet,
+    then polls the batches until they all ended, downloading their result files.
+
+    Args:
+        job (BatchJob): The state of the run.
+        backend (object): The backend (see `client.py`) used to submit and poll batches.
+        verbose (bool): If True, print the progress of the batches. Default is True.
+    """
+    for batch in job.batches:
+        if batch['batch_id'] is None:
+            file_id = await backend.upload_batch_file(batch['request_file'])
+            batch['batch_id'] = (await backend.create_batch(file_id, completion_window=completion_window))['id']
+            job.save()
+            metrics.increment('batches_submitted_total', stage=job.phase)
+            if verbose: print(f"Batch {job.phase}: submitted '{batch['request_file']}' as {batch['batch_id']}.")
+
+    while True:
+        for batch in job.batches:
+            if batch['status'] in terminal_statuses:
+                continue
+            try:
+                batch_info = await backend.get_batch(batch['batch_id'])
+            except Exception as e:
+                print(f"WARNING ({e}): Could not poll batch {batch['batch_id']}, trying again later.")
+                continue
+            if batch_info['status'] not in terminal_statuses:
+                continue
+            # The status is saved once the results are downloaded, an interrupted download is thus done again
+            request_file = Path(batch['request_file'])
+            for key in ('output', 'error'):
+                if batch_info.get(f"{key}_file_id") is not None:
+                    result_file = request_file.with_name(f"{request_file.stem}.{key}.jsonl")
+                    await backend.download_file(batch_info[f"{key}_file_id"], result_file)
+                    batch[f"{key}_file"] = str(result_file)
+            batch['status'] = batch_info['status']
+            job.save()
+            if batch['status'] != 'completed':
+                print(f"WARNING: Batch {batch['batch_id']} ended with status '{batch['status']}', its missing requests will be listed as dead letters.")
+
+        nb_batches_done = sum(batch['status'] in terminal_statuses for batch in job.batches)
+        if nb_batches_done == len(job.batches):
+            return
+        if verbose: print(f"Batch {job.phase}: {nb_batches_done}/{len(job.batches)} batches done, polling again in {poll_interval:.0f}s.")
+        await asyncio.sleep(poll_interval)
+
+
+async def run_phase(job, backend, build_requests, verbose=True):
+    """
+    Asynchronously runs the current phase of a job: writes its request files (unless the phase is being resumed),
+    processes them with the batch API and gathers their results.
+
+    Args:
+        job (BatchJob): The state of the run.
+        backend (object): The backend used to submit and poll batches.
+        build_requests (callable): Returns the requests of the phase (called only if the phase was not started yet).
+        verbose (bool): If True, print progress information. Default is True.
+
+    Returns:
+        dict: Maps the custom id of each request with a result to its `(output text or None, error or None)`.
+    """
+    if len(job.batches) == 0:
+        request_files = write_request_files(build_requests(), Path(state.state_folder) / 'batches', f"{job.phase}-{job.round}")
+        job.batches = [{'request_file': str(path), 'batch_id': None, 'status': None, 'output_file': None, 'error_file': None} for path in request_files]
+        job.save()
+    elif verbose:
+        print(f"Batch {job.phase}: resuming {len(job.batches)} batches.")
+
+    await process_batches(job, backend, verbose=verbose)
+
+    results = {}
+    for batch in job.batches:
+        for custom_id, output, error, usage in read_batch_results(batch):
+            results[custom_id] = (output, error)
+            metrics.increment('batch_requests_total', stage=job.phase, outcome='success' if error is None else 'error')
+            metrics.increment('prompt_tokens_total', usage.get('prompt_tokens', 0), stage=job.phase)
+            metrics.increment('completion_tokens_total', usage.get('completion_tokens', 0), stage=job.phase)
+    return results
+
+
+def get_result(results, custom_id, messages, stage):
+    """
+    Returns the output of a request: its result if it has one (storing it in the response cache), its cached output otherwise.
+    Requests that failed (or are missing from the results) are listed as dead letters and None is returned.
+    """
+    response_cache = get_response_cache()
+    output, error = results.get(custom_id, (None, 'Missing from the results of its batch.'))
+    if output is not None:
+        output = output.strip()
+        if response_cache is not None:
+            model = get_stage_model(stage)
+            response_cache.set(get_cache_key(messages, stage), output,
+                               nb_tokens=count_tokens_messages(messages, model=model) + count_tokens_text(output, model=model, store=False))
+        return output
+    if response_cache is not None:
+        cached_output = response_cache.get(get_cache_key(messages, stage))
+        if cached_output is not None:
+            metrics.increment('cache_hits_total', stage=stage)
+            return cached_output
+    record_dead_letter(stage, messages, RuntimeError(error), 1)
+    return None
+
+#----------------------------------------------------------------------------------------
+# PIPELINE
+
+def get_unanswered_questions(file_chunks, max_qa_pairs):
+    """
+    Returns the questions that still need an answer, as a dictionary mapping the hash of each chunk to the sorted indices of its questions
+    (only the first `max_qa_pairs` questions of each file are answered).
+    """
+    manifest = get_manifest()
+    unanswered_questions = {}
+    for chunks in file_chunks.values():
+        nb_questions = 0
+        for _, chunk_hash in chunks:
+            chunk = manifest.chunks.get(chunk_hash)
+            if chunk is None:
+                continue
+            for question_index, answer in enumerate(chunk['answers'][:max(0, max_qa_pairs - nb_questions)]):
+                if answer is None:
+                    unanswered_questions.setdefault(chunk_hash, set()).add(question_index)
+            nb_questions += len(chunk['answers'])
+    return {chunk_hash: sorted(question_indices) for chunk_hash, question_indices in unanswered_questions.items()}
+
+
+def get_answering_stage(questions):
+    return 'answering' if len(questions) == 1 else 'batch_answering'
+
+
+def create_answering_messages(text, questions):
+    if len(questions) == 1:
+        return create_answering_conversation_messages(questions[0], text)
+    return create_batch_answering_conversation_messages(questions, text)
+
+
+async def run_batch_pipeline(files, max_qa_pairs=300, verbose=True):
+    """
+    Asynchronously extracts and answers the questions of a list of files with the batch API:
+    all extraction requests are submitted, then, once their results are ingested into the manifest, all answering requests.
+    Progress is saved in the state folder, an interrupted run resumes from the phase it was in (without submitting its requests again).
+
+    Args:
+        files (list): A list of tuples containing file paths and their respective text content.
+        max_qa_pairs (int): The maximum number of questions kept per file. Default is 300.
+        verbose (bool): If True, print progress information. Default is True.
+
+    Returns:
+        list: A list of dictionaries containing source, question, and answer information.
+    """
+    import question_extractor
+    backend = question_extractor.backend
+    manifest = get_manifest()
+    response_cache = get_response_cache()
+    job = BatchJob(Path(state.state_folder) / 'batch_job.json')
+
+    # Split the files that changed since their last run, chunks that are copies of another chunk are replaced by it (see `process_file`)
+    file_hashes = {}
+    file_chunks = {}  # file path -> [(chunk path, chunk hash)]
+    chunk_texts = {}  # chunk hash -> text
+    for file_path, text in files:
+        file_hash = hash_text(text)
+        if manifest.is_file_done(file_path, file_hash, max_qa_pairs):
+            continue
+        chunks = []
+        for chunk_path, chunk_text, chunk_hash, fingerprint in await question_extractor.split_and_fingerprint_text_in_thread(file_path, text.strip()):
+            chunk_hash = question_extractor.get_chunk_representative(chunk_hash, fingerprint, chunk_texts)
+            chunk_texts.setdefault(chunk_hash, chunk_text)
+            chunks.append((chunk_path, chunk_hash))
+        file_hashes[file_path] = file_hash
+        file_chunks[file_path] = chunks
+    if verbose: print(f"Batch: {len(file_chunks)} files to process, {len(files) - len(file_chunks)} unchanged files.")
+
+    if job.phase is None:
+        job.set_phase('extraction')
+
+    # Extract the questions of all chunks never seen before
+    if job.phase == 'extraction':
+        new_chunks = [chunk_hash for chunk_hash in chunk_texts if chunk_hash not in manifest.chunks]
+
+        def build_extraction_requests():
+            for chunk_hash in new_chunks:
+                messages = create_extraction_conversation_messages(chunk_texts[chunk_hash])
+                if (response_cache is None) or (response_cache.get(get_cache_key(messages, 'extraction')) is None):
+                    yield create_batch_request(f"extraction:{chunk_hash}", messages, 'extraction')
+
+        results = await run_phase(job, backend, build_extraction_requests, verbose=verbose)
+
+        # Questions are ingested in the order of the files so that near-duplicate questions are dropped as in `process_file`
+        for chunks in file_chunks.values():
+            deduplicator = get_deduplicator()
+            if deduplicator is not None:
+                for _, chunk_hash in chunks:
+                    for question in manifest.chunks.get(chunk_hash, {}).get('questions', []):
+                        deduplicator.add(question)
+            for _, chunk_hash in chunks:
+                if chunk_hash in manifest.chunks:
+                    continue
+                chunk_text = chunk_texts[chunk_hash]
+                output = get_result(results, f"extraction:{chunk_hash}", create_extraction_conversation_messages(chunk_text), 'extraction')
+                if output is None:
+                    continue
+                questions = [question.strip() for question in question_extractor.extract_questions_from_output(output)]
+                kept_questions = [question for question in questions if (deduplicator is None) or not deduplicator.is_duplicate(question)]
+                observe_extraction(count_tokens_text(chunk_text, model=get_stage_model('extraction')), questions)
+                metrics.increment('questions_extracted_total', len(questions))
+                question_extractor.record_duplicates(chunk_text, questions, kept_questions)
+                manifest.set_questions(chunk_hash, kept_questions, text=chunk_text)
+        job.set_phase('answering')
+
+    # Answer the questions, in batches of questions about the same chunk during the first round and one by one afterwards
+    while job.phase == 'answering':
+        unanswered_questions = get_unanswered_questions(file_chunks, max_qa_pairs)
+        if (len(unanswered_questions) == 0) or (job.round > max_answering_rounds):
+            break
+
+        def get_requests():
+            # Yields the chunk hash, question indices, stage and messages of each answering request
+            for chunk_hash, question_indices in unanswered_questions.items():
+                chunk = manifest.chunks[chunk_hash]
+                text = chunk['text'] or chunk_texts[chunk_hash]
+                questions = [chunk['questions'][question_index] for question_index in question_indices]
+                if question_extractor.batch_answering and (job.round == 1):
+                    batches = question_extractor.get_question_batches(text, questions)
+                else:
+                    batches = [range(index, index + 1) for index in range(len(questions))]
+                for batch in batches:
+                    batch_questions = [questions[index] for index in batch]
+                    yield chunk_hash, [question_indices[index] for index in batch], get_answering_stage(batch_questions), create_answering_messages(text, batch_questions)
+
+        def ingest(chunk_hash, question_indices, output):
+            if len(question_indices) == 1:
+                answers = {0: output} if len(output) > 0 else {}
+            else:
+                answers = question_extractor.extract_answers_from_output(output, len(question_indices))
+            for index, answer in answers.items():
+                observe_answer(answer)
+                manifest.set_answer(chunk_hash, question_indices[index], answer)
+            metrics.increment('qa_pairs_total', len(answers), origin='batch')
+
+        def build_answering_requests():
+            # Answers found in the response cache are ingested right away
+            for chunk_hash, question_indices, stage, messages in get_requests():
+                cached_output = None if response_cache is None else response_cache.get(get_cache_key(messages, stage))
+                if cached_output is not None:
+                    metrics.increment('cache_hits_total', stage=stage)
+                    ingest(chunk_hash, question_indices, cached_output)
+                else:
+                    yield create_batch_request(f"answering:{chunk_hash}:{','.join(map(str, question_indices))}", messages, stage)
+
+        results = await run_phase(job, backend, build_answering_requests, verbose=verbose)
+        for custom_id, (output, error) in results.items():
+            _, chunk_hash, question_indices = custom_id.split(':')
+            question_indices = [int(question_index) for question_index in question_indices.split(',')]
+            if output is None:
+                chunk = manifest.chunks[chunk_hash]
+                questions = [chunk['questions'][index] for index in question_indices]
+                record_dead_letter(get_answering_stage(questions), create_answering_messages(chunk['text'] or chunk_texts[chunk_hash], questions), RuntimeError(error), 1)
+                continue
+            ingest(chunk_hash, question_indices, output.strip())
+        job.set_phase('answering', job.round + 1)
+
+    job.clear()
+    for file_path, chunks in file_chunks.items():
+        manifest.set_file(file_path, file_hashes[file_path], chunks)
+
+    # Gather the records of all files, unanswered questions are left out (they are submitted again by the next run)
+    records = []
+    for file_path, _ in files:
+        if file_path in manifest.files:
+            records.extend(manifest.get_records(file_path, max_qa_pairs))
+    return records
+
+
+def batch_questions_from_directory(input_folder, verbose=True, max_qa_pairs=300):
+    """
+    Extracts questions and answers from all markdown files in the input folder with the batch API of the provider
+    (cheaper, with its own quotas, but answered within hours rather than seconds).
+    The function returns once all batches are done, it can be interrupted and run again at any point to resume waiting for them.
+
+    Args:
+        input_folder (str): A path to a folder containing markdown files.
+        verbose (bool): If True, print progress information. Default is True.
+        max_qa_pairs (int): The maximum number of questions kept per file. Default is 300.
+
+    Returns:
+        list: A list of dictionaries containing source, question, and answer information.
+    """
+    import question_extractor
+
+    # Load input files from the folder
+    if verbose: print(f"Loading files from '{input_folder}'.")
+    files = load_markdown_files_from_directory(input_folder)
+
+    # Run both phases, then save the manifest
+    clear_dead_letters()
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(run_batch_pipeline(files, max_qa_pairs=max_qa_pairs, verbose=verbose))
+    loop.run_until_complete(question_extractor.save_manifest([file_path for file_path, _ in files], verbose=verbose))
+    loop.run_until_complete(question_extractor.backend.close())
+
+    if verbose: print(f"Done, {len(results)} question/answer pairs have been generated!")
+    question_extractor.report_statistics(verbose=verbose)
+    return results
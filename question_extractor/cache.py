@@ -0,0 +1,159 @@
+import json
+import time
+import asyncio
+import sqlite3
+import hashlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+#----------------------------------------------------------------------------------------
+# CONFIGURATION
+
+# set to False to always call the model
+cache_enabled = True
+
+# location of the cache, it can be shared by several runs and processes of the same machine
+# (not by several machines through a network drive: the WAL mode of SQLite needs memory shared between processes)
+cache_path = Path('./data/llm_cache.sqlite')
+
+# eviction parameters, None disables the corresponding eviction
+cache_max_size_bytes = 2 * 1024**3
+cache_max_age_seconds = 90 * 24 * 3600
+
+#----------------------------------------------------------------------------------------
+# KEYS
+
+def hash_request(model, temperature, max_tokens, messages):
+    """
+    Computes a key identifying a model call, two calls with the same key produce interchangeable outputs.
+
+    Args:
+        model (str): The name of the model called.
+        temperature (float): The sampling temperature.
+        max_tokens (int): The maximum number of tokens requested.
+        messages (list of dict): The input messages.
+
+    Returns:
+        str: A hexadecimal SHA-256 digest of the request.
+    """
+    request = {'model': model, 'temperature': temperature, 'max_tokens': max_tokens, 'messages': messages}
+    serialized_request = json.dumps(request, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(serialized_request.encode('utf-8')).hexdigest()
+
+#----------------------------------------------------------------------------------------
+# CACHE
+
+class ResponseCache:
+    """
+    Persistent SQLite store mapping request keys to model outputs.
+    The database runs in WAL mode with a busy timeout so that several processes of the same machine can read and write it concurrently.
+    From the event loop, use `get_async` and `set_async`: they run in a thread so that waiting for another process never blocks other calls.
+    """
+
+    def __init__(self, path, max_size_bytes=None, max_age_seconds=None):
+        self.path = Path(path)
+        self.max_size_bytes = max_size_bytes
+        self.max_age_seconds = max_age_seconds
+        self.nb_hits = 0
+        self.nb_misses = 0
+        self.nb_tokens_saved = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # a single thread runs the queries of the event loop, one at a time, on the shared connection
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='response-cache')
+        self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                       key TEXT PRIMARY KEY,
+                                       response TEXT NOT NULL,
+                                       nb_tokens INTEGER NOT NULL,
+                                       size INTEGER NOT NULL,
+                                       created REAL NOT NULL,
+                                       last_access REAL NOT NULL)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+
+    def get(self, key):
+        """
+        Returns the output stored for a key, or None if it is missing or expired.
+        """
+        now = time.time()
+        row = self.connection.execute("SELECT response, nb_tokens, created FROM responses WHERE key = ?", (key,)).fetchone()
+        if (row is None) or ((self.max_age_seconds is not None) and (now - row[2] > self.max_age_seconds)):
+            self.nb_misses += 1
+            return None
+        self.connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        self.nb_hits += 1
+        self.nb_tokens_saved += row[1]
+        return row[0]
+
+    def set(self, key, response, nb_tokens=0):
+        """
+        Stores the output of a call along with the number of tokens it cost.
+        """
+        now = time.time()
+        size = len(key) + len(response.encode('utf-8'))
+        self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                                (key, response, nb_tokens, size, now, now))
+
+    async def get_async(self, key):
+        """
+        Asynchronously returns the output stored for a key (see `get`), without blocking the event loop.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.get, key)
+
+    async def set_async(self, key, response, nb_tokens=0):
+        """
+        Asynchronously stores the output of a call (see `set`), without blocking the event loop.
+        """
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.set, key, response, nb_tokens)
+
+    def evict(self):
+        """
+        Removes expired entries then, if the cache is still too large, the least recently used entries.
+
+        Returns:
+            int: The number of entries removed.
+        """
+        nb_removed = 0
+        with self.connection:
+            if self.max_age_seconds is not None:
+                cursor = self.connection.execute("DELETE FROM responses WHERE created < ?",
+                                                 (time.time() - self.max_age_seconds,))
+                nb_removed += cursor.rowcount
+            if self.max_size_bytes is not None:
+                total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if total_size > self.max_size_bytes:
+                    # walks the entries from the least recently used, until enough space has been freed
+                    excess = total_size - self.max_size_bytes
+                    freed_keys = []
+                    for key, size in self.connection.execute("SELECT key, size FROM responses ORDER BY last_access"):
+                        if excess <= 0:
+                            break
+                        freed_keys.append((key,))
+                        excess -= size
+                    self.connection.executemany("DELETE FROM responses WHERE key = ?", freed_keys)
+                    nb_removed += len(freed_keys)
+        return nb_removed
+
+    def stats(self):
+        """
+        Returns the hit/miss counters of the cache since it was opened.
+        """
+        nb_lookups = self.nb_hits + self.nb_misses
+        hit_rate = self.nb_hits / nb_lookups if nb_lookups > 0 else 0.0
+        return {'hits': self.nb_hits, 'misses': self.nb_misses, 'hit_rate': hit_rate, 'tokens_saved': self.nb_tokens_saved}
+
+
+# cache shared by all calls of the process, opened on first use
+response_cache = None
+
+
+def get_response_cache():
+    """
+    Returns the process-wide response cache, or None if caching is disabled.
+    """
+    global response_cache
+    if cache_enabled and (response_cache is None):
+        response_cache = ResponseCache(cache_path, max_size_bytes=cache_max_size_bytes, max_age_seconds=cache_max_age_seconds)
+    return response_cache
@@ -0,0 +1,154 @@
+import json
+import math
+import os
+from collections import deque
+from pathlib import Path
+
+#----------------------------------------------------------------------------------------
+# CONFIGURATION
+
+# set to False to always use the default statistics (see `token_counting.py`)
+calibration_enabled = True
+
+# location of the statistics learned from previous runs
+calibration_path = Path('./data/token_statistics.json')
+
+# number of most recent observations kept per statistic
+calibration_window_size = 2000
+
+# number of observations needed before a learned statistic replaces its default
+calibration_min_samples = 50
+
+# quantile used as an upper bound on output sizes
+calibration_upper_quantile = 0.95
+
+# relative drift above which the statistics used for splitting are updated between runs
+# (splitting with new statistics changes the chunks, hence their hashes in the manifest)
+calibration_drift_threshold = 0.1
+
+#----------------------------------------------------------------------------------------
+# STATISTICS
+
+class RunningStatistic:
+    """
+    Keeps the most recent observations of a quantity, to compute its mean and quantiles.
+    """
+
+    def __init__(self, samples=(), window_size=None):
+        self.samples = deque(samples, maxlen=window_size or calibration_window_size)
+        self.sorted_samples = None
+
+    def add(self, value):
+        self.samples.append(value)
+        self.sorted_samples = None
+
+    def __len__(self):
+        return len(self.samples)
+
+    def mean(self):
+        return sum(self.samples) / len(self.samples)
+
+    def quantile(self, q):
+        """
+        Returns the `q` quantile of the observations (sorting them at most once between two additions).
+        """
+        if self.sorted_samples is None:
+            self.sorted_samples = sorted(self.samples)
+        index = min(len(self.sorted_samples) - 1, max(0, math.ceil(q * len(self.sorted_samples)) - 1))
+        return self.sorted_samples[index]
+
+
+class TokenStatistics:
+    """
+    Sizes observed in completions, used to predict the size of future completions:
+    'question_size' (tokens per extracted question), 'answer_size' (tokens per answer)
+    and 'question_text_ratio' (tokens of questions extracted per token of text).
+
+    Two sets of estimates are exposed: live estimates, updated after every observation, used to size `max_tokens`,
+    and splitting estimates, loaded at the start of the run, used to decide where texts are split.
+
+    Args:
+        defaults (dict): The mean value of each statistic, used until enough observations have been made.
+        path (Path): The file where observations are persisted between runs, None to keep them in memory.
+    """
+
+    def __init__(self, defaults, path=None):
+        self.defaults = dict(defaults)
+        self.path = None if path is None else Path(path)
+        self.statistics = {name: RunningStatistic() for name in defaults}
+        self.splitting_estimates = None
+
+        if (self.path is not None) and self.path.exists():
+            try:
+                with open(self.path, 'r', encoding='utf-8') as input_file:
+                    data = json.load(input_file)
+                for name, samples in data.get('samples', {}).items():
+                    if name in self.statistics:
+                        self.statistics[name] = RunningStatistic(samples)
+                self.splitting_estimates = data.get('splitting_estimates')
+            except (OSError, ValueError) as e:
+                print(f"WARNING ({e}): Could not load the token statistics from '{self.path}', starting from the defaults.")
+        if self.splitting_estimates is None:
+            self.splitting_estimates = self.compute_estimates()
+
+    def observe(self, name, value):
+        """
+        Records an observation of a statistic.
+        """
+        self.statistics[name].add(value)
+
+    def mean(self, name):
+        """
+        Returns the live mean of a statistic, or its default if there are not enough observations.
+        """
+        statistic = self.statistics[name]
+        if len(statistic) < calibration_min_samples:
+            return self.defaults[name]
+        return statistic.mean()
+
+    def upper_bound(self, name):
+        """
+        Returns the live upper quantile of a statistic, or 1.5 times its default if there are not enough observations.
+        """
+        statistic = self.statistics[name]
+        if len(statistic) < calibration_min_samples:
+            return self.defaults[name] * 1.5
+        return statistic.quantile(calibration_upper_quantile)
+
+    def compute_estimates(self):
+        """
+        Returns the current mean and upper bound of all statistics.
+        """
+        estimates = {}
+        for name in self.statistics:
+            estimates[name] = {'mean': self.mean(name), 'upper_bound': self.upper_bound(name)}
+        return estimates
+
+    def splitting_estimate(self, name, kind='mean'):
+        """
+        Returns the `kind` ('mean' or 'upper_bound') of a statistic used to decide where texts are split,
+        fixed for the duration of the run so that the same text is always split the same way.
+        """
+        return self.splitting_estimates[name][kind]
+
+    def save(self):
+        """
+        Saves the observations to disk, updating the splitting estimates only if they drifted significantly.
+
+        Returns:
+            bool: True if the splitting estimates changed.
+        """
+        estimates = self.compute_estimates()
+        has_drifted = any(abs(estimates[name][kind] - self.splitting_estimates[name][kind]) > calibration_drift_threshold * self.splitting_estimates[name][kind]
+                          for name in estimates for kind in ('mean', 'upper_bound'))
+        if has_drifted:
+            self.splitting_estimates = estimates
+        if self.path is not None:
+            data = {'samples': {name: list(statistic.samples) for name, statistic in self.statistics.items()},
+                    'splitting_estimates': self.splitting_estimates}
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            temporary_path = self.path.with_suffix('.tmp')
+            with open(temporary_path, 'w', encoding='utf-8') as output_file:
+                json.dump(data, output_file)
+            os.replace(temporary_path, self.path)
+        return has_drifted
@@ -0,0 +1,245 @@
+import os
+import json
+import asyncio
+import aiohttp
+
+#----------------------------------------------------------------------------------------
+# ERRORS
+
+class APIError(Exception):
+    """
+    The server answered with an error that retrying will not fix.
+    """
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class RateLimitError(APIError):
+    """
+    The server rejected the call because a rate limit was exceeded (HTTP 429).
+    """
+
+    def __init__(self, message, status=429, retry_after=None):
+        super().__init__(message, status=status)
+        self.retry_after = retry_after
+
+
+class APIConnectionError(APIError):
+    """
+    The server could not be reached, timed out, or failed on its side (HTTP 5xx).
+    """
+
+
+def parse_retry_after(value):
+    """
+    Returns the number of seconds in a `Retry-After` header, or None if it is missing or not a number of seconds.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def create_stream_error(error):
+    """
+    Returns the exception matching an error event received in the middle of a stream:
+    server errors and overloads can be retried, other errors (such as invalid requests) cannot.
+
+    Args:
+        error (dict or str): The error sent by the server, usually a `{message, type, code}` dictionary.
+    """
+    if not isinstance(error, dict):
+        return APIConnectionError(f"Stream interrupted by an error: {error}")
+    message = f"Stream interrupted by an error: {error.get('message') or error}"
+    error_type = str(error.get('type') or '')
+    if error_type in ('rate_limit_exceeded', 'requests', 'tokens'):
+        return RateLimitError(message)
+    if (error_type in ('', 'server_error', 'overloaded', 'overloaded_error', 'api_error', 'timeout')) or str(error.get('code') or '').startswith('5'):
+        return APIConnectionError(message)
+    return APIError(message)
+
+
+async def read_event_stream(response, on_text):
+    """
+    Asynchronously reads a streamed chat completion (server-sent events), calling `on_text` on each piece of text.
+    Error events raise an `APIError` (see `create_stream_error`), so that a stream cut short is never taken for a complete output.
+
+    Returns:
+        dict: The generated 'text', the token 'usage' reported by the server (if any) and the 'finish_reason'.
+    """
+    pieces = []
+    usage = {}
+    finish_reason = None
+    event_type = None
+    async for line in response.content:
+        line = line.decode('utf-8').strip()
+        # A blank line ends an event
+        if len(line) == 0:
+            event_type = None
+            continue
+        if line.startswith('event:'):
+            event_type = line[len('event:'):].strip()
+            continue
+        if not line.startswith('data:'):
+            continue
+        data = line[len('data:'):].strip()
+        if data == '[DONE]':
+            break
+        try:
+            event = json.loads(data)
+        except json.JSONDecodeError:
+            if event_type == 'error':
+                raise create_stream_error(data)
+            raise
+        if (event_type == 'error') or (isinstance(event, dict) and (event.get('error') is not None)):
+            raise create_stream_error(event.get('error', event) if isinstance(event, dict) else event)
+        usage = event.get('usage') or usage
+        for choice in event.get('choices') or []:
+            finish_reason = choice.get('finish_reason') or finish_reason
+            piece = (choice.get('delta') or {}).get('content')
+            if piece:
+                pieces.append(piece)
+                on_text(piece)
+    return {'text': ''.join(pieces), 'usage': usage, 'finish_reason': finish_reason}
+
+#----------------------------------------------------------------------------------------
+# BACKENDS
+
+class OpenAICompatibleBackend:
+    """
+    Calls the chat completion endpoint of an OpenAI-compatible server (OpenAI, Azure, vLLM, llama.cpp, etc.).
+    Keeps one HTTP session, with its own keep-alive connection pool, per API key.
+    API keys are passed explicitly with each request, no global state (such as environment variables) is touched.
+    """
+
+    def __init__(self, base_url, api_keys, timeout=600, max_connections_per_key=1000):
+        self.base_url = base_url.rstrip('/')
+        self.api_keys = list(api_keys) if len(api_keys) > 0 else ['']
+        self.timeout = timeout
+        self.max_connections_per_key = max_connections_per_key
+        self.api_key_index = 0
+        self.sessions = {}
+
+    def next_api_key(self):
+        """
+        Returns the next API key in round-robin order (no lock needed as there is no await).
+        """
+        api_key = self.api_keys[self.api_key_index]
+        self.api_key_index = (self.api_key_index + 1) % len(self.api_keys)
+        return api_key
+
+    def get_session(self, api_key):
+        """
+        Returns the HTTP session associated with an API key, creating it on first use.
+        """
+        session = self.sessions.get(api_key)
+        if (session is None) or session.closed:
+            headers = {'Authorization': f"Bearer {api_key}"} if len(api_key) > 0 else {}
+            connector = aiohttp.TCPConnector(limit=self.max_connections_per_key, keepalive_timeout=60)
+            session = aiohttp.ClientSession(headers=headers, connector=connector,
+                                            timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self.sessions[api_key] = session
+        return session
+
+    async def chat_completion(self, model, messages, temperature, max_tokens, api_key=None, on_text=None):
+        """
+        Asynchronously runs a chat completion.
+
+        Args:
+            model (str): The name of the model to call.
+            messages (list of dict): The input messages, as `{role, content}` dictionaries.
+            temperature (float): The sampling temperature.
+            max_tokens (int): The maximum number of tokens to generate.
+            api_key (str): The API key to use, defaults to the next key in round-robin order.
+            on_text (callable): If not None, the output is streamed and this function is called on each piece of text as it is generated.
+
+        Returns:
+            dict: The generated 'text', the token 'usage' reported by the server and the 'finish_reason' ('length' if the output was truncated).
+        """
+        if api_key is None:
+            api_key = self.next_api_key()
+        request = {'model': model, 'messages': messages, 'temperature': temperature, 'max_tokens': max_tokens}
+        if on_text is not None:
+            request['stream'] = True
+            request['stream_options'] = {'include_usage': True}
+        try:
+            async with self.get_session(api_key).post(f"{self.base_url}/chat/completions", json=request) as response:
+                if response.status == 429:
+                    raise RateLimitError(await response.text(), retry_after=parse_retry_after(response.headers.get('Retry-After')))
+                if response.status >= 500:
+                    raise APIConnectionError(await response.text(), status=response.status)
+                if response.status != 200:
+                    raise APIError(await response.text(), status=response.status)
+                if on_text is not None:
+                    return await read_event_stream(response, on_text)
+                body = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise APIConnectionError(f"{type(e).__name__}: {e}") from e
+        choice = body['choices'][0]
+        return {'text': choice['message']['content'] or '', 'usage': body.get('usage', {}), 'finish_reason': choice.get('finish_reason')}
+
+    async def request_json(self, method, path, api_key=None, **kwargs):
+        """
+        Asynchronously calls an endpoint of the server and returns its JSON answer.
+        Batch calls use the first API key by default, so that a batch can be followed from any run.
+        """
+        api_key = self.api_keys[0] if api_key is None else api_key
+        try:
+            async with self.get_session(api_key).request(method, f"{self.base_url}{path}", **kwargs) as response:
+                if response.status == 429:
+                    raise RateLimitError(await response.text(), retry_after=parse_retry_after(response.headers.get('Retry-After')))
+                if response.status >= 500:
+                    raise APIConnectionError(await response.text(), status=response.status)
+                if response.status != 200:
+                    raise APIError(await response.text(), status=response.status)
+                return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise APIConnectionError(f"{type(e).__name__}: {e}") from e
+
+    async def upload_batch_file(self, path, api_key=None):
+        """
+        Asynchronously uploads a JSONL file of requests for the batch API and returns its file id.
+        """
+        with open(path, 'rb') as input_file:
+            form = aiohttp.FormData()
+            form.add_field('purpose', 'batch')
+            form.add_field('file', input_file, filename=os.path.basename(path))
+            body = await self.request_json('POST', '/files', api_key=api_key, data=form)
+        return body['id']
+
+    async def create_batch(self, input_file_id, endpoint='/v1/chat/completions', completion_window='24h', api_key=None):
+        """
+        Asynchronously starts processing an uploaded file of requests and returns the batch (a dict with its 'id' and 'status').
+        """
+        request = {'input_file_id': input_file_id, 'endpoint': endpoint, 'completion_window': completion_window}
+        return await self.request_json('POST', '/batches', api_key=api_key, json=request)
+
+    async def get_batch(self, batch_id, api_key=None):
+        """
+        Asynchronously returns the batch with the given id: its 'status' and, once it ended, its 'output_file_id' and 'error_file_id'.
+        """
+        return await self.request_json('GET', f"/batches/{batch_id}", api_key=api_key)
+
+    async def download_file(self, file_id, path, api_key=None):
+        """
+        Asynchronously downloads a file (such as the results of a batch) to the given path.
+        """
+        api_key = self.api_keys[0] if api_key is None else api_key
+        try:
+            async with self.get_session(api_key).get(f"{self.base_url}/files/{file_id}/content") as response:
+                if response.status != 200:
+                    raise APIError(await response.text(), status=response.status)
+                with open(path, 'wb') as output_file:
+                    async for data in response.content.iter_chunked(1024**2):
+                        output_file.write(data)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise APIConnectionError(f"{type(e).__name__}: {e}") from e
+
+    async def close(self):
+        """
+        Asynchronously closes all HTTP sessions.
+        """
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions = {}
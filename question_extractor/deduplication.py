@@ -0,0 +1,238 @@
+import re
+import struct
+import hashlib
+import unicodedata
+from collections import OrderedDict
+
+#----------------------------------------------------------------------------------------
+# CONFIGURATION
+
+# questions that are near-duplicates of a question seen before are dropped before being answered:
+# 'file' compares the questions of a file with each other, 'corpus' compares them with all questions of the run
+# (of the shard, when running sharded), None disables deduplication
+deduplication_scope = 'file'
+
+# Jaccard similarity, between the sets of word pairs of two questions, above which they are duplicates
+similarity_threshold = 0.8
+
+# number of consecutive words in a shingle
+shingle_size = 2
+
+# number of hash functions in a signature, split into bands of rows for locality-sensitive hashing
+# (two texts are compared if all rows of one of their bands match, 16 bands of 4 rows find 99.9% of the pairs at 0.8 similarity)
+num_permutations = 64
+num_bands = 16
+
+# maximum number of questions kept in a corpus index (about 2KB each), the oldest questions are forgotten first
+max_indexed_questions = 100000
+
+# chunks that are exact or near copies of a chunk seen during the run (shared footers, versioned copies of a page)
+# are extracted and answered once, their questions and answers being attributed to every path containing them
+chunk_deduplication = True
+
+# Jaccard similarity, between the sets of 5-word shingles of two chunks, above which they are duplicates
+chunk_similarity_threshold = 0.85
+chunk_shingle_size = 5
+
+# maximum number of chunks kept in the chunk index (about 2KB, plus 4 bytes per word, each), the oldest chunks are forgotten first
+max_indexed_chunks = 50000
+
+#----------------------------------------------------------------------------------------
+# FINGERPRINTS
+
+# each hash function is a 32-bit slice of a SHAKE-128 digest of the shingle (independent hash functions, computed in a single call)
+signature_format = f"<{num_permutations}I"
+
+
+def get_shingles(text, size):
+    """
+    Normalizes a text (case, accents, punctuation, spacing) and returns its set of shingles of `size` words.
+    """
+    text = unicodedata.normalize('NFKD', text.lower())
+    words = re.sub(r"[^\w\s]", ' ', ''.join(c for c in text if not unicodedata.combining(c))).split()
+    if len(words) <= size:
+        return {' '.join(words)} if len(words) > 0 else set()
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def compute_fingerprint(text, size=None):
+    """
+    Computes the fingerprint of a text: its MinHash signature, used to find candidate duplicates,
+    and the hashes of its shingles, used to compute the exact similarity of the candidates (both packed as bytes, 4 per hash).
+
+    Args:
+        text (str): The text (a question or a chunk).
+        size (int): The number of words per shingle, defaults to `shingle_size`.
+
+    Returns:
+        tuple: The signature and the sorted shingle hashes, or None if the text contains no word.
+    """
+    shingles = get_shingles(text, size or shingle_size)
+    if len(shingles) == 0:
+        return None
+    hashes = [struct.unpack(signature_format, hashlib.shake_128(shingle.encode('utf-8')).digest(4 * num_permutations)) for shingle in shingles]
+    signature = struct.pack(signature_format, *map(min, zip(*hashes)))
+    shingle_hashes = sorted({shingle_hash[0] for shingle_hash in hashes})
+    return signature, struct.pack(f"<{len(shingle_hashes)}I", *shingle_hashes)
+
+
+def compute_similarity(shingle_hashes1, shingle_hashes2):
+    """
+    Returns the Jaccard similarity of two sets of shingle hashes (packed as bytes).
+    """
+    set1 = set(struct.unpack(f"<{len(shingle_hashes1) // 4}I", shingle_hashes1))
+    set2 = set(struct.unpack(f"<{len(shingle_hashes2) // 4}I", shingle_hashes2))
+    return len(set1 & set2) / len(set1 | set2)
+
+#----------------------------------------------------------------------------------------
+# INDEX
+
+class NearDuplicateIndex:
+    """
+    Locality-sensitive hashing index of fingerprints, finding near-duplicates without comparing all pairs of texts.
+
+    Each band of a signature is a key in a table mapping to the smallest key of the texts seen with it, candidates sharing a band
+    are then confirmed by computing their similarity. Memory is bounded by forgetting the oldest texts.
+
+    Args:
+        threshold (float): The Jaccard similarity above which two texts are duplicates.
+        max_size (int): The maximum number of texts indexed.
+    """
+
+    def __init__(self, threshold, max_size):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.band_size = 4 * (num_permutations // num_bands)
+        self.fingerprints = OrderedDict()  # key -> fingerprint, oldest first
+        self.bands = [dict() for _ in range(num_bands)]  # band hash -> key
+
+    def get_band_keys(self, signature):
+        return [hash(signature[band * self.band_size:(band + 1) * self.band_size]) for band in range(num_bands)]
+
+    def find(self, fingerprint):
+        """
+        Returns the key of an indexed text that is a near-duplicate of the given fingerprint, None if there is none
+        (the smallest key if there are several, so that the result does not depend on the order of the candidates).
+        """
+        signature, shingle_hashes = fingerprint
+        candidates = {self.bands[band].get(band_key) for band, band_key in enumerate(self.get_band_keys(signature))}
+        candidates.discard(None)
+        for candidate in sorted(candidates):
+            if compute_similarity(shingle_hashes, self.fingerprints[candidate][1]) >= self.threshold:
+                return candidate
+        return None
+
+    def insert(self, key, fingerprint):
+        """
+        Indexes a fingerprint under a key, forgetting the oldest text if the index is full.
+        """
+        self.fingerprints[key] = fingerprint
+        # a band keeps the smallest of its keys, so that `find` does not depend on the order in which texts were indexed
+        for band, band_key in enumerate(self.get_band_keys(fingerprint[0])):
+            band_owner = self.bands[band].get(band_key)
+            if (band_owner is None) or (key < band_owner):
+                self.bands[band][band_key] = key
+
+        if len(self.fingerprints) > self.max_size:
+            oldest_key, (oldest_signature, _) = self.fingerprints.popitem(last=False)
+            for band, band_key in enumerate(self.get_band_keys(oldest_signature)):
+                if self.bands[band].get(band_key) == oldest_key:
+                    del self.bands[band][band_key]
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+
+class QuestionDeduplicator(NearDuplicateIndex):
+    """
+    Index of the questions seen, to drop the questions that are near-duplicates of a previous question.
+
+    Args:
+        max_size (int): The maximum number of questions indexed, defaults to `max_indexed_questions`.
+    """
+
+    def __init__(self, max_size=None):
+        super().__init__(similarity_threshold, max_size or max_indexed_questions)
+        self.next_id = 0
+
+    def add(self, question):
+        """
+        Indexes a question (such as a question answered during a previous run) without checking it.
+        """
+        fingerprint = compute_fingerprint(question)
+        if fingerprint is not None:
+            self.insert(self.next_id, fingerprint)
+            self.next_id += 1
+
+    def is_duplicate(self, question):
+        """
+        Returns True if a question is a near-duplicate of a question seen before, indexes it otherwise.
+        """
+        fingerprint = compute_fingerprint(question)
+        if fingerprint is None:
+            return False
+        if self.find(fingerprint) is not None:
+            return True
+        self.insert(self.next_id, fingerprint)
+        self.next_id += 1
+        return False
+
+
+# index shared by all files of the process with the 'corpus' scope, created on first use
+corpus_deduplicator = None
+
+
+def get_deduplicator():
+    """
+    Returns the index the questions of a file are checked against: a new index with the 'file' scope,
+    the index shared by all files with the 'corpus' scope, None if deduplication is disabled.
+    """
+    global corpus_deduplicator
+    if deduplication_scope == 'file':
+        return QuestionDeduplicator()
+    if deduplication_scope == 'corpus':
+        if corpus_deduplicator is None:
+            corpus_deduplicator = QuestionDeduplicator()
+        return corpus_deduplicator
+    return None
+
+#----------------------------------------------------------------------------------------
+# CHUNKS
+
+# index of the chunks of the files processed during the run, mapping to their hash
+chunk_index = None
+
+
+def compute_chunk_fingerprint(text):
+    """
+    Computes the fingerprint used to find near-duplicate chunks, None if chunk deduplication is disabled.
+    """
+    if not chunk_deduplication:
+        return None
+    return compute_fingerprint(text, chunk_shingle_size)
+
+
+def find_representative_chunk(chunk_hash, fingerprint):
+    """
+    Returns the hash of the chunk that will be extracted and answered in place of a chunk:
+    the hash of a near-duplicate chunk seen before during the run, or the hash of the chunk itself (which is then indexed).
+
+    Args:
+        chunk_hash (str): The content hash of the chunk.
+        fingerprint (tuple): The fingerprint of the chunk (see `compute_chunk_fingerprint`), None to skip near-duplicate detection.
+
+    Returns:
+        str: The hash of the representative chunk.
+    """
+    global chunk_index
+    if fingerprint is None:
+        return chunk_hash
+    if chunk_index is None:
+        chunk_index = NearDuplicateIndex(chunk_similarity_threshold, max_indexed_chunks)
+    if chunk_hash in chunk_index.fingerprints:
+        return chunk_hash
+    representative_hash = chunk_index.find(fingerprint)
+    if representative_hash is not None:
+        return representative_hash
+    chunk_index.insert(chunk_hash, fingerprint)
+    return chunk_hash
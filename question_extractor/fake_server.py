@@ -0,0 +1,366 @@
+"""
+Deterministic stand-in for an OpenAI-compatible chat completion API, used to test and benchmark the pipeline without spending money.
+It can be used in-process (`FakeBackend`, a drop-in replacement for `client.OpenAICompatibleBackend`)
+or as a local HTTP server (`python3 -m question_extractor.fake_server --port 8000`).
+"""
+import json
+import time
+import math
+import random
+import shutil
+import asyncio
+import hashlib
+import argparse
+import tempfile
+from pathlib import Path
+from aiohttp import web
+from .client import APIError, APIConnectionError, RateLimitError
+from .rate_limiting import TokenBucket
+from .models import models
+from .token_counting import TokenCountCache, get_encoding, count_tokens_messages
+from .prompts import extraction_system_prompt, batch_answering_system_prompt
+
+#----------------------------------------------------------------------------------------
+# FAKE MODEL
+
+class FakeModel:
+    """
+    Produces deterministic canned completions (the same messages always produce the same output),
+    with random latencies, failures and real rate limits.
+    Calls to a model of the registry (see `models.py`) that do not fit in its context window are rejected with a 400.
+
+    Args:
+        latency_mean (float): Mean latency of a call, in seconds.
+        latency_sigma (float): Standard deviation of the logarithm of the latency (log-normal distribution), 0 for a constant latency.
+        seconds_per_output_token (float): Latency added per generated token.
+        requests_per_minute (float): Requests per minute above which calls are rejected with a 429, None for no limit.
+        tokens_per_minute (float): Tokens per minute above which calls are rejected with a 429, None for no limit.
+        failure_rate (float): Probability that a call fails with a 500 error.
+        max_concurrent_requests (int): Number of calls in progress above which calls are rejected with a 429 (an overloaded server), None for no limit.
+        questions_per_100_tokens (float): Number of questions generated per 100 tokens of extracted text.
+        answer_words (int): Number of words in each generated answer.
+        seed (int): Seed of the random number generator used for latencies and failures.
+    """
+
+    def __init__(self, latency_mean=0.5, latency_sigma=0.5, seconds_per_output_token=0.0,
+                 requests_per_minute=None, tokens_per_minute=None, failure_rate=0.0, max_concurrent_requests=None,
+                 questions_per_100_tokens=1.0, answer_words=60, seed=0):
+        self.latency_mean = latency_mean
+        self.latency_sigma = latency_sigma
+        self.seconds_per_output_token = seconds_per_output_token
+        self.requests_bucket = None if requests_per_minute is None else TokenBucket(requests_per_minute)
+        self.tokens_bucket = None if tokens_per_minute is None else TokenBucket(tokens_per_minute)
+        self.failure_rate = failure_rate
+        self.max_concurrent_requests = max_concurrent_requests
+        self.nb_requests_in_progress = 0
+        self.questions_per_100_tokens = questions_per_100_tokens
+        self.answer_words = answer_words
+        self.random = random.Random(seed)
+        # the fake server counts tokens on its own, without touching the statistics of the client's cache
+        self.token_count_cache = TokenCountCache(get_encoding())
+        self.stats = {'nb_requests': 0, 'nb_completions': 0, 'nb_rate_limited': 0, 'nb_failures': 0,
+                      'prompt_tokens': 0, 'completion_tokens': 0, 'max_requests_in_progress': 0, 'nb_requests_per_model': {}}
+
+    def sample_latency(self):
+        """
+        Draws a latency from a log-normal distribution with mean `latency_mean`.
+        """
+        if self.latency_sigma <= 0:
+            return self.latency_mean
+        mu = self.random.gauss(0, self.latency_sigma) - self.latency_sigma**2 / 2
+        return self.latency_mean * math.exp(mu)
+
+    def generate_text(self, messages, max_tokens):
+        """
+        Returns a canned output adapted to the prompt (a numbered list of questions, a JSON array of answers, or an answer)
+        and whether it was truncated to fit in `max_tokens`.
+        """
+        digest = hashlib.sha256(json.dumps(messages, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+        system_prompt = messages[0]['content']
+        if system_prompt == extraction_system_prompt:
+            text_token_count = self.token_count_cache.count(messages[-1]['content'])
+            nb_questions = max(1, int(text_token_count * self.questions_per_100_tokens / 100))
+            output = '\n'.join(f"{index}. What is point {index} of section {digest}?" for index in range(1, nb_questions + 1))
+        elif system_prompt == batch_answering_system_prompt:
+            nb_questions = messages[-1]['content'].count('\n') + 1
+            output = json.dumps([{'id': index, 'answer': self.generate_answer(f"{digest}-{index}")} for index in range(1, nb_questions + 1)])
+        else:
+            output = self.generate_answer(digest)
+
+        # Truncate the output if it is longer than allowed
+        words = output.split(' ')
+        is_truncated = False
+        while (len(words) > 1) and (self.token_count_cache.count(' '.join(words), store=False) > max_tokens):
+            words = words[:len(words) // 2]
+            is_truncated = True
+        return ' '.join(words), is_truncated
+
+    def generate_answer(self, seed_text):
+        """
+        Returns a deterministic answer of `answer_words` words.
+        """
+        return ' '.join(["Answer", seed_text] + ["lorem"] * max(0, self.answer_words - 2)) + '.'
+
+    def check_rate_limits(self, prompt_tokens, max_tokens):
+        """
+        Returns the number of seconds to wait if the call exceeds a rate limit (consuming its budget otherwise), None if it is admitted.
+        """
+        waiting_times = []
+        if self.requests_bucket is not None:
+            waiting_times.append(self.requests_bucket.time_until_available(1))
+        if self.tokens_bucket is not None:
+            waiting_times.append(self.tokens_bucket.time_until_available(prompt_tokens + max_tokens))
+        if max(waiting_times, default=0.0) > 0:
+            return max(waiting_times)
+        if self.requests_bucket is not None:
+            self.requests_bucket.consume(1)
+        if self.tokens_bucket is not None:
+            self.tokens_bucket.consume(prompt_tokens + max_tokens)
+        return None
+
+    async def complete(self, messages, max_tokens, on_text=None, model=None):
+        """
+        Asynchronously runs a fake completion.
+
+        Args:
+            messages (list of dict): The input messages.
+            max_tokens (int): The maximum number of tokens to generate.
+            on_text (async callable): If not None, the output is streamed line by line to this function,
+                the latency being spread between the first line and the following ones.
+            model (str): The model called, its context window is checked if it is in the registry.
+
+        Returns:
+            tuple: An HTTP status, the body of the response (an OpenAI-like completion or an error) and the headers to add.
+        """
+        self.stats['nb_requests'] += 1
+        self.stats['nb_requests_per_model'][model] = self.stats['nb_requests_per_model'].get(model, 0) + 1
+        model = model if model in models else None
+        prompt_tokens = count_tokens_messages(messages, model=model, token_count_cache=self.token_count_cache)
+
+        if (model is not None) and (prompt_tokens + max_tokens > models[model]['context_window']):
+            return 400, {'error': {'message': f"This model's maximum context length is {models[model]['context_window']} tokens, "
+                                              f"the call requested {prompt_tokens + max_tokens} tokens.", 'type': 'context_length_exceeded'}}, {}
+
+        if (self.max_concurrent_requests is not None) and (self.nb_requests_in_progress >= self.max_concurrent_requests):
+            self.stats['nb_rate_limited'] += 1
+            return 429, {'error': {'message': 'The server is overloaded.', 'type': 'overloaded'}}, {'Retry-After': f"{self.latency_mean:.3f}"}
+
+        retry_after = self.check_rate_limits(prompt_tokens, max_tokens)
+        if retry_after is not None:
+            self.stats['nb_rate_limited'] += 1
+            return 429, {'error': {'message': 'Rate limit reached.', 'type': 'requests'}}, {'Retry-After': f"{retry_after:.3f}"}
+
+        self.nb_requests_in_progress += 1
+        self.stats['max_requests_in_progress'] = max(self.stats['max_requests_in_progress'], self.nb_requests_in_progress)
+        try:
+            return await self.generate_completion(messages, prompt_tokens, max_tokens, on_text)
+        finally:
+            self.nb_requests_in_progress -= 1
+
+    async def generate_completion(self, messages, prompt_tokens, max_tokens, on_text=None):
+        """
+        Asynchronously runs a fake completion that was admitted by the rate limits (see `complete`).
+        """
+
+        text, is_truncated = self.generate_text(messages, max_tokens)
+        completion_tokens = self.token_count_cache.count(text, store=False)
+        latency = self.sample_latency()
+        is_failure = self.random.random() < self.failure_rate
+
+        if is_failure:
+            if on_text is None:
+                await asyncio.sleep(latency + completion_tokens * self.seconds_per_output_token)
+            self.stats['nb_failures'] += 1
+            return 500, {'error': {'message': 'The server had an error while processing your request.', 'type': 'server_error'}}, {}
+
+        if on_text is None:
+            await asyncio.sleep(latency + completion_tokens * self.seconds_per_output_token)
+        else:
+            # The total latency of the call is spread evenly between the lines
+            lines = text.split('\n')
+            for index, line in enumerate(lines):
+                piece = line if index == len(lines) - 1 else line + '\n'
+                await asyncio.sleep((latency + self.token_count_cache.count(piece, store=False) * self.seconds_per_output_token) / len(lines))
+                await on_text(piece)
+
+        # Give back the unused part of the token reservation
+        if self.tokens_bucket is not None:
+            self.tokens_bucket.refund(max_tokens - completion_tokens)
+        self.stats['nb_completions'] += 1
+        self.stats['prompt_tokens'] += prompt_tokens
+        self.stats['completion_tokens'] += completion_tokens
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}
+        finish_reason = 'length' if is_truncated else 'stop'
+        return 200, {'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': finish_reason}], 'usage': usage}, {}
+
+    def run_batch(self, input_path, output_path, error_path):
+        """
+        Processes a JSONL file of batch requests (ignoring latencies and rate limits, which do not apply to batches),
+        writing a result line per successful request to `output_path` and per failed request to `error_path`, in the format of the OpenAI batch API.
+
+        Returns:
+            dict: The number of 'total', 'completed' and 'failed' requests.
+        """
+        request_counts = {'total': 0, 'completed': 0, 'failed': 0}
+        with open(input_path, 'r', encoding='utf-8') as input_file, open(output_path, 'w', encoding='utf-8') as output_file, \
+             open(error_path, 'w', encoding='utf-8') as error_file:
+            for line in input_file:
+                if len(line.strip()) == 0:
+                    continue
+                request = json.loads(line)
+                messages, max_tokens = request['body']['messages'], request['body']['max_tokens']
+                request_counts['total'] += 1
+                if self.random.random() < self.failure_rate:
+                    request_counts['failed'] += 1
+                    self.stats['nb_failures'] += 1
+                    response = {'status_code': 500, 'body': {'error': {'message': 'The server had an error while processing your request.', 'type': 'server_error'}}}
+                    error_file.write(json.dumps({'custom_id': request['custom_id'], 'response': response, 'error': None}) + '\n')
+                    continue
+                text, is_truncated = self.generate_text(messages, max_tokens)
+                prompt_tokens, completion_tokens = count_tokens_messages(messages, token_count_cache=self.token_count_cache), self.token_count_cache.count(text, store=False)
+                request_counts['completed'] += 1
+                self.stats['nb_completions'] += 1
+                self.stats['prompt_tokens'] += prompt_tokens
+                self.stats['completion_tokens'] += completion_tokens
+                body = {'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'length' if is_truncated else 'stop'}],
+                        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}}
+                output_file.write(json.dumps({'custom_id': request['custom_id'], 'response': {'status_code': 200, 'body': body}, 'error': None}) + '\n')
+        return request_counts
+
+#----------------------------------------------------------------------------------------
+# IN-PROCESS BACKEND
+
+class FakeBackend:
+    """
+    In-process drop-in replacement for `client.OpenAICompatibleBackend` answering with a `FakeModel`.
+    Uploaded files and batches are kept in `batch_folder` (a temporary folder by default), a batch being processed
+    the first time it is polled `batch_latency` seconds after its creation; several backends sharing a folder see the same batches.
+    """
+
+    def __init__(self, fake_model, api_keys=('fake-key',), batch_folder=None, batch_latency=0.0):
+        self.fake_model = fake_model
+        self.api_keys = list(api_keys)
+        self.api_key_index = 0
+        self.batch_folder = Path(batch_folder or tempfile.mkdtemp(prefix='fake-batches-'))
+        self.batch_folder.mkdir(parents=True, exist_ok=True)
+        self.batch_latency = batch_latency
+
+    def next_api_key(self):
+        api_key = self.api_keys[self.api_key_index]
+        self.api_key_index = (self.api_key_index + 1) % len(self.api_keys)
+        return api_key
+
+    async def chat_completion(self, model, messages, temperature, max_tokens, api_key=None, on_text=None):
+        async def emit(piece):
+            on_text(piece)
+
+        status, body, headers = await self.fake_model.complete(messages, max_tokens, on_text=None if on_text is None else emit, model=model)
+        if status == 429:
+            raise RateLimitError(body['error']['message'], retry_after=float(headers['Retry-After']))
+        if status == 400:
+            raise APIError(body['error']['message'], status=status)
+        if status != 200:
+            raise APIConnectionError(body['error']['message'], status=status)
+        choice = body['choices'][0]
+        return {'text': choice['message']['content'], 'usage': body['usage'], 'finish_reason': choice['finish_reason']}
+
+    def new_id(self, prefix):
+        return f"{prefix}-{hashlib.sha256(f'{time.time()}-{random.random()}'.encode('utf-8')).hexdigest()[:16]}"
+
+    async def upload_batch_file(self, path, api_key=None):
+        file_id = self.new_id('file')
+        shutil.copyfile(path, self.batch_folder / f"{file_id}.jsonl")
+        return file_id
+
+    async def create_batch(self, input_file_id, endpoint='/v1/chat/completions', completion_window='24h', api_key=None):
+        batch = {'id': self.new_id('batch'), 'input_file_id': input_file_id, 'status': 'in_progress', 'created_at': time.time(),
+                 'output_file_id': None, 'error_file_id': None, 'request_counts': None}
+        (self.batch_folder / f"{batch['id']}.json").write_text(json.dumps(batch))
+        return batch
+
+    async def get_batch(self, batch_id, api_key=None):
+        batch_path = self.batch_folder / f"{batch_id}.json"
+        batch = json.loads(batch_path.read_text())
+        if (batch['status'] == 'in_progress') and (time.time() >= batch['created_at'] + self.batch_latency):
+            batch['output_file_id'], batch['error_file_id'] = self.new_id('file'), self.new_id('file')
+            batch['request_counts'] = self.fake_model.run_batch(self.batch_folder / f"{batch['input_file_id']}.jsonl",
+                                                                self.batch_folder / f"{batch['output_file_id']}.jsonl",
+                                                                self.batch_folder / f"{batch['error_file_id']}.jsonl")
+            batch['status'] = 'completed'
+            batch_path.write_text(json.dumps(batch))
+        return batch
+
+    async def download_file(self, file_id, path, api_key=None):
+        shutil.copyfile(self.batch_folder / f"{file_id}.jsonl", path)
+
+    async def close(self):
+        pass
+
+#----------------------------------------------------------------------------------------
+# HTTP SERVER
+
+def create_app(fake_model):
+    """
+    Returns an aiohttp application serving `/v1/chat/completions` with a `FakeModel`.
+    """
+    async def handle_chat_completion(request):
+        body = await request.json()
+        max_tokens = body.get('max_tokens') or 256
+        if not body.get('stream'):
+            status, response, headers = await fake_model.complete(body['messages'], max_tokens, model=body.get('model'))
+            return web.json_response(response, status=status, headers=headers)
+
+        # Streams the output as server-sent events, errors are sent before the stream starts
+        stream = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+
+        async def send_event(event):
+            await stream.write(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+
+        async def send_piece(piece):
+            if not stream.prepared:
+                await stream.prepare(request)
+            await send_event({'choices': [{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}]})
+
+        status, response, headers = await fake_model.complete(body['messages'], max_tokens, on_text=send_piece, model=body.get('model'))
+        if status != 200:
+            return web.json_response(response, status=status, headers=headers)
+        if not stream.prepared:
+            await stream.prepare(request)
+        await send_event({'choices': [{'index': 0, 'delta': {}, 'finish_reason': response['choices'][0]['finish_reason']}]})
+        if (body.get('stream_options') or {}).get('include_usage'):
+            await send_event({'choices': [], 'usage': response['usage']})
+        await stream.write(b"data: [DONE]\n\n")
+        await stream.write_eof()
+        return stream
+
+    async def handle_stats(request):
+        return web.json_response(fake_model.stats)
+
+    app = web.Application()
+    app.router.add_post('/v1/chat/completions', handle_chat_completion)
+    app.router.add_get('/stats', handle_stats)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a fake OpenAI-compatible chat completion server.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency-mean', type=float, default=0.5)
+    parser.add_argument('--latency-sigma', type=float, default=0.5)
+    parser.add_argument('--rpm', type=float, default=None, help="requests per minute limit")
+    parser.add_argument('--tpm', type=float, default=None, help="tokens per minute limit")
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--max-concurrent-requests', type=int, default=None, help="number of calls in progress above which the server answers with a 429")
+    parser.add_argument('--seed', type=int, default=0)
+    arguments = parser.parse_args()
+
+    fake_model = FakeModel(latency_mean=arguments.latency_mean, latency_sigma=arguments.latency_sigma,
+                           requests_per_minute=arguments.rpm, tokens_per_minute=arguments.tpm,
+                           failure_rate=arguments.failure_rate, max_concurrent_requests=arguments.max_concurrent_requests, seed=arguments.seed)
+    print(f"Serving a fake model on http://{arguments.host}:{arguments.port}/v1")
+    web.run_app(create_app(fake_model), host=arguments.host, port=arguments.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
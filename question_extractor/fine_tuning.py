@@ -0,0 +1,305 @@
+import os
+import re
+import json
+import heapq
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from .token_counting import count_tokens_text
+from .models import get_model
+from .output import read_normalized_output
+
+#----------------------------------------------------------------------------------------
+# CONFIGURATION
+
+# formats that can be written, each provider expecting its own layout of the question/answer pairs
+fine_tune_types = ['openai', 'azure_openai', 'palm2', 'anyscale']
+
+# an output file is split into numbered shards once it reaches either limit, None disables the limit (a single, unnumbered, file is written if both are None)
+max_shard_bytes = 512 * 1024**2
+max_shard_records = None
+
+# examples with more tokens than this are left out of the outputs (and reported), None keeps all examples
+# (set it to the maximum length of a training example accepted by the provider, see `fine_tune_prep.py`)
+max_example_tokens = None
+
+# number of records converted by a process at once, and number of processes (None to use all cores, 1 to convert in the current process)
+records_per_task = 2000
+conversion_max_workers = None
+
+# number of characters read at once from a JSON array
+read_size = 16 * 1024**2
+
+#----------------------------------------------------------------------------------------
+# READING
+
+def read_json_array(input_file):
+    """
+    Yields the elements of a JSON array one at a time, reading the file `read_size` characters at a time
+    so that arrays larger than memory can be processed.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    is_eof = False
+    is_in_array = False
+    while True:
+        # Skips the separators, reading more of the file when the buffer is exhausted
+        while (position < len(buffer)) and (buffer[position] in ' \t\r\n,' or ((buffer[position] == '[') and not is_in_array)):
+            is_in_array = is_in_array or (buffer[position] == '[')
+            position += 1
+        if position >= len(buffer):
+            if is_eof:
+                return
+            buffer, position = input_file.read(read_size), 0
+            is_eof = (len(buffer) == 0)
+            continue
+        if buffer[position] == ']':
+            return
+        try:
+            element, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # The element continues past the end of the buffer
+            if is_eof:
+                raise
+            more = input_file.read(read_size)
+            is_eof = (len(more) == 0)
+            buffer, position = buffer[position:] + more, 0
+            continue
+        yield element
+        # Drops the part of the buffer already processed
+        if position >= read_size:
+            buffer, position = buffer[position:], 0
+
+
+def read_records(input_path):
+    """
+    Yields the `{source, question, answer}` records of a JSON array, a JSONL file or a normalized output folder (see `output.py`).
+    Lines of JSONL files are yielded without being parsed (as strings), so that parsing happens in the worker processes.
+    """
+    input_path = Path(input_path)
+    if input_path.is_dir():
+        yield from read_normalized_output(input_path)
+        return
+    with open(input_path, 'r', encoding='utf-8') as input_file:
+        # Looks at the first non-whitespace character to tell a JSON array from a JSONL file
+        first_character = input_file.read(1)
+        while first_character.isspace():
+            first_character = input_file.read(1)
+        input_file.seek(0)
+        if first_character == '[':
+            yield from read_json_array(input_file)
+        else:
+            yield from (line for line in input_file if len(line.strip()) > 0)
+
+
+def read_record_batches(input_path, batch_size=None):
+    """
+    Yields the records of `read_records` in lists of `batch_size` records (defaults to `records_per_task`).
+    """
+    batch = []
+    for record in read_records(input_path):
+        batch.append(record)
+        if len(batch) >= (batch_size or records_per_task):
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+#----------------------------------------------------------------------------------------
+# CONVERSION
+
+def create_example(fine_tune_type, system_prompt, question, answer):
+    """
+    Returns a question/answer pair in the format expected by a fine-tuning provider.
+    """
+    if fine_tune_type in ['openai', 'anyscale']:
+        return {
+            'messages': [
+                {'role': 'system', 'content': system_prompt},
+                {'role': 'user', 'content': question},
+                {'role': 'assistant', 'content': answer}
+            ]
+        }
+    elif fine_tune_type == 'azure_openai':
+        return {'prompt': question, 'completion': answer}
+    elif fine_tune_type == 'palm2':
+        return {'input_text': question, 'output_text': answer}
+    raise ValueError(f"Invalid fine tune type '{fine_tune_type}', expected one of {fine_tune_types}.")
+
+
+def count_example_tokens(fine_tune_type, system_prompt_token_count, question_token_count, answer_token_count):
+    """
+    Returns the number of tokens of an example, given the number of tokens of its parts:
+    the conversation (as counted by `count_tokens_messages` for the default model) for chat formats, the prompt and completion otherwise.
+    """
+    if fine_tune_type in ['openai', 'anyscale']:
+        properties = get_model()
+        return 3 * (properties['tokens_per_message'] + properties['tokens_per_name']) + system_prompt_token_count + question_token_count + answer_token_count + 3
+    return question_token_count + answer_token_count
+
+
+def convert_records(records, system_prompt, output_types, max_tokens=None):
+    """
+    Converts records to examples in each of the requested formats, counting their tokens.
+    Runs in a worker process, the question and answer of each record are tokenized once for all formats.
+
+    Args:
+        records (list): The records, as dictionaries or as JSON strings.
+        system_prompt (str): The system prompt of chat formats.
+        output_types (list of str): The formats to produce.
+        max_tokens (int): Examples with more tokens are left out, None to keep all examples.
+
+    Returns:
+        dict: The JSONL 'lines' of each format, the number of examples and tokens written per format ('nb_examples', 'nb_tokens'),
+            the number of records and the `(nb_tokens, question, source)` of the records left out of at least one format ('oversized').
+    """
+    system_prompt_token_count = count_tokens_text(system_prompt)
+    output = {'lines': {output_type: [] for output_type in output_types}, 'nb_examples': dict.fromkeys(output_types, 0),
+              'nb_tokens': dict.fromkeys(output_types, 0), 'nb_records': len(records), 'oversized': []}
+    for record in records:
+        if isinstance(record, str):
+            record = json.loads(record)
+        question, answer = record['question'], record['answer']
+        question_token_count, answer_token_count = count_tokens_text(question, store=False), count_tokens_text(answer, store=False)
+        max_oversized_tokens = None
+        for output_type in output_types:
+            nb_tokens = count_example_tokens(output_type, system_prompt_token_count, question_token_count, answer_token_count)
+            if (max_tokens is not None) and (nb_tokens > max_tokens):
+                max_oversized_tokens = max(nb_tokens, max_oversized_tokens or 0)
+                continue
+            output['lines'][output_type].append(json.dumps(create_example(output_type, system_prompt, question, answer), ensure_ascii=False))
+            output['nb_examples'][output_type] += 1
+            output['nb_tokens'][output_type] += nb_tokens
+        if max_oversized_tokens is not None:
+            output['oversized'].append((max_oversized_tokens, question, record.get('source') or ''))
+    return output
+
+#----------------------------------------------------------------------------------------
+# WRITING
+
+class ShardedWriter:
+    """
+    Writes JSONL lines to `{prefix}.jsonl`, or to numbered shards `{prefix}-00000.jsonl`, `{prefix}-00001.jsonl`, etc.
+    if a shard size is set, starting a new shard whenever `max_bytes` or `max_records` would be exceeded.
+    The files of a previous conversion with the same prefix are deleted first, so that no stale shard is left behind.
+
+    Args:
+        output_folder (str): The folder where the files are written.
+        prefix (str): The prefix of the file names.
+        max_bytes (int): The maximum size of a shard, None for no limit.
+        max_records (int): The maximum number of lines of a shard, None for no limit.
+    """
+
+    def __init__(self, output_folder, prefix, max_bytes=None, max_records=None):
+        self.output_folder = Path(output_folder)
+        self.output_folder.mkdir(parents=True, exist_ok=True)
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.paths = []
+        self.output_file = None
+        self.nb_bytes = self.nb_records = 0
+        self.remove_previous_files()
+
+    def remove_previous_files(self):
+        """
+        Deletes the `{prefix}.jsonl` file and the `{prefix}-<number>.jsonl` shards already in the output folder.
+        """
+        file_name_pattern = re.compile(re.escape(self.prefix) + r'(-\d+)?\.jsonl')
+        for path in self.output_folder.iterdir():
+            if path.is_file() and file_name_pattern.fullmatch(path.name):
+                path.unlink()
+
+    def write(self, line):
+        line = (line + '\n').encode('utf-8')
+        is_full = ((self.max_bytes is not None) and (self.nb_bytes + len(line) > self.max_bytes) and (self.nb_records > 0)) \
+                  or ((self.max_records is not None) and (self.nb_records >= self.max_records))
+        if (self.output_file is None) or is_full:
+            self.close()
+            is_sharded = (self.max_bytes is not None) or (self.max_records is not None)
+            self.paths.append(self.output_folder / (f"{self.prefix}-{len(self.paths):05d}.jsonl" if is_sharded else f"{self.prefix}.jsonl"))
+            self.output_file = open(self.paths[-1], 'wb')
+            self.nb_bytes = self.nb_records = 0
+        self.output_file.write(line)
+        self.nb_bytes += len(line)
+        self.nb_records += 1
+
+    def close(self):
+        if self.output_file is not None:
+            self.output_file.close()
+            self.output_file = None
+
+
+def convert_to_fine_tuning_formats(input_path, output_folder, system_prompt, output_types=None, max_workers=None, verbose=True, nb_top_oversized=10):
+    """
+    Converts question/answer pairs to the fine-tuning formats of several providers in a single pass,
+    streaming the input (a JSON array, a JSONL file or a normalized output folder) so that memory usage does not grow with its size.
+    Records are tokenized and serialized by several processes, the outputs keep the order of the input.
+
+    Args:
+        input_path (str): The question/answer pairs, as produced by `question_extractor.py`.
+        output_folder (str): The folder where a `fine_tune_<type>.jsonl` file (or its shards) is written for each format, replacing the previous ones.
+        system_prompt (str): The system prompt of chat formats ('openai' and 'anyscale').
+        output_types (list of str): The formats to write, defaults to all `fine_tune_types`.
+        max_workers (int): The number of processes used, defaults to `conversion_max_workers` (all cores).
+        verbose (bool): If True, print a report of the conversion. Default is True.
+        nb_top_oversized (int): The number of largest oversized examples reported. Default is 10.
+
+    Returns:
+        dict: The number of records, the examples, tokens and files written per format, and the number of oversized records.
+    """
+    output_types = list(output_types or fine_tune_types)
+    for output_type in output_types:
+        if output_type not in fine_tune_types:
+            raise ValueError(f"Invalid fine tune type '{output_type}', expected one of {fine_tune_types}.")
+    max_workers = max_workers or conversion_max_workers or os.cpu_count()
+
+    writers = {output_type: ShardedWriter(output_folder, f"fine_tune_{output_type}", max_bytes=max_shard_bytes, max_records=max_shard_records)
+               for output_type in output_types}
+    report = {'nb_records': 0, 'nb_examples': dict.fromkeys(output_types, 0), 'nb_tokens': dict.fromkeys(output_types, 0), 'nb_oversized': 0}
+    largest_oversized = []  # heap of the largest oversized records
+
+    def write_output(output):
+        report['nb_records'] += output['nb_records']
+        for output_type in output_types:
+            for line in output['lines'][output_type]:
+                writers[output_type].write(line)
+            report['nb_examples'][output_type] += output['nb_examples'][output_type]
+            report['nb_tokens'][output_type] += output['nb_tokens'][output_type]
+        report['nb_oversized'] += len(output['oversized'])
+        for oversized in output['oversized']:
+            heapq.heappush(largest_oversized, oversized)
+            if len(largest_oversized) > nb_top_oversized:
+                heapq.heappop(largest_oversized)
+
+    try:
+        batches = read_record_batches(input_path)
+        if max_workers == 1:
+            for batch in batches:
+                write_output(convert_records(batch, system_prompt, output_types, max_example_tokens))
+        else:
+            # A bounded number of batches is in flight, in order, so that the input is never fully loaded
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                pending = deque()
+                for batch in batches:
+                    pending.append(executor.submit(convert_records, batch, system_prompt, output_types, max_example_tokens))
+                    if len(pending) >= 2 * max_workers:
+                        write_output(pending.popleft().result())
+                while len(pending) > 0:
+                    write_output(pending.popleft().result())
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    report['files'] = {output_type: [str(path) for path in writer.paths] for output_type, writer in writers.items()}
+    if verbose:
+        print(f"Converted {report['nb_records']} question/answer pairs.")
+        for output_type in output_types:
+            print(f"  {output_type}: {report['nb_examples'][output_type]} examples, {report['nb_tokens'][output_type]} tokens, "
+                  f"{len(report['files'][output_type])} files in '{output_folder}'.")
+        if report['nb_oversized'] > 0:
+            print(f"WARNING: {report['nb_oversized']} question/answer pairs are longer than {max_example_tokens} tokens and were left out (of some formats), the largest being:")
+            for nb_tokens, question, source in sorted(largest_oversized, reverse=True):
+                print(f"  {nb_tokens} tokens: '{question[:80]}' ({source})")
+    return report
@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import asyncio
+from pathlib import Path
+from contextlib import contextmanager
+
+#----------------------------------------------------------------------------------------
+# CONFIGURATION
+
+# folder where metrics (Prometheus text format) and traces (Chrome trace format) are written at the end of a run
+metrics_folder = Path('./data/metrics')
+
+# port on which metrics are served in Prometheus text format during a run (on `/metrics`), None to disable the endpoint
+metrics_port = None
+
+# maximum number of spans kept in the trace, to bound memory usage on large runs
+max_trace_events = 500000
+
+# number of seconds between two progress lines
+progress_interval = 10.0
+
+#----------------------------------------------------------------------------------------
+# METRICS
+
+class Metrics:
+    """
+    Counters, gauges, summaries (count/sum/max of observed values) and a trace of timed spans.
+    Everything runs on the event loop thread, so no locking is needed
+    (work done in worker threads, such as splitting files, returns its measures to be recorded once back on the event loop).
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.summaries = {}
+        self.trace_events = []
+
+    def increment(self, name, value=1, **labels):
+        """
+        Adds `value` to a counter.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """
+        Sets the current value of a gauge.
+        """
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def get_gauge(self, name, default=None, **labels):
+        """
+        Returns the value of a gauge with the given labels (unlabelled by default).
+        """
+        return self.gauges.get((name, tuple(sorted(labels.items()))), default)
+
+    def observe(self, name, value, **labels):
+        """
+        Records a value (such as a duration) in a summary.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        summary = self.summaries.get(key)
+        if summary is None:
+            summary = self.summaries[key] = {'count': 0, 'sum': 0.0, 'max': value}
+        summary['count'] += 1
+        summary['sum'] += value
+        summary['max'] = max(summary['max'], value)
+
+    def get_counter(self, name, **labels):
+        """
+        Returns the value of a counter, summed over all of its labels (or over those matching `labels`).
+        """
+        return sum(value for (counter_name, counter_labels), value in self.counters.items()
+                   if (counter_name == name) and set(labels.items()).issubset(counter_labels))
+
+    def get_summary(self, name):
+        """
+        Returns the count and sum of a summary, aggregated over all of its labels.
+        """
+        summaries = [summary for (summary_name, _), summary in self.summaries.items() if summary_name == name]
+        return {'count': sum(summary['count'] for summary in summaries), 'sum': sum(summary['sum'] for summary in summaries)}
+
+    def record_span(self, name, start, duration=None, **labels):
+        """
+        Records a span that started at `start` (as returned by `time.time()`) and lasted `duration` seconds (ends now by default),
+        in the `{name}_seconds` summary and in the trace.
+        """
+        if duration is None:
+            duration = time.time() - start
+        self.observe(f"{name}_seconds", duration, **labels)
+        if len(self.trace_events) < max_trace_events:
+            # spans of the same task share a row of the trace
+            try:
+                task = asyncio.current_task()
+            except RuntimeError:
+                # outside of the event loop (in a thread)
+                task = None
+            self.trace_events.append({'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6,
+                                      'pid': os.getpid(), 'tid': id(task), 'args': labels})
+
+    @contextmanager
+    def span(self, name, **labels):
+        """
+        Times the enclosed block (which can contain awaits) as a span.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record_span(name, start, **labels)
+
+    def to_prometheus_text(self):
+        """
+        Returns all counters, gauges and summaries in the Prometheus text exposition format.
+        """
+        def format_labels(labels):
+            if len(labels) == 0:
+                return ''
+            return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"question_extractor_{name}{format_labels(labels)} {value}")
+        for (name, labels), value in sorted(self.gauges.items()):
+            lines.append(f"question_extractor_{name}{format_labels(labels)} {value}")
+        for (name, labels), summary in sorted(self.summaries.items()):
+            lines.append(f"question_extractor_{name}_count{format_labels(labels)} {summary['count']}")
+            lines.append(f"question_extractor_{name}_sum{format_labels(labels)} {summary['sum']}")
+            lines.append(f"question_extractor_{name}_max{format_labels(labels)} {summary['max']}")
+        return '\n'.join(lines) + '\n'
+
+    def export(self, folder=None):
+        """
+        Writes the metrics (`metrics.prom`) and the trace (`trace.json`, viewable in chrome://tracing or Perfetto) to a folder.
+        """
+        folder = Path(folder or metrics_folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        (folder / 'metrics.prom').write_text(self.to_prometheus_text(), encoding='utf-8')
+        with open(folder / 'trace.json', 'w', encoding='utf-8') as output_file:
+            json.dump({'traceEvents': self.trace_events}, output_file)
+
+
+# metrics shared by the whole process
+metrics = Metrics()
+
+#----------------------------------------------------------------------------------------
+# PROGRESS
+
+def format_duration(seconds):
+    """
+    Formats a number of seconds as `h:mm:ss`.
+    """
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{(seconds % 3600) // 60:02d}:{seconds % 60:02d}"
+
+
+async def report_progress(progress_counter, interval=None):
+    """
+    Asynchronously prints a progress line (QA pairs per second, token throughput, ETA) every `interval` seconds, until cancelled.
+
+    Args:
+        progress_counter (dict): A dictionary containing progress information ('nb_files_done' and 'nb_files').
+        interval (float): The number of seconds between two lines, defaults to `progress_interval`.
+    """
+    start = time.time()
+    while True:
+        await asyncio.sleep(interval or progress_interval)
+        elapsed = time.time() - start
+        nb_files_done = progress_counter['nb_files_done']
+        nb_files = progress_counter['nb_files']
+        nb_qa_pairs = metrics.get_counter('qa_pairs_total')
+        nb_tokens_in = metrics.get_counter('prompt_tokens_total')
+        nb_tokens_out = metrics.get_counter('completion_tokens_total')
+        eta = '?'
+        if isinstance(nb_files, int) and (nb_files_done > 0):
+            eta = format_duration(elapsed * (nb_files - nb_files_done) / nb_files_done)
+        print(f"PROGRESS: {nb_files_done}/{nb_files} files, {nb_qa_pairs} QA pairs ({nb_qa_pairs / elapsed:.1f}/s), "
+              f"{(nb_tokens_in + nb_tokens_out) / elapsed:.0f} tokens/s (in: {nb_tokens_in}, out: {nb_tokens_out}), "
+              f"elapsed {format_duration(elapsed)}, ETA {eta}")
+
+
+async def serve_metrics(port=None, host='127.0.0.1'):
+    """
+    Asynchronously starts an HTTP endpoint serving the metrics in Prometheus text format on `/metrics`.
+
+    Args:
+        port (int): The port to listen on, defaults to `metrics_port`.
+        host (str): The interface to listen on. Default is '127.0.0.1'.
+
+    Returns:
+        aiohttp.web.AppRunner: The runner of the server (call its `cleanup` method to stop it), or None if no port is set.
+    """
+    port = port or metrics_port
+    if port is None:
+        return None
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=metrics.to_prometheus_text(), content_type='text/plain')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
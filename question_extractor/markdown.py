@@ -1,4 +1,94 @@
 import os
+import re
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+#----------------------------------------------------------------------------------------
+# LOADING
+
+# number of threads used to scan directories
+scanning_max_workers = 16
+
+
+class MarkdownFile:
+    """
+    A markdown file found while scanning a directory, its content is only read when needed.
+    """
+
+    def __init__(self, path, size, relative_path=None):
+        self.path = path
+        self.size = size
+        # path relative to the scanned directory, using '/' as a separator
+        self.relative_path = relative_path
+
+    def read(self):
+        """
+        Reads and returns the content of the file.
+        """
+        with open(self.path, "r", encoding="utf-8") as file:
+            return file.read()
+
+
+def matches_any_pattern(relative_path, patterns):
+    """
+    Returns True if a path (relative to the scanned directory, using '/' as a separator) matches one of the glob patterns.
+    Patterns are tested against both the full relative path and the file name.
+    """
+    file_name = relative_path.rsplit('/', 1)[-1]
+    return any(fnmatch(relative_path, pattern) or fnmatch(file_name, pattern) for pattern in patterns)
+
+
+def scan_directory(directory, relative_directory):
+    """
+    Lists the content of a single directory.
+
+    Returns:
+        tuple: A list of (path, relative path) of subdirectories and a list of (path, relative path, size) of files.
+    """
+    subdirectories = []
+    files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            relative_path = entry.name if relative_directory == '' else f"{relative_directory}/{entry.name}"
+            # Symbolic links are not followed, so that a link loop cannot make the scan fail nor a subtree be listed twice
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append((entry.path, relative_path))
+            elif entry.is_file(follow_symlinks=False):
+                files.append((entry.path, relative_path, entry.stat().st_size))
+    return subdirectories, files
+
+
+def scan_markdown_files(directory, include_patterns=('*.md',), exclude_patterns=(), max_workers=None):
+    """
+    Lazily finds markdown files in a folder and its subfolders, scanning directories concurrently with a thread pool.
+    Files are yielded as soon as their directory has been scanned, without reading their content.
+
+    Args:
+        directory (str): The path to the folder containing markdown files.
+        include_patterns (tuple of str): Glob patterns a file must match to be included. Default is ('*.md',).
+        exclude_patterns (tuple of str): Glob patterns excluding files and whole subdirectories. Default is ().
+        max_workers (int): The number of scanning threads, defaults to `scanning_max_workers`.
+
+    Yields:
+        MarkdownFile: The files found, with their path and size.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers or scanning_max_workers) as executor:
+        pending = {executor.submit(scan_directory, str(directory), '')}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                subdirectories, files = future.result()
+
+                # Schedule the scan of subdirectories that are not excluded
+                for subdirectory, relative_path in subdirectories:
+                    if not matches_any_pattern(relative_path, exclude_patterns):
+                        pending.add(executor.submit(scan_directory, subdirectory, relative_path))
+
+                # Yield the files matching the patterns
+                for file_path, relative_path, size in files:
+                    if matches_any_pattern(relative_path, include_patterns) and not matches_any_pattern(relative_path, exclude_patterns):
+                        yield MarkdownFile(file_path, size, relative_path)
+
 
 def load_markdown_files_from_directory(directory):
     """
@@ -11,43 +101,90 @@ def load_markdown_files_from_directory(directory):
     Returns:
         list of tuples: A list of tuples containing the file path (str) and the file content (str) for each markdown file.
     """
-    markdown_files_data = []
-
-    # Iterate through the files in the directory and its subdirectories
-    for root, dirs, files in os.walk(directory):
-        for file_name in files:
-            
-            # Check if the file is a markdown file
-            if file_name.endswith('.md'):
-                file_path = os.path.join(root, file_name)
-                
-                # Read the file content
-                with open(file_path, "r", encoding="utf-8") as file:
-                    file_content = file.read()
-                
-                # Append the file path and content to the markdown_files_data list
-                markdown_files_data.append((file_path, file_content))
-
-    return markdown_files_data
-
-def find_highest_markdown_heading_level(lines):
-    """
-    Takes a list of lines representing a markdown file as input.
-    Finds the highest level of heading and returns it as an integer.
-    Returns None if the text contains no headings.
+    return [(markdown_file.path, markdown_file.read()) for markdown_file in scan_markdown_files(directory)]
+
+#----------------------------------------------------------------------------------------
+# SPLITTING
+
+# matches a markdown heading, capturing its level
+heading_pattern = re.compile(r"^(#+)(\s|$)")
+
+# matches the whitespace following the end of a sentence, and following a word
+sentence_end_pattern = re.compile(r"(?<=[.!?])\s+")
+word_end_pattern = re.compile(r"\s+")
+
+
+class MarkdownSection:
+    """
+    A node of the heading tree of a markdown file.
+    A section covers the lines `[start, end)` of the file, starting with its heading line (except for the root),
+    its own body runs until the start of its first subsection.
+    """
+
+    def __init__(self, title, level, start):
+        self.title = title
+        self.level = level
+        self.start = start
+        self.end = None
+        self.token_count = None
+        self.children = []
+
+    def body_end(self):
+        """
+        Returns the index of the line ending the body of the section (before its first subsection).
+        """
+        return self.children[0].start if len(self.children) > 0 else self.end
+
+
+class MarkdownTree:
+    """
+    The heading tree of a markdown file, along with the token count of each of its lines.
+    """
+
+    def __init__(self, lines, line_token_counts, root, count_tokens):
+        self.lines = lines
+        self.root = root
+        self.count_tokens_text = count_tokens
+        # prefix sums of the per-line token counts, one token per newline included
+        self.cumulated_token_counts = [0]
+        for line_token_count in line_token_counts:
+            self.cumulated_token_counts.append(self.cumulated_token_counts[-1] + line_token_count + 1)
+
+    def count_tokens(self, start, end):
+        """
+        Returns the (slightly overestimated) number of tokens in the lines `[start, end)`.
+        """
+        return self.cumulated_token_counts[end] - self.cumulated_token_counts[start]
+
+    def get_text(self, start, end):
+        """
+        Returns the text of the lines `[start, end)`.
+        """
+        return '\n'.join(self.lines[start:end]).strip()
+
+
+def parse_markdown_tree(text, count_tokens, count_tokens_batch=None):
+    """
+    Takes a string representation of a markdown file as input.
+    Builds its heading tree in a single pass, computing the token count of each section once from per-line token counts.
     
     Args:
-        lines (list of str): A list of lines in the markdown file.
+        text (str): The content of a markdown file as a single string.
+        count_tokens (function): A function returning the number of tokens in a string.
+        count_tokens_batch (function): If not None, a function returning the number of tokens of each string of a list,
+            used to tokenize all lines at once.
 
     Returns:
-        int or None: The highest heading level as an integer, or None if no headings are found.
+        MarkdownTree: The tree of sections of the file.
     """
-    highest_heading_level = None
+    lines = text.split('\n')
+    line_token_counts = [count_tokens(line) for line in lines] if count_tokens_batch is None else count_tokens_batch(lines)
+
+    root = MarkdownSection(title='', level=0, start=0)
+    open_sections = [root]
     code_section = False
 
-    # Iterate through the lines in the markdown file
-    for line in lines:
-    
+    for index, line in enumerate(lines):
         """
         Check code section e.g.:
             ```bash
@@ -55,86 +192,335 @@ def find_highest_markdown_heading_level(lines):
             antctl trace-packet -S ns1/pod1 -D ns2/pod2
             # Trace a Service request from a local Pod
             antctl trace-packet -S ns1/pod1 -D ns2/svc2 -f "tcp,tcp_dst=80"
-            # Trace the Service reply packet (assuming "ns2/pod2" is the Service backend Pod)
-            antctl trace-packet -D ns1/pod1 -S ns2/pod2 -f "tcp,tcp_src=80"
-            # Trace an IP packet from a Pod to gateway port
-            antctl trace-packet -S ns1/pod1 -D antrea-gw0
-            # Trace a UDP packet from a Pod to an IP address
-            antctl trace-packet -S ns1/pod1 -D 10.1.2.3 -f udp,udp_dst=1234
-            # Trace a UDP packet from an IP address to a Pod
-            antctl trace-packet -D ns1/pod1 -S 10.1.2.3 -f udp,udp_src=1234
-            # Trace an ARP request from a local Pod
-            antctl trace-packet -p ns1/pod1 -f arp,arp_spa=10.1.2.3,arp_sha=00:11:22:33:44:55,arp_tpa=10.1.2.1,dl_dst=ff:ff:ff:ff:ff:ff
             ```
         Here # is a code comment not the md level symbole
         """
         if line.startswith("```"):
             code_section = not code_section
+        if code_section:
+            continue
+
         # Check if the line starts with a heading
-        if line.startswith("#") and not code_section:
-            
-            # Calculate the heading level based on the number of '#' characters
-            current_heading_level = len(line.split()[0])
-            
-            # Update the highest_heading_level if it is None or if the current_heading_level is higher
-            if (highest_heading_level is None) or (current_heading_level < highest_heading_level):
-                highest_heading_level = current_heading_level
+        heading_match = heading_pattern.match(line)
+        if heading_match is None:
+            continue
+
+        # Close the sections that are at the same or a deeper level than the new heading
+        level = len(heading_match.group(1))
+        while open_sections[-1].level >= level:
+            open_sections.pop().end = index
+
+        # Open the new section as a subsection of the deepest open section
+        section = MarkdownSection(title=line.strip(), level=level, start=index)
+        open_sections[-1].children.append(section)
+        open_sections.append(section)
+
+    # Close the sections still open at the end of the file
+    for section in open_sections:
+        section.end = len(lines)
+
+    tree = MarkdownTree(lines, line_token_counts, root, count_tokens)
+
+    # Aggregate token counts over the tree
+    sections = [root]
+    while sections:
+        section = sections.pop()
+        section.token_count = tree.count_tokens(section.start, section.end)
+        sections.extend(section.children)
+
+    return tree
 
-    return highest_heading_level
 
-def split_markdown(text):
+def is_body_line(line):
     """
-    Takes a string representation of a markdown file as input.
-    Finds the highest level of heading and splits the text into sections accordingly.
-    Returns a list of tuples, each containing the section title and section content.
-    
+    Returns True if a line holds text of its own (it is neither blank nor a heading).
+    """
+    return (len(line.strip()) > 0) and (heading_pattern.match(line) is None)
+
+
+def title_to_path(title):
+    """
+    Turns a section title into a path component (`## Some Title` becomes `##some-title`).
+    """
+    return title.replace('# ', '#').replace(' ', '-').lower()
+
+
+def split_after(text, pattern):
+    """
+    Splits a text after each match of a pattern (such as the whitespace ending a sentence),
+    each piece keeping the separator that follows it, so that the pieces add up to the text.
+    """
+    pieces = []
+    position = 0
+    for match in pattern.finditer(text):
+        if match.end() > position:
+            pieces.append(text[position:match.end()])
+            position = match.end()
+    if position < len(text):
+        pieces.append(text[position:])
+    return pieces
+
+
+def cut_by_tokens(text, count_tokens, fits_token_count):
+    """
+    Cuts a text that cannot be split along whitespace (such as a long URL or an encoded blob) into the longest pieces that fit the token budget.
+
     Args:
-        text (str): The content of a markdown file as a single string.
+        text (str): The text to cut.
+        count_tokens (function): A function returning the number of tokens in a string.
+        fits_token_count (function): A function returning True if a given number of tokens can be processed.
 
     Returns:
-        list of tuples: A list of tuples containing the section title (str) and section content (str).
+        list of tuples: Each piece of the text (str) and its token count (int).
     """
-    lines = text.split('\n')
+    pieces = []
+    while len(text) > 0:
+        # Binary search of the longest prefix that fits (of at least one character, so that the text is always consumed)
+        low, high = 1, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if fits_token_count(count_tokens(text[:middle])):
+                low = middle
+            else:
+                high = middle - 1
+        pieces.append((text[:low], count_tokens(text[:low])))
+        text = text[low:]
+    return pieces
+
+
+def split_overlong_text(text, count_tokens, fits_token_count):
+    """
+    Splits a text that does not fit the token budget into words (keeping the whitespace that follows them),
+    words that do not fit on their own being cut along tokens.
+
+    Returns:
+        list of tuples: Each piece of the text (str) and its token count (int).
+    """
+    pieces = []
+    for word in split_after(text, word_end_pattern):
+        word_token_count = count_tokens(word)
+        if fits_token_count(word_token_count):
+            pieces.append((word, word_token_count))
+        else:
+            pieces.extend(cut_by_tokens(word, count_tokens, fits_token_count))
+    return pieces
+
+
+def pack_pieces(pieces, fits_token_count):
+    """
+    Greedily groups consecutive pieces of text while the group fits the token budget.
+
+    Args:
+        pieces (list of tuples): A list of tuples containing a piece of text (str), ending with the whitespace that separates it from the next piece, and its token count (int).
+        fits_token_count (function): A function returning True if a given number of tokens can be processed.
+
+    Returns:
+        list of str: The text of each group, pieces being concatenated as they are (trailing whitespace is removed).
+        Pieces that do not fit on their own are returned in a group of their own.
+    """
+    groups = []
+    group_pieces = []
+    group_token_count = 0
+    for piece, piece_token_count in pieces:
+        # one extra token as a margin, tokens might merge across the boundary of two pieces
+        if (len(group_pieces) > 0) and fits_token_count(group_token_count + 1 + piece_token_count):
+            group_pieces.append(piece)
+            group_token_count += 1 + piece_token_count
+        else:
+            if len(group_pieces) > 0:
+                groups.append(''.join(group_pieces).rstrip())
+            group_pieces = [piece]
+            group_token_count = piece_token_count
+    if len(group_pieces) > 0:
+        groups.append(''.join(group_pieces).rstrip())
+    return groups
+
 
-    # Remove the title heading (if present) from the text
-    if (len(lines) > 0) and (lines[0].startswith('#')):
-        lines = lines[1:]
-
-    # Find the highest heading level
-    highest_heading_level = find_highest_markdown_heading_level(lines)
-
-    # If there are no headings, print a warning and return an empty list
-    if highest_heading_level is None:
-        # FIXME if this is ever triggered, introduce an alternative paragraph splitting method
-        print(f"WARNING: Giving up on a piece of text that is too long for processing:\n```\n{text}\n```")
-        return []
-
-    # Construct the heading prefix for splitting
-    headings_prefix = ("#" * highest_heading_level) + " "
-
-    # Split the text at the highest heading level
-    sections = []
-    current_section_title = ''
-    current_section = []
-
-    for line in lines:
-        # Check if the line starts with the highest heading level prefix
-        if line.startswith(headings_prefix):
-            # If the current_section is not empty, add it to the sections list
-            if len(current_section) > 0:
-                current_section_body = '\n'.join(current_section)
-                sections.append((current_section_title, current_section_body))
-
-                # Update the current_section_title and clear the current_section
-                current_section_title = line.strip()
-                current_section = []
+def split_long_line(line, count_tokens, fits_token_count, prefix=None):
+    """
+    Splits a line that is too long to be processed into groups of sentences, of words for overlong sentences,
+    and of parts of words (cut along tokens) for overlong words. The whitespace between the parts of a group is kept as is.
+
+    Args:
+        line (str): The line to split.
+        count_tokens (function): A function returning the number of tokens in a string.
+        fits_token_count (function): A function returning True if a given number of tokens can be processed.
+        prefix (str): If not None, a text (such as headings) put at the start of the first piece, followed by a blank line.
+
+    Returns:
+        list of str: Pieces of the line that fit the token budget.
+    """
+    pieces = []
+    for sentence in split_after(line.rstrip(), sentence_end_pattern):
+        sentence_token_count = count_tokens(sentence)
+        if fits_token_count(sentence_token_count):
+            pieces.append((sentence, sentence_token_count))
         else:
-            # Add the line to the current_section
-            current_section.append(line)
+            pieces.extend(split_overlong_text(sentence, count_tokens, fits_token_count))
+    prefix_token_count = None if prefix is None else count_tokens(prefix) + 2
+    # Headings that leave no room for any text are left out, a chunk made of headings only would be dropped anyway
+    if (prefix_token_count is not None) and fits_token_count(prefix_token_count + 1) and (len(pieces) > 0):
+        # The first piece is split into words, or cut along tokens, if it does not fit along with the prefix
+        fits_after_prefix = lambda token_count: fits_token_count(prefix_token_count + token_count)
+        if not fits_after_prefix(pieces[0][1]):
+            first_piece, _ = pieces.pop(0)
+            first_pieces = split_overlong_text(first_piece, count_tokens, fits_token_count)
+            if not fits_after_prefix(first_pieces[0][1]):
+                first_word, _ = first_pieces.pop(0)
+                first_pieces[0:0] = cut_by_tokens(first_word, count_tokens, fits_after_prefix)
+            pieces[0:0] = first_pieces
+        first_piece, first_piece_token_count = pieces[0]
+        pieces[0] = (prefix + '\n\n' + first_piece, prefix_token_count + first_piece_token_count)
+    return pack_pieces(pieces, fits_token_count)
+
+
+def find_paragraphs(tree, start, end):
+    """
+    Splits the lines `[start, end)` into paragraphs separated by blank lines, code blocks are kept whole.
+
+    Returns:
+        list of tuples: The `(start, end)` line range of each paragraph.
+    """
+    paragraphs = []
+    paragraph_start = start
+    code_section = False
+    for index in range(start, end):
+        line = tree.lines[index]
+        if line.startswith("```"):
+            code_section = not code_section
+        if (not code_section) and (len(line.strip()) == 0):
+            if index > paragraph_start:
+                paragraphs.append((paragraph_start, index))
+            paragraph_start = index + 1
+    if end > paragraph_start:
+        paragraphs.append((paragraph_start, end))
+    return paragraphs
+
+
+def cut_markdown_tree(tree, file_path, fits_token_count, stats=None):
+    """
+    Selects the largest sections of a markdown tree that fit the token budget.
+    Sections that do not fit are replaced by their own body (the text before their first subsection)
+    followed by their subsections, recursively, adjacent siblings being merged back together while they fit the budget.
+    Sections without subsections that do not fit are split along paragraphs, then lines, then sentences, then words, then tokens.
+    
+    Args:
+        tree (MarkdownTree): The tree of sections of the file.
+        file_path (str): The path of the file, used as a prefix to name the chunks.
+        fits_token_count (function): A function returning True if a given number of tokens can be processed.
+        stats (dict): If not None, its 'nb_unpacked_chunks' and 'nb_chunks' entries are incremented with the number
+            of chunks that would have been produced without merging siblings, and the number of chunks produced.
+
+    Returns:
+        list of tuples: A list of tuples containing the chunk path (str) and chunk content (str).
+    """
+    chunks = []
+    nb_sections = 0
+
+    def add_chunk(path, text):
+        # Headings without any text below them would only produce junk questions
+        if any(is_body_line(line) for line in text.split('\n')):
+            chunks.append((path, text))
+
+    def split_leaf(path, start, end):
+        nonlocal nb_sections
+        # The lines `[start, end)` open with headings, which are kept with the first piece of the body
+        body_start = next((index for index in range(start, end) if is_body_line(tree.lines[index])), None)
+        if body_start is None:
+            return
+
+        # Pack paragraphs (or lines of oversized paragraphs) into line ranges that fit the budget
+        line_ranges = []
+        for paragraph_start, paragraph_end in find_paragraphs(tree, body_start, end):
+            range_start = start if len(line_ranges) == 0 else paragraph_start
+            if fits_token_count(tree.count_tokens(range_start, paragraph_end)):
+                line_ranges.append((range_start, paragraph_end))
+            else:
+                line_ranges.append((range_start, paragraph_start + 1))
+                line_ranges.extend((index, index + 1) for index in range(paragraph_start + 1, paragraph_end))
+
+        texts = []
+        group_start, group_end = None, None
+        for range_start, range_end in line_ranges:
+            if (group_start is not None) and fits_token_count(tree.count_tokens(group_start, range_end)):
+                group_end = range_end
+                continue
+            if group_start is not None:
+                texts.append(tree.get_text(group_start, group_end))
+            if fits_token_count(tree.count_tokens(range_start, range_end)):
+                group_start, group_end = range_start, range_end
+            else:
+                # A single line that does not fit (the headings above the first line going with its first piece)
+                group_start, group_end = None, None
+                headings = tree.get_text(range_start, range_end - 1) if range_start < range_end - 1 else None
+                texts.extend(split_long_line(tree.lines[range_end - 1], tree.count_tokens_text, fits_token_count, prefix=headings))
+        if group_start is not None:
+            texts.append(tree.get_text(group_start, group_end))
+
+        # Texts still too long (groups of lines are measured with a margin, so this should not happen) are cut along tokens rather than lost
+        texts = [piece for text in texts
+                 for piece in ([text] if fits_token_count(tree.count_tokens_text(text))
+                               else [piece_text for piece_text, _ in cut_by_tokens(text, tree.count_tokens_text, fits_token_count)])]
+        for index, text in enumerate(texts):
+            nb_sections += 1
+            add_chunk(f"{path.rstrip('/')}/part-{index + 1}", text)
+
+    def cut_section(section, path, start=None):
+        nonlocal nb_sections
+        # The section starts at `start` when the headings of its ancestors without a body of their own are kept with it
+        start = section.start if start is None else start
+
+        # The section fits: keep it whole
+        if fits_token_count(tree.count_tokens(start, section.end)):
+            nb_sections += 1
+            add_chunk(path, tree.get_text(start, section.end))
+            return
+
+        # The section is a leaf that does not fit
+        if len(section.children) == 0:
+            split_leaf(path, start, section.end)
+            return
+
+        # The title heading of the file does not need its own level in the chunk paths
+        body_start = section.start if section.level == 0 else section.start + 1
+        body_end = section.body_end()
+        body_is_empty = len(tree.get_text(body_start, body_end)) == 0
+        if (section is tree.root) and body_is_empty and (len(section.children) == 1):
+            cut_section(section.children[0], path, start)
+            return
+
+        # Units covering the section: its body (if it has more than a heading) then its subsections,
+        # the heading of a section without a body going with its first subsection
+        units = []
+        if not body_is_empty:
+            units.append((path + '/', start, body_end, None))
+        for child in section.children:
+            child_start = start if len(units) == 0 else child.start
+            units.append((path + '/' + title_to_path(child.title), child_start, child.end, child))
+
+        # Greedily merge adjacent units while they fit, named after their first unit
+        group = None
+        for unit_path, unit_start, unit_end, child in units:
+            if (group is not None) and fits_token_count(tree.count_tokens(group[1], unit_end)):
+                nb_sections += 1
+                group = (group[0], group[1], unit_end)
+                continue
+            if group is not None:
+                add_chunk(group[0], tree.get_text(group[1], group[2]))
+                group = None
+            if fits_token_count(tree.count_tokens(unit_start, unit_end)):
+                nb_sections += 1
+                group = (unit_path, unit_start, unit_end)
+            elif child is None:
+                split_leaf(unit_path, unit_start, unit_end)
+            else:
+                cut_section(child, unit_path, unit_start)
+        if group is not None:
+            add_chunk(group[0], tree.get_text(group[1], group[2]))
 
-    # Add the last section to the sections list (if not empty)
-    if len(current_section) > 0:
-        current_section_body = '\n'.join(current_section)
-        sections.append((current_section_title, current_section_body))
+    cut_section(tree.root, file_path)
 
-    return sections
\ No newline at end of file
+    if stats is not None:
+        stats['nb_unpacked_chunks'] = stats.get('nb_unpacked_chunks', 0) + nb_sections
+        stats['nb_chunks'] = stats.get('nb_chunks', 0) + len(chunks)
+    return chunks
@@ -0,0 +1,76 @@
+#----------------------------------------------------------------------------------------
+# CONFIGURATION
+
+# properties of each model that can be called:
+# - its context window (prompt plus completion, in tokens) and tokenizer (a tiktoken encoding),
+# - the tokens added around each message and each name (see `count_tokens_messages`),
+# - its price, in dollars per 1000 input and output tokens,
+# - the rate limits of the provider account (overridable per API key, see `rate_limiting.py`),
+# - the maximum number of calls in flight, each model having its own adaptive concurrency pool (see `retrying.py`)
+models = {
+    'gpt-3.5-turbo': {'context_window': 4096, 'encoding': 'cl100k_base', 'tokens_per_message': 4, 'tokens_per_name': -1,
+                      'prices': {'input': 0.0015, 'output': 0.002},
+                      'rate_limits': {'requests_per_minute': 3500, 'tokens_per_minute': 90000}, 'max_concurrency': 1500},
+    'gpt-3.5-turbo-16k': {'context_window': 16384, 'encoding': 'cl100k_base', 'tokens_per_message': 3, 'tokens_per_name': 1,
+                          'prices': {'input': 0.003, 'output': 0.004},
+                          'rate_limits': {'requests_per_minute': 3500, 'tokens_per_minute': 180000}, 'max_concurrency': 1500},
+    'gpt-4': {'context_window': 8192, 'encoding': 'cl100k_base', 'tokens_per_message': 3, 'tokens_per_name': 1,
+              'prices': {'input': 0.03, 'output': 0.06},
+              'rate_limits': {'requests_per_minute': 200, 'tokens_per_minute': 10000}, 'max_concurrency': 200},
+    'gpt-4-32k': {'context_window': 32768, 'encoding': 'cl100k_base', 'tokens_per_message': 3, 'tokens_per_name': 1,
+                  'prices': {'input': 0.06, 'output': 0.12},
+                  'rate_limits': {'requests_per_minute': 200, 'tokens_per_minute': 20000}, 'max_concurrency': 200},
+}
+
+# model used by stages missing from `stage_models`
+default_model = 'gpt-3.5-turbo'
+
+# model used by each stage of the pipeline: texts are split so that each chunk fits in the context of both the extraction and the answering model,
+# using a larger context model for answering (or for both stages) means fewer, larger chunks and larger batches of questions
+stage_models = {
+    'extraction': 'gpt-3.5-turbo',
+    'answering': 'gpt-3.5-turbo',
+    'batch_answering': 'gpt-3.5-turbo',
+}
+
+#----------------------------------------------------------------------------------------
+# REGISTRY
+
+def register_model(name, context_window, encoding='cl100k_base', tokens_per_message=3, tokens_per_name=1,
+                   input_price=0.0, output_price=0.0, requests_per_minute=3500, tokens_per_minute=90000, max_concurrency=1500):
+    """
+    Adds a model (such as a model served locally) to the registry, or replaces its properties.
+
+    Args:
+        name (str): The name of the model, as sent to the server.
+        context_window (int): The maximum number of tokens of the prompt plus the completion.
+        encoding (str): The name of the tiktoken encoding closest to the tokenizer of the model.
+        tokens_per_message (int): The number of tokens added around each message.
+        tokens_per_name (int): The number of tokens added for a name (counted for every message).
+        input_price (float): The price of 1000 input tokens, in dollars.
+        output_price (float): The price of 1000 output tokens, in dollars.
+        requests_per_minute (int): The number of requests per minute allowed.
+        tokens_per_minute (int): The number of tokens per minute allowed.
+        max_concurrency (int): The maximum number of calls in flight.
+    """
+    models[name] = {'context_window': context_window, 'encoding': encoding, 'tokens_per_message': tokens_per_message, 'tokens_per_name': tokens_per_name,
+                    'prices': {'input': input_price, 'output': output_price},
+                    'rate_limits': {'requests_per_minute': requests_per_minute, 'tokens_per_minute': tokens_per_minute},
+                    'max_concurrency': max_concurrency}
+
+
+def get_model(model=None):
+    """
+    Returns the properties of a model (defaults to `default_model`), raising a ValueError if it is not in the registry.
+    """
+    model = model or default_model
+    if model not in models:
+        raise ValueError(f"Unknown model '{model}', add it to the registry with `register_model` (known models: {list(models)}).")
+    return models[model]
+
+
+def get_stage_model(stage):
+    """
+    Returns the name of the model used by a stage of the pipeline ('extraction', 'answering' or 'batch_answering').
+    """
+    return stage_models.get(stage, default_model)
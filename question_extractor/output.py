@@ -0,0 +1,110 @@
+import json
+from pathlib import Path
+
+#----------------------------------------------------------------------------------------
+# NORMALIZED FORMAT
+
+# The normalized output is a folder holding two JSONL tables, both written and read one line at a time:
+# `chunks.jsonl` has one `{"id", "source", "text"}` row per chunk, the text of a chunk being stored once,
+# `questions.jsonl` has one `{"chunk", "question", "answer"}` row per question/answer pair, referencing the id of its chunk.
+chunks_filename = 'chunks.jsonl'
+questions_filename = 'questions.jsonl'
+
+
+class NormalizedWriter:
+    """
+    Appends chunks and their question/answer pairs to the tables of a normalized output folder.
+
+    Args:
+        output_folder (str): The folder where the tables are written (created if needed, existing tables are overwritten).
+    """
+
+    def __init__(self, output_folder):
+        self.output_folder = Path(output_folder)
+        self.output_folder.mkdir(parents=True, exist_ok=True)
+        self.chunks_file = open(self.output_folder / chunks_filename, 'w', encoding='utf-8')
+        self.questions_file = open(self.output_folder / questions_filename, 'w', encoding='utf-8')
+        self.nb_chunks = 0
+        self.nb_records = 0
+
+    def write_chunk(self, source, text):
+        """
+        Writes a chunk and returns its id.
+        """
+        chunk_id = self.nb_chunks
+        self.chunks_file.write(json.dumps({'id': chunk_id, 'source': source, 'text': text}, ensure_ascii=False) + '\n')
+        self.nb_chunks += 1
+        return chunk_id
+
+    def write_qa_pair(self, chunk_id, question, answer):
+        """
+        Writes a question/answer pair about a chunk.
+        """
+        self.questions_file.write(json.dumps({'chunk': chunk_id, 'question': question, 'answer': answer}, ensure_ascii=False) + '\n')
+        self.nb_records += 1
+
+    def close(self):
+        self.chunks_file.close()
+        self.questions_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception_info):
+        self.close()
+
+
+def write_normalized_output(manifest, output_folder, max_qa_pairs=300):
+    """
+    Writes the question/answer pairs of all files in the manifest to a normalized output folder.
+
+    Args:
+        manifest (Manifest): The manifest of the run (see `state.py`), once deleted files have been pruned.
+        output_folder (str): The folder where the tables are written.
+        max_qa_pairs (int): The maximum number of questions kept per file. Default is 300.
+
+    Returns:
+        int: The number of question/answer pairs written.
+    """
+    with NormalizedWriter(output_folder) as writer:
+        for file_path in manifest.files:
+            for chunk_path, chunk_text, qa_pairs in manifest.iter_chunks(file_path, max_qa_pairs):
+                if len(qa_pairs) > 0:
+                    chunk_id = writer.write_chunk(chunk_path, chunk_text)
+                    for question, answer in qa_pairs:
+                        writer.write_qa_pair(chunk_id, question, answer)
+    return writer.nb_records
+
+
+def read_jsonl(path):
+    """
+    Yields the rows of a JSONL file, skipping empty lines.
+    """
+    with open(path, 'r', encoding='utf-8') as input_file:
+        for line in input_file:
+            if len(line.strip()) > 0:
+                yield json.loads(line)
+
+
+def read_normalized_output(output_folder, include_text=False):
+    """
+    Streams the `{source, question, answer}` records of a normalized output folder,
+    only the source (and text, if asked for) of each chunk being held in memory.
+
+    Args:
+        output_folder (str): The folder holding the tables.
+        include_text (bool): If True, records also contain the 'text' of their chunk. Default is False.
+
+    Yields:
+        dict: Dictionaries containing source, question, and answer (and text) information.
+    """
+    output_folder = Path(output_folder)
+    chunks = {}
+    for chunk in read_jsonl(output_folder / chunks_filename):
+        chunks[chunk['id']] = (chunk['source'], chunk['text'] if include_text else None)
+    for row in read_jsonl(output_folder / questions_filename):
+        source, text = chunks[row['chunk']]
+        record = {'source': source, 'question': row['question'], 'answer': row['answer']}
+        if include_text:
+            record['text'] = text
+        yield record
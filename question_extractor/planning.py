@@ -0,0 +1,211 @@
+import os
+import csv
+import math
+from concurrent.futures import ProcessPoolExecutor
+from .markdown import scan_markdown_files, parse_markdown_tree, cut_markdown_tree
+from .rate_limiting import get_rate_limits, rate_limit_usage_ratio
+from . import models
+from .models import get_model, get_stage_model
+from .token_counting import (count_tokens_text, are_tokens_available_for_both_conversations, split_questions_into_batches, get_token_statistics,
+                             get_empty_messages_token_count, batch_answer_overhead_token_count, batch_question_overhead_token_count)
+
+#----------------------------------------------------------------------------------------
+# CONFIGURATION
+
+# the price of each model is set in `models.py`, each call being priced with the model of its stage
+
+# number of processes used to tokenize the corpus, None to use all cores
+planning_max_workers = None
+
+# number of files sent to a process at once
+planning_chunksize = 16
+
+#----------------------------------------------------------------------------------------
+# PREDICTING
+
+def plan_chunk(text_token_count, batch_answering, max_questions_per_batch, max_questions):
+    """
+    Predicts the calls and tokens needed to extract and answer the questions of a chunk.
+
+    Args:
+        text_token_count (int): The number of tokens in the chunk.
+        batch_answering (bool): Whether questions are answered in batches.
+        max_questions_per_batch (int): The maximum number of questions per batch.
+        max_questions (int): The maximum number of questions that will be answered for this chunk.
+
+    Returns:
+        dict: The predicted number of questions, calls, input and output tokens, and cost,
+            with the calls and tokens of each stage (`nb_batch_answering_calls` is part of `nb_answering_calls`).
+    """
+    token_statistics = get_token_statistics()
+    average_question_size = token_statistics.mean('question_size')
+    average_answer_size = token_statistics.mean('answer_size')
+    average_question_text_ratio = token_statistics.mean('question_text_ratio')
+
+    # Extraction produces questions in proportion to the length of the text
+    questions_token_count = max(average_question_size, text_token_count * average_question_text_ratio)
+    nb_questions = min(max_questions, max(1, round(questions_token_count / average_question_size)))
+    plan = {'nb_questions': nb_questions, 'nb_extraction_calls': 0, 'nb_answering_calls': 0, 'nb_batch_answering_calls': 0,
+            'input_tokens': 0, 'output_tokens': 0, 'extraction_tokens': 0, 'answering_tokens': 0, 'batch_answering_tokens': 0, 'cost': 0.0}
+
+    def add_call(stage, input_tokens, output_tokens):
+        plan['nb_extraction_calls' if stage == 'extraction' else 'nb_answering_calls'] += 1
+        if stage == 'batch_answering':
+            plan['nb_batch_answering_calls'] += 1
+        plan['input_tokens'] += input_tokens
+        plan['output_tokens'] += output_tokens
+        plan[f"{stage}_tokens"] += input_tokens + output_tokens
+        plan['cost'] += compute_cost(input_tokens, output_tokens, model=get_stage_model(stage))
+
+    add_call('extraction', get_empty_messages_token_count('extraction') + text_token_count, questions_token_count)
+
+    # Answering sends the text once per batch (or once per question)
+    if batch_answering:
+        batches = split_questions_into_batches(text_token_count, [average_question_size] * nb_questions, max_batch_size=max_questions_per_batch)
+    else:
+        batches = [range(index, index + 1) for index in range(nb_questions)]
+    for batch in batches:
+        nb_batch_questions = len(batch)
+        if nb_batch_questions > 1:
+            add_call('batch_answering',
+                     get_empty_messages_token_count('batch_answering') + text_token_count + nb_batch_questions * (average_question_size + batch_question_overhead_token_count),
+                     nb_batch_questions * (average_answer_size + batch_answer_overhead_token_count))
+        else:
+            add_call('answering', get_empty_messages_token_count('answering') + text_token_count + average_question_size, average_answer_size)
+    return plan
+
+
+def plan_file(file_path, batch_answering=True, max_questions_per_batch=10, max_qa_pairs=300):
+    """
+    Reads, splits and tokenizes a file, then predicts the calls and tokens needed to process it.
+    Runs in a worker process.
+
+    Args:
+        file_path (str): The path of the markdown file.
+        batch_answering (bool): Whether questions are answered in batches.
+        max_questions_per_batch (int): The maximum number of questions per batch.
+        max_qa_pairs (int): The maximum number of questions kept per file.
+
+    Returns:
+        dict: The predicted number of chunks, questions, calls, input and output tokens of the file.
+    """
+    with open(file_path, 'r', encoding='utf-8') as input_file:
+        text = input_file.read()
+    markdown_tree = parse_markdown_tree(text.strip(), count_tokens_text)
+    chunks = cut_markdown_tree(markdown_tree, file_path, are_tokens_available_for_both_conversations)
+
+    file_plan = {'path': file_path, 'nb_text_tokens': markdown_tree.count_tokens(0, len(markdown_tree.lines)), 'nb_chunks': len(chunks),
+                 'nb_questions': 0, 'nb_extraction_calls': 0, 'nb_answering_calls': 0, 'nb_batch_answering_calls': 0,
+                 'input_tokens': 0, 'output_tokens': 0, 'extraction_tokens': 0, 'answering_tokens': 0, 'batch_answering_tokens': 0, 'cost': 0.0}
+    for _, chunk_text in chunks:
+        max_questions = max(0, max_qa_pairs - file_plan['nb_questions'])
+        chunk_plan = plan_chunk(count_tokens_text(chunk_text, store=False), batch_answering, max_questions_per_batch, max_questions)
+        for key, value in chunk_plan.items():
+            file_plan[key] += value
+    for key in ['input_tokens', 'output_tokens', 'extraction_tokens', 'answering_tokens', 'batch_answering_tokens']:
+        file_plan[key] = round(file_plan[key])
+    return file_plan
+
+
+def compute_cost(input_tokens, output_tokens, model=None):
+    """
+    Returns the price, in dollars, of a number of input and output tokens for a model (defaults to `models.default_model`).
+    """
+    prices = get_model(model)['prices']
+    return (input_tokens * prices['input'] + output_tokens * prices['output']) / 1000
+
+
+def get_total_rate_limits(api_keys, model=None):
+    """
+    Returns the requests and tokens per minute usable across all API keys (each key has its own limiter, see `rate_limiting.py`).
+    """
+    model = model or models.default_model
+    total_limits = {'requests_per_minute': 0.0, 'tokens_per_minute': 0.0}
+    for api_key in set(api_keys):
+        limits = get_rate_limits(model, api_key)
+        for key in total_limits:
+            total_limits[key] += limits[key] * rate_limit_usage_ratio
+    return total_limits
+
+
+def estimate_minimum_wall_time(nb_calls, nb_tokens, rate_limits):
+    """
+    Returns the minimum number of seconds needed to run the calls within the rate limits,
+    the buckets starting full (one minute worth of burst).
+    """
+    minutes_for_requests = nb_calls / rate_limits['requests_per_minute'] - 1
+    minutes_for_tokens = nb_tokens / rate_limits['tokens_per_minute'] - 1
+    return 60 * max(0.0, minutes_for_requests, minutes_for_tokens)
+
+#----------------------------------------------------------------------------------------
+# PLANNING
+
+def plan_directory(input_folder, api_keys=('',), batch_answering=True, max_questions_per_batch=10, max_qa_pairs=300,
+                   include_patterns=('*.md',), exclude_patterns=(), max_workers=None):
+    """
+    Predicts the calls, tokens, cost and minimum wall time needed to process all markdown files in a folder.
+    Files are tokenized in parallel, on all cores, and the model is never called.
+
+    Args:
+        input_folder (str): A path to a folder containing markdown files.
+        api_keys (list of str): The API keys that will be used, each of which has its own rate limits.
+        batch_answering (bool): Whether questions are answered in batches.
+        max_questions_per_batch (int): The maximum number of questions per batch.
+        max_qa_pairs (int): The maximum number of questions kept per file.
+        include_patterns (tuple of str): Glob patterns of the files to process.
+        exclude_patterns (tuple of str): Glob patterns of the files and folders to skip.
+        max_workers (int): The number of processes used, defaults to `planning_max_workers` (all cores).
+
+    Returns:
+        dict: The 'totals' of the run and the plan of each file ('files'), most expensive first.
+    """
+    file_paths = [markdown_file.path for markdown_file in scan_markdown_files(input_folder, include_patterns=include_patterns, exclude_patterns=exclude_patterns)]
+    max_workers = max_workers or planning_max_workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        file_plans = list(executor.map(plan_file, file_paths, [batch_answering] * len(file_paths), [max_questions_per_batch] * len(file_paths),
+                                       [max_qa_pairs] * len(file_paths), chunksize=planning_chunksize))
+    file_plans.sort(key=lambda file_plan: file_plan['cost'], reverse=True)
+
+    totals = {'nb_files': len(file_plans)}
+    for key in ['nb_text_tokens', 'nb_chunks', 'nb_questions', 'nb_extraction_calls', 'nb_answering_calls', 'nb_batch_answering_calls',
+                'input_tokens', 'output_tokens', 'extraction_tokens', 'answering_tokens', 'batch_answering_tokens', 'cost']:
+        totals[key] = sum(file_plan[key] for file_plan in file_plans)
+
+    # Each model has its own rate limits, the run lasts as long as its slowest model
+    model_usages = {}
+    stage_calls = {'extraction': totals['nb_extraction_calls'], 'batch_answering': totals['nb_batch_answering_calls'],
+                   'answering': totals['nb_answering_calls'] - totals['nb_batch_answering_calls']}
+    for stage, nb_calls in stage_calls.items():
+        nb_model_calls, nb_model_tokens = model_usages.get(get_stage_model(stage), (0, 0))
+        model_usages[get_stage_model(stage)] = (nb_model_calls + nb_calls, nb_model_tokens + totals[f"{stage}_tokens"])
+    totals['minimum_wall_time_seconds'] = max(estimate_minimum_wall_time(nb_calls, nb_tokens, get_total_rate_limits(api_keys, model=model))
+                                              for model, (nb_calls, nb_tokens) in model_usages.items())
+    return {'totals': totals, 'files': file_plans}
+
+
+def write_breakdown(plan, output_path):
+    """
+    Writes the per-file plan as a CSV file, most expensive files first.
+    """
+    with open(output_path, 'w', newline='', encoding='utf-8') as output_file:
+        writer = csv.DictWriter(output_file, fieldnames=list(plan['files'][0].keys()) if len(plan['files']) > 0 else ['path'])
+        writer.writeheader()
+        writer.writerows(plan['files'])
+
+
+def print_plan(plan, nb_top_files=10):
+    """
+    Prints the totals of a plan and its most expensive files.
+    """
+    totals = plan['totals']
+    wall_time = totals['minimum_wall_time_seconds']
+    print(f"Plan: {totals['nb_files']} files, {totals['nb_text_tokens']} text tokens, {totals['nb_chunks']} chunks, about {totals['nb_questions']} questions.")
+    print(f"Models: {get_stage_model('extraction')} (extraction), {get_stage_model('answering')} (answering), {get_stage_model('batch_answering')} (batch answering).")
+    print(f"Calls: {totals['nb_extraction_calls']} extraction + {totals['nb_answering_calls']} answering, "
+          f"tokens: {totals['input_tokens']} input + {totals['output_tokens']} output, cost: ${totals['cost']:.2f}.")
+    print(f"Minimum wall time given the rate limits: {math.ceil(wall_time / 60)} minutes.")
+    if len(plan['files']) > 0:
+        print("Most expensive files:")
+        for file_plan in plan['files'][:nb_top_files]:
+            print(f"  ${file_plan['cost']:.3f} {file_plan['nb_chunks']} chunks, {file_plan['nb_extraction_calls'] + file_plan['nb_answering_calls']} calls: '{file_plan['path']}'")
+
@@ -1,5 +1,3 @@
-from langchain.schema import HumanMessage, SystemMessage
-
 #----------------------------------------------------------------------------------------
 # EXTRACTION
 
@@ -17,10 +15,10 @@ def create_extraction_conversation_messages(text):
         list: A list of messages that set up the context for extracting questions.
     """
     # Create a system message setting the context for the extraction task
-    context_message = SystemMessage(content=extraction_system_prompt)
+    context_message = {'role': 'system', 'content': extraction_system_prompt}
     
     # Create a human message containing the input text
-    input_text_message = HumanMessage(content=text)
+    input_text_message = {'role': 'user', 'content': text}
     
     # Return the list of messages to be used in the extraction conversation
     return [context_message, input_text_message]
@@ -45,13 +43,51 @@ def create_answering_conversation_messages(question, text):
         list: A list of messages that set up the context for answering the question.
     """
     # Create a system message setting the context for the answering task
-    context_message = SystemMessage(content=answering_system_prompt)
+    context_message = {'role': 'system', 'content': answering_system_prompt}
     
     # Create a human message containing the input text
-    input_text_message = HumanMessage(content=text)
+    input_text_message = {'role': 'user', 'content': text}
     
     # Create a human message containing the question to be answered
-    input_question_message = HumanMessage(content=question)
+    input_question_message = {'role': 'user', 'content': question}
     
     # Return the list of messages to be used in the answering conversation
     return [context_message, input_text_message, input_question_message]
+
+
+#----------------------------------------------------------------------------------------
+# BATCH ANSWERING
+
+# prompt used to answer several questions about the same text in a single call
+batch_answering_system_prompt="You are an expert user answering questions. You will be passed a page extracted from a documentation and a numbered list of questions. Generate a comprehensive and informative answer to each question based *solely* on the given text. Reply with a JSON array containing one object per question, of the form {\"id\": <question number>, \"answer\": \"<answer>\"}, and nothing else."
+
+
+def format_numbered_questions(questions):
+    """
+    Takes a list of questions and returns them as a numbered list (starting at 1), one question per line.
+    """
+    return '\n'.join(f"{index}. {question}" for index, question in enumerate(questions, start=1))
+
+
+def create_batch_answering_conversation_messages(questions, text):
+    """
+    Takes several questions and a text and returns a list of messages designed to answer all questions based on the text.
+    
+    Args:
+        questions (list of str): The questions to be answered.
+        text (str): The text containing information for answering the questions.
+    
+    Returns:
+        list: A list of messages that set up the context for answering the questions.
+    """
+    # Create a system message setting the context for the batch answering task
+    context_message = {'role': 'system', 'content': batch_answering_system_prompt}
+    
+    # Create a human message containing the input text
+    input_text_message = {'role': 'user', 'content': text}
+    
+    # Create a human message containing the numbered questions to be answered
+    input_questions_message = {'role': 'user', 'content': format_numbered_questions(questions)}
+    
+    # Return the list of messages to be used in the batch answering conversation
+    return [context_message, input_text_message, input_questions_message]
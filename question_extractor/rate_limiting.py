@@ -0,0 +1,171 @@
+import time
+import heapq
+import asyncio
+import itertools
+from .models import get_model
+
+#----------------------------------------------------------------------------------------
+# CONFIGURATION
+
+# the rate limits of each model, as documented on the provider's account page, are set in `models.py`
+
+# per API key overrides of the model rate limits: {api_key: {model: limits}}
+api_key_rate_limits = {}
+
+# fraction of the rate limits we allow ourselves to use
+rate_limit_usage_ratio = 0.95
+
+#----------------------------------------------------------------------------------------
+# TOKEN BUCKET
+
+class TokenBucket:
+    """
+    A bucket that holds at most `capacity` units and refills continuously at `capacity` units per `period` seconds.
+    """
+
+    def __init__(self, capacity, period=60.0):
+        self.capacity = capacity
+        self.refill_rate = capacity / period
+        self.level = capacity
+        self.last_refill = time.monotonic()
+
+    def refill(self):
+        """
+        Adds the units accumulated since the last refill, up to the capacity of the bucket.
+        """
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.last_refill) * self.refill_rate)
+        self.last_refill = now
+
+    def time_until_available(self, amount):
+        """
+        Returns the number of seconds to wait before `amount` units can be taken from the bucket.
+        Amounts larger than the capacity only wait for a full bucket (otherwise they would never be admitted).
+        """
+        self.refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.refill_rate)
+
+    def consume(self, amount):
+        """
+        Takes `amount` units from the bucket, the level can go negative to account for debts.
+        """
+        self.refill()
+        self.level -= amount
+
+    def refund(self, amount):
+        """
+        Gives back `amount` units to the bucket.
+        """
+        self.refill()
+        self.level = min(self.capacity, self.level + amount)
+
+#----------------------------------------------------------------------------------------
+# RATE LIMITER
+
+class RateLimiter:
+    """
+    Dual token bucket limiting both the number of requests and the number of tokens per minute.
+    Waiting requests are admitted one at a time, by increasing priority then in arrival order,
+    so that large requests cannot be starved by smaller ones of the same priority.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_bucket = TokenBucket(requests_per_minute)
+        self.tokens_bucket = TokenBucket(tokens_per_minute)
+        # heap of [priority, arrival number, wake-up future] entries, the first entry is the next request admitted
+        self.waiters = []
+        self.arrival_numbers = itertools.count()
+
+    def wake_up_head(self):
+        """
+        Wakes the first waiting request up so that it checks whether it can be admitted.
+        """
+        if (len(self.waiters) > 0) and (not self.waiters[0][2].done()):
+            self.waiters[0][2].set_result(None)
+
+    async def acquire(self, num_tokens, priority=()):
+        """
+        Waits until the request is the next to be admitted and one request and `num_tokens` tokens are available, then consumes them.
+
+        Args:
+            num_tokens (int): The number of tokens reserved for the call (prompt plus maximum completion).
+            priority (tuple): The priority of the call, lower priorities are admitted first (see `scheduling.py`).
+        """
+        loop = asyncio.get_running_loop()
+        entry = [priority, next(self.arrival_numbers), loop.create_future()]
+        previous_head = self.waiters[0] if len(self.waiters) > 0 else None
+        heapq.heappush(self.waiters, entry)
+        # A request that overtakes the head makes it go back to waiting
+        if (previous_head is not None) and (self.waiters[0] is entry) and (not previous_head[2].done()):
+            previous_head[2].set_result(None)
+        try:
+            while True:
+                waiting_time = None
+                if self.waiters[0] is entry:
+                    waiting_time = max(self.requests_bucket.time_until_available(1),
+                                       self.tokens_bucket.time_until_available(num_tokens))
+                    if waiting_time <= 0:
+                        break
+                # Sleep until the tokens are available, or until woken up by a change of head
+                if entry[2].done():
+                    entry[2] = loop.create_future()
+                await asyncio.wait([entry[2]], timeout=waiting_time)
+        except BaseException:
+            # The call was cancelled while waiting
+            self.waiters.remove(entry)
+            heapq.heapify(self.waiters)
+            self.wake_up_head()
+            raise
+        heapq.heappop(self.waiters)
+        self.requests_bucket.consume(1)
+        self.tokens_bucket.consume(num_tokens)
+        self.wake_up_head()
+
+    def refund(self, reserved_tokens, used_tokens):
+        """
+        Settles a reservation once the real usage is known, giving back unused tokens
+        (or consuming the excess if the call used more tokens than reserved).
+
+        Args:
+            reserved_tokens (int): The number of tokens reserved with `acquire`.
+            used_tokens (int): The number of tokens actually used by the call.
+        """
+        unused_tokens = reserved_tokens - used_tokens
+        if unused_tokens > 0:
+            self.tokens_bucket.refund(unused_tokens)
+            # the next request might now be admitted earlier than it expected
+            self.wake_up_head()
+        elif unused_tokens < 0:
+            self.tokens_bucket.consume(-unused_tokens)
+
+
+# one limiter per (model, api_key) pair, built on first use
+rate_limiters = {}
+
+
+def get_rate_limits(model, api_key):
+    """
+    Returns the requests and tokens per minute allowed for a model and API key (the per key override if there is one).
+    """
+    return api_key_rate_limits.get(api_key, {}).get(model, get_model(model)['rate_limits'])
+
+
+def get_rate_limiter(model, api_key):
+    """
+    Returns the rate limiter associated with a given model and API key, creating it if needed.
+
+    Args:
+        model (str): The name of the model being called.
+        api_key (str): The API key used for the call.
+
+    Returns:
+        RateLimiter: The limiter shared by all calls using this model and key.
+    """
+    limiter = rate_limiters.get((model, api_key))
+    if limiter is None:
+        limits = get_rate_limits(model, api_key)
+        limiter = RateLimiter(requests_per_minute=limits['requests_per_minute'] * rate_limit_usage_ratio,
+                              tokens_per_minute=limits['tokens_per_minute'] * rate_limit_usage_ratio)
+        rate_limiters[(model, api_key)] = limiter
+    return limiter
@@ -0,0 +1,282 @@
+import json
+import time
+import random
+import asyncio
+from collections import deque
+from pathlib import Path
+
+#----------------------------------------------------------------------------------------
+# CONFIGURATION
+
+# number of attempts made for a call before it is given up and sent to the dead-letter list
+max_attempts = 8
+
+# exponential backoff between attempts (with full jitter), used when the server does not send a `Retry-After`
+retry_min_wait = 1.0
+retry_max_wait = 60.0
+
+# concurrency is adjusted between these bounds: increased by one call per round of successful calls (additive increase),
+# halved when calls are rate limited or time out (multiplicative decrease)
+initial_concurrency = 64
+min_concurrency = 1
+concurrency_decrease_factor = 0.5
+
+# concurrency stops increasing while the mean latency is this many times above the lowest mean latency observed
+# (requests are queuing on the server side)
+latency_slowdown_ratio = 2.0
+latency_smoothing = 0.05
+
+# number of consecutive failures (connection errors, 5xx) after which the circuit breaker of an endpoint opens,
+# and seconds during which calls to an open endpoint are failed immediately before a single trial call is let through
+circuit_breaker_threshold = 20
+circuit_breaker_cooldown = 30.0
+
+# calls that failed after `max_attempts` attempts (or with an error that retrying cannot fix) are listed in this file,
+# their results are missing from the manifest so that they are retried on the next run
+dead_letters_path = Path('./data/dead_letters.jsonl')
+
+#----------------------------------------------------------------------------------------
+# BACKOFF
+
+def get_retry_delay(attempt, retry_after=None):
+    """
+    Returns the number of seconds to wait before the next attempt of a call.
+
+    Args:
+        attempt (int): The number of attempts made so far.
+        retry_after (float): The delay requested by the server (`Retry-After` header), if any.
+
+    Returns:
+        float: The delay, the requested delay (plus a little jitter so that waiting calls do not all come back at once) if there is one,
+            a random delay under an exponentially increasing bound otherwise.
+    """
+    if retry_after is not None:
+        return retry_after + random.uniform(0, retry_min_wait)
+    return random.uniform(retry_min_wait, min(retry_max_wait, retry_min_wait * 2 ** attempt))
+
+#----------------------------------------------------------------------------------------
+# ADAPTIVE CONCURRENCY
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limits the number of calls in flight, adjusting the limit with an additive-increase/multiplicative-decrease controller:
+    the limit grows by one for each round of `limit` successful calls (doubling instead until the first congestion), as long as latency is stable,
+    and is cut by `concurrency_decrease_factor` when a call is rate limited or times out.
+    Only calls started after the last decrease can trigger a new one, so that a burst of failures counts as one congestion signal.
+
+    Args:
+        max_concurrency (int): The maximum number of calls in flight.
+        initial (int): The initial limit, defaults to `initial_concurrency`.
+    """
+
+    def __init__(self, max_concurrency, initial=None):
+        self.max_concurrency = max_concurrency
+        self.limit = float(min(max_concurrency, initial or initial_concurrency))
+        self.nb_in_flight = 0
+        self.waiters = deque()
+        self.last_decrease = None
+        self.mean_latencies = {}  # stage -> mean latency
+        self.lowest_mean_latencies = {}  # stage -> lowest mean latency
+
+    async def acquire(self):
+        """
+        Asynchronously waits for a free slot.
+
+        Returns:
+            float: The time the call started, to be passed to `release`.
+        """
+        while self.nb_in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Passes the wake up on to the next waiter
+                if waiter.done() and not waiter.cancelled():
+                    self.wake_up()
+                raise
+        self.nb_in_flight += 1
+        return time.monotonic()
+
+    def wake_up(self):
+        """
+        Wakes up as many waiters as there are free slots.
+        """
+        nb_free_slots = int(self.limit) - self.nb_in_flight
+        while (nb_free_slots > 0) and (len(self.waiters) > 0):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                nb_free_slots -= 1
+
+    def release(self, start_time, outcome, stage=None):
+        """
+        Frees the slot of a call and adjusts the limit to its outcome.
+
+        Args:
+            start_time (float): The value returned by `acquire`.
+            outcome (str): 'success', 'congestion' (rate limited or timed out) or 'failure' (any other error, which does not change the limit).
+            stage (str): The pipeline stage of the call, latencies are compared between calls of the same stage.
+        """
+        self.nb_in_flight -= 1
+        if outcome == 'success':
+            latency = time.monotonic() - start_time
+            mean_latency = self.mean_latencies.get(stage, latency)
+            mean_latency = (1 - latency_smoothing) * mean_latency + latency_smoothing * latency
+            self.mean_latencies[stage] = mean_latency
+            self.lowest_mean_latencies[stage] = min(self.lowest_mean_latencies.get(stage, mean_latency), mean_latency)
+            if mean_latency <= latency_slowdown_ratio * self.lowest_mean_latencies[stage]:
+                # Until the first congestion, the limit doubles with each round of calls (slow start)
+                increase = 1.0 if self.last_decrease is None else 1.0 / self.limit
+                self.limit = min(self.max_concurrency, self.limit + increase)
+        elif (outcome == 'congestion') and ((self.last_decrease is None) or (start_time >= self.last_decrease)):
+            self.limit = max(min_concurrency, self.limit * concurrency_decrease_factor)
+            self.last_decrease = time.monotonic()
+        self.wake_up()
+
+#----------------------------------------------------------------------------------------
+# CIRCUIT BREAKER
+
+class CircuitOpenError(Exception):
+    """
+    The call was not made because the circuit breaker of its endpoint is open.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Stops calling an endpoint that keeps failing: after `circuit_breaker_threshold` consecutive failures the circuit opens
+    and calls fail immediately for `circuit_breaker_cooldown` seconds, then a single trial call is let through (half-open),
+    closing the circuit if it succeeds and opening it again otherwise.
+    Failed calls wait for the end of the cooldown, or for the result of the trial call, with `wait_for_recovery`.
+
+    Args:
+        name (str): The name of the endpoint, used in messages.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.nb_consecutive_failures = 0
+        self.opened_at = None
+        self.is_trial_in_flight = False
+        self.trial_result = None  # future set to True if the trial call failed, False otherwise
+
+    def check(self):
+        """
+        Raises a `CircuitOpenError` if calls to the endpoint should not be made.
+
+        Returns:
+            bool: True if the call is the trial call of a half-open circuit.
+        """
+        if self.opened_at is None:
+            return False
+        remaining_cooldown = self.opened_at + circuit_breaker_cooldown - time.monotonic()
+        if (remaining_cooldown > 0) or self.is_trial_in_flight:
+            raise CircuitOpenError(f"Circuit open for endpoint '{self.name}'.", retry_after=max(remaining_cooldown, 0.0))
+        self.is_trial_in_flight = True
+        self.trial_result = asyncio.get_running_loop().create_future()
+        return True
+
+    async def wait_for_recovery(self):
+        """
+        Asynchronously waits until a call to the endpoint can be attempted again: the end of the cooldown, or the end of the trial call in flight.
+
+        Returns:
+            bool: False if the trial call failed (the circuit opened again), True otherwise.
+        """
+        if self.is_trial_in_flight:
+            # Shielded, as all waiting calls share the future
+            has_failed = await asyncio.shield(self.trial_result)
+            return not has_failed
+        if self.opened_at is not None:
+            await asyncio.sleep(max(0.0, self.opened_at + circuit_breaker_cooldown - time.monotonic()))
+        return True
+
+    def end_trial(self, has_failed):
+        """
+        Marks the trial call, if any, as over and wakes up the calls waiting for its result.
+        """
+        self.is_trial_in_flight = False
+        if (self.trial_result is not None) and (not self.trial_result.done()):
+            self.trial_result.set_result(has_failed)
+
+    def record_success(self, is_trial=False):
+        self.nb_consecutive_failures = 0
+        if is_trial or (self.opened_at is not None):
+            print(f"WARNING: Endpoint '{self.name}' answers again, closing its circuit.")
+        self.opened_at = None
+        self.end_trial(has_failed=False)
+
+    def cancel_trial(self):
+        """
+        Lets another trial call through, the trial call having ended without showing whether the endpoint is up.
+        """
+        self.end_trial(has_failed=False)
+
+    def record_failure(self, is_trial=False):
+        self.nb_consecutive_failures += 1
+        if is_trial:
+            self.opened_at = time.monotonic()
+            self.end_trial(has_failed=True)
+        elif (self.opened_at is None) and (self.nb_consecutive_failures >= circuit_breaker_threshold):
+            print(f"WARNING: {self.nb_consecutive_failures} consecutive failures on endpoint '{self.name}', pausing calls for {circuit_breaker_cooldown:.0f}s.")
+            self.opened_at = time.monotonic()
+
+
+# circuit breaker of each endpoint, created on first use
+circuit_breakers = {}
+
+
+def get_circuit_breaker(endpoint):
+    """
+    Returns the circuit breaker associated with an endpoint, creating it if needed.
+    """
+    if endpoint not in circuit_breakers:
+        circuit_breakers[endpoint] = CircuitBreaker(endpoint)
+    return circuit_breakers[endpoint]
+
+#----------------------------------------------------------------------------------------
+# DEAD LETTERS
+
+# calls given up during the run
+dead_letters = []
+
+
+def record_dead_letter(stage, messages, error, nb_attempts):
+    """
+    Adds a call that was given up to the dead-letter list, and appends it to `dead_letters_path`.
+
+    Args:
+        stage (str): The pipeline stage making the call.
+        messages (list of dict): The input messages of the call.
+        error (Exception): The last error encountered.
+        nb_attempts (int): The number of attempts made.
+    """
+    dead_letter = {'stage': stage, 'error': f"{type(error).__name__}: {error}", 'nb_attempts': nb_attempts, 'time': time.time(), 'messages': messages}
+    dead_letters.append(dead_letter)
+    dead_letters_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(dead_letters_path, 'a', encoding='utf-8') as output_file:
+        output_file.write(json.dumps(dead_letter, ensure_ascii=False) + '\n')
+
+
+def read_dead_letters(path=None):
+    """
+    Returns the calls listed in a dead-letter file (defaults to `dead_letters_path`).
+    """
+    path = Path(path or dead_letters_path)
+    if not path.is_file():
+        return []
+    with open(path, 'r', encoding='utf-8') as input_file:
+        return [json.loads(line) for line in input_file if len(line.strip()) > 0]
+
+
+def clear_dead_letters():
+    """
+    Empties the dead-letter file, at the start of a run that will retry its calls.
+    """
+    dead_letters.clear()
+    dead_letters_path.unlink(missing_ok=True)
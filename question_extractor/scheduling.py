@@ -0,0 +1,46 @@
+import itertools
+import contextvars
+
+#----------------------------------------------------------------------------------------
+# CONFIGURATION
+
+# order in which calls waiting for the rate limiters are admitted:
+# 'priority' admits answers before extractions, then the calls of the oldest file first, then the smallest calls first
+# 'fifo' admits calls in arrival order
+scheduling_policy = 'priority'
+
+# priority class of each stage of the pipeline, lower is admitted first
+# (answering lets files finish, extracting starts new work)
+stage_priorities = {'answering': 0, 'batch_answering': 0, 'extraction': 1}
+
+#----------------------------------------------------------------------------------------
+# PRIORITIES
+
+# rank of the file being processed by the current task, in the order files were started
+# (inherited by the tasks created while processing the file)
+current_file_rank = contextvars.ContextVar('current_file_rank', default=0)
+file_ranks = itertools.count()
+
+
+def start_file():
+    """
+    Gives the file processed by the current task (and the tasks it creates) the next rank.
+    Calls of files started earlier are admitted first, so that files are completed in the order they were started.
+    """
+    current_file_rank.set(next(file_ranks))
+
+
+def get_priority(stage, estimated_tokens):
+    """
+    Returns the priority of a call, calls with lower priorities are admitted first by the rate limiters.
+
+    Args:
+        stage (str): The pipeline stage making the call.
+        estimated_tokens (int): The number of tokens reserved for the call.
+
+    Returns:
+        tuple: The priority of the call, empty with the 'fifo' policy.
+    """
+    if scheduling_policy == 'fifo':
+        return ()
+    return (stage_priorities.get(stage, max(stage_priorities.values())), current_file_rank.get(), estimated_tokens)
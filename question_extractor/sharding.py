@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import socket
+import hashlib
+import threading
+import multiprocessing
+from pathlib import Path
+from .output import NormalizedWriter, read_jsonl, chunks_filename, questions_filename
+
+#----------------------------------------------------------------------------------------
+# CONFIGURATION
+
+# seconds between two updates of the claim of a shard being processed
+claim_heartbeat_interval = 30
+
+# seconds without update after which the claim of a shard is considered abandoned (its host crashed) and can be taken over
+claim_timeout = 300
+
+#----------------------------------------------------------------------------------------
+# SHARDS
+
+def get_shard_index(relative_path, nb_shards):
+    """
+    Returns the shard a file belongs to, computed from its path relative to the input folder
+    so that all hosts agree on it whatever the location of their copy of the corpus.
+
+    Args:
+        relative_path (str): The path of the file relative to the input folder, using '/' as a separator.
+        nb_shards (int): The total number of shards.
+
+    Returns:
+        int: The index of the shard, in [0, nb_shards).
+    """
+    digest = hashlib.sha256(relative_path.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % nb_shards
+
+
+def get_shard_folder(shared_folder, shard_index, nb_shards):
+    """
+    Returns the folder holding the state, output and markers of a shard.
+    """
+    return Path(shared_folder) / f"shard-{shard_index:04d}-of-{nb_shards:04d}"
+
+
+def is_shard_done(shard_folder):
+    """
+    Returns True if the shard was fully processed.
+    """
+    return (Path(shard_folder) / 'done.json').is_file()
+
+#----------------------------------------------------------------------------------------
+# CLAIMS
+
+def write_claim(claim_file):
+    """
+    Writes the host, process and time of a claim to an open file.
+    """
+    json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}, claim_file)
+
+
+def claim_shard(shard_folder):
+    """
+    Tries to claim a shard for this host, atomically (the claim file is created exclusively, which works on shared drives).
+    Claims that have not been updated for `claim_timeout` seconds are taken over.
+
+    Returns:
+        bool: True if the shard was claimed.
+    """
+    shard_folder = Path(shard_folder)
+    shard_folder.mkdir(parents=True, exist_ok=True)
+    claim_path = shard_folder / 'claim.json'
+    if is_shard_done(shard_folder):
+        return False
+
+    try:
+        file_descriptor = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return take_over_abandoned_claim(shard_folder, claim_path)
+    with os.fdopen(file_descriptor, 'w') as claim_file:
+        write_claim(claim_file)
+    return True
+
+
+def take_over_abandoned_claim(shard_folder, claim_path):
+    """
+    Replaces the claim of a shard if it has not been updated for `claim_timeout` seconds (its host crashed).
+    Hosts seeing the same abandoned claim race to create a lease file named after its last update, exclusively:
+    a single host wins, and a claim refreshed or replaced in the meantime has another name and cannot be taken over by mistake.
+
+    Returns:
+        bool: True if the shard was claimed.
+    """
+    try:
+        last_update = claim_path.stat().st_mtime_ns
+    except FileNotFoundError:
+        # The claim was released in the meantime, the shard is claimed on the next attempt
+        return False
+    if time.time() - last_update / 1e9 <= claim_timeout:
+        return False
+
+    try:
+        os.close(os.open(shard_folder / f"takeover.{last_update}.lock", os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return False
+    print(f"WARNING: Taking over the abandoned shard '{shard_folder}'.")
+    # The new claim replaces the abandoned one in a single step
+    temporary_path = shard_folder / f"claim.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(temporary_path, 'w', encoding='utf-8') as claim_file:
+        write_claim(claim_file)
+    os.replace(temporary_path, claim_path)
+    return True
+
+
+def keep_claims_alive(claim_paths, stop_event):
+    """
+    Updates the modification time of the claims currently held, until `stop_event` is set.
+    """
+    while not stop_event.wait(claim_heartbeat_interval):
+        for claim_path in list(claim_paths):
+            try:
+                os.utime(claim_path)
+            except OSError:
+                pass
+
+#----------------------------------------------------------------------------------------
+# EXECUTION
+
+def run_shard(input_folder, shard_folder, shard_index, nb_shards, rate_limit_share=1.0, verbose=True):
+    """
+    Processes the files of a shard, in the current process, writing its question/answer pairs to `questions.jsonl` in the shard folder
+    (and to a `normalized` output folder, see `output.py`).
+    The state of the shard (manifest, journal, dead letters) is kept in its folder, a shard can thus be resumed by any host.
+
+    Args:
+        input_folder (str): A path to a folder containing markdown files.
+        shard_folder (str): The folder of the shard.
+        shard_index (int): The index of the shard.
+        nb_shards (int): The total number of shards.
+        rate_limit_share (float): The fraction of the rate limits this process can use.
+        verbose (bool): If True, print progress information. Default is True.
+    """
+    import question_extractor
+    from question_extractor import state, rate_limiting, instrumentation, retrying
+
+    shard_folder = Path(shard_folder)
+    state.state_folder = shard_folder / 'state'
+    retrying.dead_letters_path = shard_folder / 'dead_letters.jsonl'
+    instrumentation.metrics_folder = shard_folder / 'metrics'
+    rate_limiting.rate_limit_usage_ratio *= rate_limit_share
+
+    # Records of completed files are served again from the manifest, the output is rewritten from scratch
+    output_path = shard_folder / 'questions.jsonl'
+    file_filter = lambda markdown_file: get_shard_index(markdown_file.relative_path, nb_shards) == shard_index
+    nb_records = question_extractor.stream_questions_from_directory(input_folder, output_path, verbose=verbose, file_filter=file_filter)
+    question_extractor.export_normalized_output(shard_folder / 'normalized', verbose=False)
+
+    # A shard with failed calls is not done: it is resumed (retrying only those calls) on the next run
+    if len(retrying.dead_letters) > 0:
+        return
+
+    with open(shard_folder / 'done.json', 'w', encoding='utf-8') as done_file:
+        json.dump({'host': socket.gethostname(), 'nb_records': nb_records, 'time': time.time()}, done_file)
+
+
+def run_sharded(input_folder, shared_folder, nb_shards, nb_workers, total_nb_workers=None, verbose=True):
+    """
+    Processes the shards of a corpus with `nb_workers` processes on this host, each process handling one shard at a time.
+    Several hosts can run this function on the same shared folder, each shard being claimed by a single host.
+
+    Args:
+        input_folder (str): A path to a folder containing markdown files.
+        shared_folder (str): A folder, visible by all hosts, where the state and outputs of the shards are kept.
+        nb_shards (int): The total number of shards (identical on all hosts).
+        nb_workers (int): The number of processes running on this host.
+        total_nb_workers (int): The number of processes running on all hosts, each gets an equal share of the rate limits.
+            Defaults to `nb_workers` (a single host).
+        verbose (bool): If True, print progress information. Default is True.
+
+    Returns:
+        bool: True if all shards are done (some might still be processed by other hosts otherwise).
+    """
+    rate_limit_share = 1.0 / (total_nb_workers or nb_workers)
+    # processes are started from scratch, rather than forked from a process that might hold an event loop
+    context = multiprocessing.get_context('spawn')
+    running = {}  # shard index -> (process, claim path)
+    claim_paths = []
+    stop_event = threading.Event()
+    threading.Thread(target=keep_claims_alive, args=(claim_paths, stop_event), daemon=True).start()
+
+    try:
+        pending_shards = list(range(nb_shards))
+        while (len(pending_shards) > 0) or (len(running) > 0):
+            # Start a process on each shard that can be claimed, while there are free workers
+            for shard_index in list(pending_shards):
+                if len(running) >= nb_workers:
+                    break
+                shard_folder = get_shard_folder(shared_folder, shard_index, nb_shards)
+                if is_shard_done(shard_folder):
+                    pending_shards.remove(shard_index)
+                elif claim_shard(shard_folder):
+                    pending_shards.remove(shard_index)
+                    process = context.Process(target=run_shard, args=(str(input_folder), str(shard_folder), shard_index, nb_shards, rate_limit_share, verbose))
+                    process.start()
+                    running[shard_index] = (process, shard_folder / 'claim.json')
+                    claim_paths.append(shard_folder / 'claim.json')
+                    if verbose: print(f"Shard {shard_index + 1}/{nb_shards} started (pid {process.pid}).")
+
+            # Release the claims of finished processes (a failed shard can then be resumed by any host)
+            for shard_index, (process, claim_path) in list(running.items()):
+                if not process.is_alive():
+                    del running[shard_index]
+                    claim_paths.remove(claim_path)
+                    claim_path.unlink(missing_ok=True)
+                    if process.exitcode != 0:
+                        print(f"ERROR: Shard {shard_index + 1}/{nb_shards} failed (exit code {process.exitcode}), it will be resumed on the next run.")
+                    elif not is_shard_done(get_shard_folder(shared_folder, shard_index, nb_shards)):
+                        print(f"WARNING: Shard {shard_index + 1}/{nb_shards} finished with failed calls, they will be retried on the next run.")
+                    elif verbose:
+                        print(f"Shard {shard_index + 1}/{nb_shards} done.")
+
+            # Shards claimed by other hosts are checked again until they are done or abandoned
+            time.sleep(0.5 if len(running) > 0 else 5)
+    finally:
+        stop_event.set()
+        for process, claim_path in running.values():
+            process.terminate()
+            claim_path.unlink(missing_ok=True)
+
+    return all(is_shard_done(get_shard_folder(shared_folder, shard_index, nb_shards)) for shard_index in range(nb_shards))
+
+#----------------------------------------------------------------------------------------
+# MERGING
+
+def merge_shards(shared_folder, nb_shards, output_path):
+    """
+    Combines the outputs of all shards into a single JSON list of `{source, question, answer}` records,
+    identical in format to the one written by `question_extractor.py`. Records are streamed, not held in memory.
+
+    Args:
+        shared_folder (str): The folder where the shards were processed.
+        nb_shards (int): The total number of shards.
+        output_path (str): The path of the JSON file to write.
+
+    Returns:
+        int: The number of records written.
+    """
+    missing_shards = [shard_index for shard_index in range(nb_shards) if not is_shard_done(get_shard_folder(shared_folder, shard_index, nb_shards))]
+    if len(missing_shards) > 0:
+        raise RuntimeError(f"Cannot merge: {len(missing_shards)}/{nb_shards} shards are not done (such as shard {missing_shards[0] + 1}).")
+
+    nb_records = 0
+    with open(output_path, 'w', encoding='utf-8') as output_file:
+        output_file.write('[')
+        for shard_index in range(nb_shards):
+            shard_output_path = get_shard_folder(shared_folder, shard_index, nb_shards) / 'questions.jsonl'
+            with open(shard_output_path, 'r', encoding='utf-8') as input_file:
+                for line in input_file:
+                    if len(line.strip()) == 0:
+                        continue
+                    # indents the record as `json.dump(records, indent=4)` would
+                    record = json.dumps(json.loads(line), indent=4).replace('\n', '\n    ')
+                    output_file.write((',\n    ' if nb_records > 0 else '\n    ') + record)
+                    nb_records += 1
+        output_file.write('\n]' if nb_records > 0 else ']')
+    return nb_records
+
+
+def merge_normalized_shards(shared_folder, nb_shards, output_folder):
+    """
+    Combines the normalized outputs of all shards into a single normalized output folder (see `output.py`),
+    renumbering the chunks of each shard. Rows are streamed, only the chunk ids of the current shard are held in memory.
+
+    Args:
+        shared_folder (str): The folder where the shards were processed.
+        nb_shards (int): The total number of shards.
+        output_folder (str): The folder where the tables are written.
+
+    Returns:
+        int: The number of question/answer pairs written.
+    """
+    missing_shards = [shard_index for shard_index in range(nb_shards) if not is_shard_done(get_shard_folder(shared_folder, shard_index, nb_shards))]
+    if len(missing_shards) > 0:
+        raise RuntimeError(f"Cannot merge: {len(missing_shards)}/{nb_shards} shards are not done (such as shard {missing_shards[0] + 1}).")
+
+    with NormalizedWriter(output_folder) as writer:
+        for shard_index in range(nb_shards):
+            shard_output_folder = get_shard_folder(shared_folder, shard_index, nb_shards) / 'normalized'
+            chunk_ids = {}  # id in the shard -> id in the merged output
+            for chunk in read_jsonl(shard_output_folder / chunks_filename):
+                chunk_ids[chunk['id']] = writer.write_chunk(chunk['source'], chunk['text'])
+            for row in read_jsonl(shard_output_folder / questions_filename):
+                writer.write_qa_pair(chunk_ids[row['chunk']], row['question'], row['answer'])
+    return writer.nb_records
@@ -0,0 +1,411 @@
+import os
+import json
+import time
+import atexit
+import asyncio
+import sqlite3
+import hashlib
+from collections.abc import Mapping
+from pathlib import Path
+
+#----------------------------------------------------------------------------------------
+# CONFIGURATION
+
+# folder where the state of the runs is kept, separate from the input documents
+state_folder = Path('./data/state')
+
+# maximum number of seconds between two flushes of the journal to disk
+journal_flush_interval = 1.0
+
+# number of buffered journal records triggering an early flush
+journal_flush_size = 1000
+
+# minimum number of seconds between two checkpoints of the manifest during a run (changes are committed and the journal emptied),
+# bounding the size of the journal replayed when resuming a crashed run
+manifest_checkpoint_interval = 60.0
+
+#----------------------------------------------------------------------------------------
+# JOURNAL
+
+class Journal:
+    """
+    Append-only JSONL log of the changes made to the manifest since it was last saved.
+    Records are buffered in memory and written by a background task, in batches, with a fsync after each batch.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.buffer = []
+        self.writer_task = None
+        self.wakeup = None
+        self.closing = False
+        # Records still buffered when the process exits (Ctrl-C, uncaught exception) are written synchronously
+        atexit.register(self.flush_buffer)
+
+    def read(self):
+        """
+        Yields the records of the journal, skipping corrupted records.
+        A truncated last record (if the process died mid-write) is also cut from the file,
+        otherwise the next record appended would be glued to it and lost.
+        """
+        if not self.path.is_file():
+            return
+        complete_size = 0
+        with open(self.path, 'rb') as input_file:
+            for line in input_file:
+                if not line.endswith(b'\n'):
+                    print(f"WARNING: Skipping a truncated record at the end of '{self.path}'.")
+                    break
+                complete_size += len(line)
+                try:
+                    yield json.loads(line)
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    print(f"WARNING: Skipping a corrupted record in '{self.path}'.")
+        if complete_size < self.path.stat().st_size:
+            os.truncate(self.path, complete_size)
+
+    def append(self, record):
+        """
+        Buffers a record, it will be written to disk by the background writer.
+        """
+        self.buffer.append(record)
+        if self.writer_task is None:
+            self.closing = False
+            self.wakeup = asyncio.Event()
+            self.writer_task = asyncio.get_running_loop().create_task(self.run_writer())
+        elif len(self.buffer) >= journal_flush_size:
+            self.wakeup.set()
+
+    def write_records(self, records):
+        """
+        Appends records to the journal file, then forces them to disk.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as output_file:
+            output_file.write(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records))
+            output_file.flush()
+            os.fsync(output_file.fileno())
+
+    def flush_buffer(self):
+        """
+        Synchronously writes the buffered records.
+        """
+        records, self.buffer = self.buffer, []
+        if len(records) > 0:
+            self.write_records(records)
+
+    async def run_writer(self):
+        """
+        Writes buffered records every `journal_flush_interval` seconds (or earlier when the buffer is full),
+        in a thread so that disk writes do not block the event loop.
+        """
+        while not (self.closing and len(self.buffer) == 0):
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=journal_flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            records, self.buffer = self.buffer, []
+            if len(records) > 0:
+                await asyncio.to_thread(self.write_records, records)
+
+    async def close(self):
+        """
+        Asynchronously waits for all buffered records to be written, then stops the background writer.
+        """
+        if self.writer_task is not None:
+            self.closing = True
+            self.wakeup.set()
+            await self.writer_task
+            self.writer_task = None
+
+    def clear(self):
+        """
+        Empties the journal, once its content has been saved in the manifest.
+        """
+        self.buffer = []
+        if self.path.is_file():
+            os.remove(self.path)
+
+#----------------------------------------------------------------------------------------
+# MANIFEST
+
+def hash_text(text):
+    """
+    Returns the hexadecimal SHA-256 digest of a text, used to identify files and chunks by their content.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class FileTable(Mapping):
+    """
+    Read-only view of the files of a manifest, mapping a file path to `{'hash': file hash, 'chunks': [[chunk path, chunk hash], ...]}`.
+    Entries are read from the database on access, files are iterated in path order.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __getitem__(self, file_path):
+        row = self.connection.execute("SELECT hash FROM files WHERE path = ?", (file_path,)).fetchone()
+        if row is None:
+            raise KeyError(file_path)
+        chunks = self.connection.execute("SELECT chunk_path, chunk_hash FROM file_chunks WHERE path = ? ORDER BY position", (file_path,)).fetchall()
+        return {'hash': row[0], 'chunks': [list(chunk) for chunk in chunks]}
+
+    def __contains__(self, file_path):
+        return self.connection.execute("SELECT 1 FROM files WHERE path = ?", (file_path,)).fetchone() is not None
+
+    def __iter__(self):
+        return (row[0] for row in self.connection.execute("SELECT path FROM files ORDER BY path").fetchall())
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+
+class ChunkTable(Mapping):
+    """
+    Read-only view of the chunks of a manifest, mapping a chunk hash to `{'text': chunk text, 'questions': [question, ...], 'answers': [answer or None, ...]}`.
+    Entries are read from the database on access.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __getitem__(self, chunk_hash):
+        row = self.connection.execute("SELECT text FROM chunks WHERE hash = ?", (chunk_hash,)).fetchone()
+        if row is None:
+            raise KeyError(chunk_hash)
+        questions = self.connection.execute("SELECT question, answer FROM questions WHERE chunk = ? ORDER BY position", (chunk_hash,)).fetchall()
+        return {'text': row[0], 'questions': [question for question, _ in questions], 'answers': [answer for _, answer in questions]}
+
+    def __contains__(self, chunk_hash):
+        return self.connection.execute("SELECT 1 FROM chunks WHERE hash = ?", (chunk_hash,)).fetchone() is not None
+
+    def __iter__(self):
+        return (row[0] for row in self.connection.execute("SELECT hash FROM chunks").fetchall())
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+
+class Manifest:
+    """
+    Maps the content hash of each file, and of each chunk produced by splitting it, to their questions and answers.
+
+    The manifest is an SQLite database, read on demand (see `FileTable` and `ChunkTable` for the `files` and `chunks` views),
+    so that neither memory usage nor the time needed to resume a run grow with the size of the corpus.
+    Chunks are shared between files, so a moved file or a chunk copied in several files is only processed once.
+
+    Every change is written to the database, in a transaction committed by `save`, and appended to a journal which is replayed on load,
+    so that an interrupted run only loses the calls that were in flight.
+    """
+
+    def __init__(self, path, journal=None):
+        self.path = Path(path)
+        self.journal = journal
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # `save` runs in a thread, while the event loop is idle
+        self.connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, hash TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS file_chunks (path TEXT NOT NULL, position INTEGER NOT NULL, chunk_path TEXT NOT NULL, chunk_hash TEXT NOT NULL,
+                                                    PRIMARY KEY (path, position));
+            CREATE INDEX IF NOT EXISTS file_chunks_chunk_hash ON file_chunks (chunk_hash);
+            CREATE TABLE IF NOT EXISTS chunks (hash TEXT PRIMARY KEY, text TEXT);
+            CREATE TABLE IF NOT EXISTS questions (chunk TEXT NOT NULL, position INTEGER NOT NULL, question TEXT NOT NULL, answer TEXT,
+                                                  PRIMARY KEY (chunk, position));
+            CREATE TABLE IF NOT EXISTS representatives (chunk TEXT PRIMARY KEY, representative TEXT NOT NULL);""")
+        self.files = FileTable(self.connection)
+        self.chunks = ChunkTable(self.connection)
+        self.last_checkpoint = time.monotonic()
+
+        # Replay the changes made since the last save (those of a crashed run were rolled back by the database)
+        if self.journal is not None:
+            for record in self.journal.read():
+                self.apply(record)
+
+    def apply(self, record):
+        """
+        Applies a change, as stored in the journal, to the manifest.
+        The change is part of the transaction committed by the next `save`.
+        """
+        if not self.connection.in_transaction:
+            self.connection.execute("BEGIN")
+        if record['type'] == 'file':
+            self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?)", (record['path'], record['hash']))
+            self.connection.execute("DELETE FROM file_chunks WHERE path = ?", (record['path'],))
+            self.connection.executemany("INSERT INTO file_chunks VALUES (?, ?, ?, ?)",
+                                        [(record['path'], position, chunk_path, chunk_hash) for position, (chunk_path, chunk_hash) in enumerate(record['chunks'])])
+        elif record['type'] == 'questions':
+            self.connection.execute("INSERT OR REPLACE INTO chunks VALUES (?, ?)", (record['chunk'], record.get('text')))
+            self.connection.execute("DELETE FROM questions WHERE chunk = ?", (record['chunk'],))
+            self.connection.executemany("INSERT INTO questions VALUES (?, ?, ?, NULL)",
+                                        [(record['chunk'], position, question) for position, question in enumerate(record['questions'])])
+        elif record['type'] == 'answer':
+            self.connection.execute("UPDATE questions SET answer = ? WHERE chunk = ? AND position = ?", (record['answer'], record['chunk'], record['index']))
+        elif record['type'] == 'representative':
+            self.connection.execute("INSERT OR REPLACE INTO representatives VALUES (?, ?)", (record['chunk'], record['representative']))
+
+    def record(self, record):
+        """
+        Applies a change to the manifest and appends it to the journal.
+        """
+        self.apply(record)
+        if self.journal is not None:
+            self.journal.append(record)
+
+    def get_answers(self, chunk_hash):
+        """
+        Returns the answers (None for unanswered questions) to the questions of a chunk, in order, None if the chunk is unknown.
+        """
+        if chunk_hash not in self.chunks:
+            return None
+        return [row[0] for row in self.connection.execute("SELECT answer FROM questions WHERE chunk = ? ORDER BY position", (chunk_hash,))]
+
+    def is_file_done(self, file_path, file_hash, max_qa_pairs):
+        """
+        Returns True if a file is unchanged since its last run and all of its (first `max_qa_pairs`) questions were answered.
+        """
+        file_entry = self.files.get(file_path)
+        if (file_entry is None) or (file_entry['hash'] != file_hash):
+            return False
+        nb_questions = 0
+        for _, chunk_hash in file_entry['chunks']:
+            answers = self.get_answers(chunk_hash)
+            if answers is None:
+                return False
+            for answer in answers:
+                if nb_questions >= max_qa_pairs:
+                    return True
+                if answer is None:
+                    return False
+                nb_questions += 1
+        return True
+
+    def iter_chunks(self, file_path, max_qa_pairs):
+        """
+        Yields the `(chunk path, chunk text, [(question, answer), ...])` of each chunk of a file,
+        keeping its first `max_qa_pairs` questions and skipping unanswered questions (and chunks whose questions are not known).
+        """
+        nb_questions = 0
+        for chunk_path, chunk_hash in self.files[file_path]['chunks']:
+            chunk = self.chunks.get(chunk_hash)
+            if chunk is None:
+                continue
+            qa_pairs = []
+            for question, answer in zip(chunk['questions'], chunk['answers']):
+                if nb_questions >= max_qa_pairs:
+                    break
+                if answer is not None:
+                    qa_pairs.append((question, answer))
+                nb_questions += 1
+            yield chunk_path, chunk['text'], qa_pairs
+
+    def get_records(self, file_path, max_qa_pairs):
+        """
+        Returns the `{source, question, answer}` records of a file, skipping unanswered questions.
+        """
+        return [{'source': chunk_path, 'question': question, 'answer': answer}
+                for chunk_path, _, qa_pairs in self.iter_chunks(file_path, max_qa_pairs) for question, answer in qa_pairs]
+
+    def get_representative(self, chunk_hash):
+        """
+        Returns the hash of the chunk whose questions and answers are used for a chunk: the chunk itself if it is known,
+        the near-duplicate chunk recorded for it (see `set_representative`) if that one is known, None otherwise.
+        """
+        if chunk_hash in self.chunks:
+            return chunk_hash
+        row = self.connection.execute("SELECT representative FROM representatives WHERE chunk = ?", (chunk_hash,)).fetchone()
+        if (row is None) or (row[0] not in self.chunks):
+            return None
+        return row[0]
+
+    def set_representative(self, chunk_hash, representative_hash):
+        """
+        Records that a chunk is a near-duplicate of another chunk, whose questions and answers are used in its place,
+        so that it is mapped to the same chunk by the following runs.
+        """
+        self.record({'type': 'representative', 'chunk': chunk_hash, 'representative': representative_hash})
+
+    def set_file(self, file_path, file_hash, chunks):
+        """
+        Records the chunks (a list of `(chunk path, chunk hash)`) of the current version of a file.
+        """
+        self.record({'type': 'file', 'path': file_path, 'hash': file_hash,
+                     'chunks': [[chunk_path, chunk_hash] for chunk_path, chunk_hash in chunks]})
+
+    def set_questions(self, chunk_hash, questions, text=None):
+        """
+        Records the text of a chunk and the questions extracted from it, none of them being answered yet.
+        """
+        self.record({'type': 'questions', 'chunk': chunk_hash, 'text': text, 'questions': questions})
+
+    def set_answer(self, chunk_hash, question_index, answer):
+        """
+        Records the answer to one of the questions of a chunk.
+        """
+        self.record({'type': 'answer', 'chunk': chunk_hash, 'index': question_index, 'answer': answer})
+
+    def prune(self, file_paths):
+        """
+        Drops the files that are not in `file_paths` (deleted since the last run), then the chunks no file refers to.
+
+        Returns:
+            tuple: The number of files and of chunks removed.
+        """
+        if not self.connection.in_transaction:
+            self.connection.execute("BEGIN")
+        self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS current_files (path TEXT PRIMARY KEY)")
+        self.connection.execute("DELETE FROM current_files")
+        self.connection.executemany("INSERT OR IGNORE INTO current_files VALUES (?)", ((file_path,) for file_path in file_paths))
+        nb_deleted_files = self.connection.execute("DELETE FROM files WHERE path NOT IN (SELECT path FROM current_files)").rowcount
+        self.connection.execute("DELETE FROM file_chunks WHERE path NOT IN (SELECT path FROM files)")
+        self.connection.execute("DELETE FROM current_files")
+
+        nb_deleted_chunks = self.connection.execute("DELETE FROM chunks WHERE hash NOT IN (SELECT chunk_hash FROM file_chunks)").rowcount
+        self.connection.execute("DELETE FROM questions WHERE chunk NOT IN (SELECT hash FROM chunks)")
+        self.connection.execute("DELETE FROM representatives WHERE representative NOT IN (SELECT hash FROM chunks)")
+        return nb_deleted_files, nb_deleted_chunks
+
+    def save(self):
+        """
+        Commits the changes made to the manifest (a crash before the commit leaves the previous version intact),
+        then empties the journal whose changes it now contains.
+        """
+        if self.connection.in_transaction:
+            self.connection.execute("COMMIT")
+        if self.journal is not None:
+            self.journal.clear()
+
+    async def checkpoint(self, force=False):
+        """
+        Asynchronously commits the changes made so far and empties the journal, if the last checkpoint is older than `manifest_checkpoint_interval`.
+        The journal is flushed first, no change is made in between, so a change is always either committed or in the journal.
+        """
+        if (not force) and (time.monotonic() - self.last_checkpoint < manifest_checkpoint_interval):
+            return
+        self.last_checkpoint = time.monotonic()
+        if self.journal is not None:
+            await self.journal.close()
+        self.save()
+
+    def close(self):
+        """
+        Closes the database, dropping the changes that were not saved (they can still be replayed from the journal).
+        """
+        self.connection.close()
+
+
+# manifest shared by all files of the process, loaded on first use
+manifest = None
+
+
+def get_manifest():
+    """
+    Returns the process-wide manifest, loading it from the state folder if needed.
+    """
+    global manifest
+    if manifest is None:
+        manifest = Manifest(Path(state_folder) / 'manifest.sqlite', journal=Journal(Path(state_folder) / 'journal.jsonl'))
+    return manifest
@@ -1,83 +1,413 @@
+import math
+import time
+import threading
 import tiktoken
-from .prompts import create_answering_conversation_messages, create_extraction_conversation_messages
+from collections import OrderedDict
+from . import calibration
+from .calibration import TokenStatistics
+from .models import get_model, get_stage_model
+from .prompts import (create_answering_conversation_messages, create_extraction_conversation_messages, create_batch_answering_conversation_messages,
+                      extraction_system_prompt, answering_system_prompt, batch_answering_system_prompt)
 
 #----------------------------------------------------------------------------------------
 # COUNTING
 
-# properties of the model used
-model_type='gpt-3.5-turbo'
-model_token_limit=4096
-model_tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-model_tokens_per_name = -1  # if there's a name, the role is omitted
+# the properties of each model (context window, tokenizer, tokens per message) are set in `models.py`,
+# functions taking a `model` use `models.default_model` when it is None
 
 # parameters
 padding_token_count = 16 # tokens added to make sure we do not go over the limit
 
-# encoder used to turn text into token
-encoding = tiktoken.encoding_for_model(model_type)
+# the token counts of recently counted texts are kept so that a chunk is tokenized once rather than once per call it is sent in,
+# up to this total number of characters per encoding (least recently used texts are evicted first), 0 disables the cache
+token_cache_max_characters = 16 * 1024**2
 
+# texts missing from the cache are tokenized in parallel threads (`encode_batch`) when at least this many of them are counted at once
+batch_encoding_min_texts = 64
 
-def count_tokens_text(text):
+# encoders used to turn text into token, one per tiktoken encoding, loaded on first use
+encodings = {}
+
+# tokens are counted both on the event loop and in the threads splitting files, this lock guards the creation of encoders and caches
+encodings_lock = threading.Lock()
+
+
+def get_encoding(model=None):
+    """
+    Returns the tiktoken encoder of a model.
+    """
+    encoding_name = get_model(model)['encoding']
+    encoding = encodings.get(encoding_name)
+    if encoding is None:
+        with encodings_lock:
+            encoding = encodings.get(encoding_name)
+            if encoding is None:
+                encoding = tiktoken.get_encoding(encoding_name)
+                encodings[encoding_name] = encoding
+    return encoding
+
+
+class TokenCountCache:
+    """
+    Least recently used cache of the token counts of texts, for one encoding, bounded by the total number of characters of the texts kept.
+    Texts are their own keys: Python stores the hash of a string in the string and compares a string to itself without reading it,
+    so looking up a chunk passed from call to call is nearly free. The system prompts are pinned (never evicted).
+    The processor time spent tokenizing is measured, to estimate the time saved by the cache.
+    The cache is shared by the event loop and the threads splitting files: it is guarded by a lock, texts are tokenized outside of it.
+
+    Args:
+        encoding (tiktoken.Encoding): The encoder used to count tokens.
+        max_characters (int): The maximum total number of characters of the texts kept, defaults to `token_cache_max_characters`.
+    """
+
+    def __init__(self, encoding, max_characters=None):
+        self.encoding = encoding
+        self.max_characters = token_cache_max_characters if max_characters is None else max_characters
+        self.token_counts = OrderedDict()  # text -> number of tokens, least recently used first
+        self.pinned_token_counts = {}
+        self.nb_characters = 0
+        self.nb_hits = self.nb_misses = 0
+        self.nb_hit_characters = self.nb_miss_characters = 0
+        self.encoding_seconds = 0.0
+        self.lock = threading.RLock()
+
+    def lookup(self, text):
+        """
+        Returns the token count of a text if it is in the cache (marking it as recently used), None otherwise.
+        """
+        with self.lock:
+            token_count = self.pinned_token_counts.get(text)
+            if token_count is None:
+                token_count = self.token_counts.get(text)
+                if token_count is None:
+                    return None
+                self.token_counts.move_to_end(text)
+            self.nb_hits += 1
+            self.nb_hit_characters += len(text)
+            return token_count
+
+    def store(self, text, token_count):
+        """
+        Adds the token count of a text to the cache, evicting the least recently used texts if it gets too large.
+        """
+        with self.lock:
+            if (len(text) > self.max_characters) or (text in self.token_counts):
+                return
+            self.token_counts[text] = token_count
+            self.nb_characters += len(text)
+            while self.nb_characters > self.max_characters:
+                evicted_text, _ = self.token_counts.popitem(last=False)
+                self.nb_characters -= len(evicted_text)
+
+    def pin(self, text):
+        """
+        Adds the token count of a text that will never be evicted (such as a system prompt).
+        """
+        token_count = len(self.encoding.encode(text))
+        with self.lock:
+            self.pinned_token_counts[text] = token_count
+
+    def count(self, text, store=True):
+        """
+        Returns the number of tokens of a text, tokenizing it only if it is not in the cache.
+        """
+        token_count = self.lookup(text)
+        if token_count is None:
+            start = time.process_time()
+            token_count = len(self.encoding.encode(text))
+            with self.lock:
+                self.encoding_seconds += time.process_time() - start
+                self.nb_misses += 1
+                self.nb_miss_characters += len(text)
+                if store:
+                    self.store(text, token_count)
+        return token_count
+
+    def count_many(self, texts, store=True):
+        """
+        Returns the number of tokens of each text, tokenizing the texts missing from the cache together
+        (in parallel threads if there are at least `batch_encoding_min_texts` of them).
+        """
+        token_counts = [self.lookup(text) for text in texts]
+        missing_texts = list(dict.fromkeys(text for text, token_count in zip(texts, token_counts) if token_count is None))
+        if len(missing_texts) == 0:
+            return token_counts
+        start = time.process_time()
+        if len(missing_texts) >= batch_encoding_min_texts:
+            missing_token_counts = [len(tokens) for tokens in self.encoding.encode_batch(missing_texts)]
+        else:
+            missing_token_counts = [len(self.encoding.encode(text)) for text in missing_texts]
+        missing_token_counts = dict(zip(missing_texts, missing_token_counts))
+        with self.lock:
+            self.encoding_seconds += time.process_time() - start
+            self.nb_misses += len(missing_texts)
+            self.nb_miss_characters += sum(len(text) for text in missing_texts)
+            if store:
+                for text, token_count in missing_token_counts.items():
+                    self.store(text, token_count)
+        return [missing_token_counts[text] if token_count is None else token_count for text, token_count in zip(texts, token_counts)]
+
+    def stats(self):
+        """
+        Returns the number of cache hits and misses, the processor time spent tokenizing
+        and an estimate of the time saved by the hits (at the tokenization speed observed on the misses).
+        """
+        nb_lookups = self.nb_hits + self.nb_misses
+        seconds_per_character = self.encoding_seconds / self.nb_miss_characters if self.nb_miss_characters > 0 else 0.0
+        return {'hits': self.nb_hits, 'misses': self.nb_misses, 'hit_rate': self.nb_hits / nb_lookups if nb_lookups > 0 else 0.0,
+                'encoding_seconds': self.encoding_seconds, 'seconds_saved': self.nb_hit_characters * seconds_per_character}
+
+
+# token count cache of each tiktoken encoding, created on first use
+token_count_caches = {}
+
+
+def get_token_count_cache(model=None):
+    """
+    Returns the token count cache of the encoding of a model, creating it (with the system prompts pinned) if needed.
+    """
+    encoding_name = get_model(model)['encoding']
+    token_count_cache = token_count_caches.get(encoding_name)
+    if token_count_cache is None:
+        encoding = get_encoding(model)
+        with encodings_lock:
+            token_count_cache = token_count_caches.get(encoding_name)
+            if token_count_cache is None:
+                token_count_cache = TokenCountCache(encoding)
+                for system_prompt in (extraction_system_prompt, answering_system_prompt, batch_answering_system_prompt):
+                    token_count_cache.pin(system_prompt)
+                token_count_caches[encoding_name] = token_count_cache
+    return token_count_cache
+
+
+def get_token_count_cache_stats():
+    """
+    Returns the statistics of all token count caches (see `TokenCountCache.stats`), summed over encodings.
+    """
+    total_stats = {'hits': 0, 'misses': 0, 'encoding_seconds': 0.0, 'seconds_saved': 0.0}
+    for token_count_cache in token_count_caches.values():
+        for key, value in token_count_cache.stats().items():
+            if key in total_stats:
+                total_stats[key] += value
+    nb_lookups = total_stats['hits'] + total_stats['misses']
+    total_stats['hit_rate'] = total_stats['hits'] / nb_lookups if nb_lookups > 0 else 0.0
+    return total_stats
+
+
+def count_tokens_text(text, model=None, store=True):
     """
     Counts the number of tokens used to encode a given text.
     
     Args:
         text (str): The input text to be tokenized.
+        model (str): The model whose tokenizer is used.
+        store (bool): If False, the count is not kept in the cache (for texts that will not be counted again, such as model outputs).
         
     Returns:
         int: The number of tokens in the encoded text.
     """
-    encoded_text = encoding.encode(text)
-    return len(encoded_text)
+    return get_token_count_cache(model).count(text, store=store)
 
 
-def count_tokens_messages(messages):
+def count_tokens_texts(texts, model=None, store=True):
+    """
+    Counts the number of tokens used to encode each of several texts, tokenizing them in a single batch.
+
+    Args:
+        texts (list of str): The input texts to be tokenized.
+        model (str): The model whose tokenizer is used.
+        store (bool): If False, the counts are not kept in the cache.
+
+    Returns:
+        list of int: The number of tokens of each text.
+    """
+    return get_token_count_cache(model).count_many(texts, store=store)
+
+
+def count_tokens_messages(messages, model=None, token_count_cache=None):
     """
     Counts the number of tokens needed to encode a list of messages.
     
     Args:
-        messages (list): A list of message objects to be tokenized.
+        messages (list of dict): A list of `{role, content}` messages to be tokenized.
+        model (str): The model whose tokenizer and message format are used.
+        token_count_cache (TokenCountCache): The cache used to count the tokens of each message, defaults to the cache of the model's encoding.
         
     Returns:
         int: The total number of tokens required to encode the messages.
         
     Adapted from: https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
     """
+    properties = get_model(model)
+    token_count_cache = token_count_cache or get_token_count_cache(model)
     total_tokens = 0
     for message in messages:
-        total_tokens += model_tokens_per_message
-        total_tokens += count_tokens_text(message.content)
-        total_tokens += model_tokens_per_name
+        total_tokens += properties['tokens_per_message']  # every message follows <|start|>{role/name}\n{content}<|end|>\n
+        total_tokens += token_count_cache.count(message['content'])
+        total_tokens += properties['tokens_per_name']  # if there's a name, the role is omitted
 
     total_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return total_tokens
 
 
-def get_available_tokens(messages_token_count):
+def get_available_tokens(messages_token_count, model=None):
     """
     Calculates the number of tokens that can be requested from the model.
     
     Args:
         messages_token_count (int): The total number of tokens used by the messages.
+        model (str): The model called, whose context window is used.
         
     Returns:
         int: The number of tokens available for the model request.
     """
-    adjusted_token_limit = model_token_limit - padding_token_count  # Avoid requesting the exact token limit
+    adjusted_token_limit = get_model(model)['context_window'] - padding_token_count  # Avoid requesting the exact token limit
     available_tokens = adjusted_token_limit - messages_token_count
     return available_tokens
 
 #----------------------------------------------------------------------------------------
 # PREDICTING
 
-# data gathered running tests
+# data gathered running tests, used until enough completions have been observed (see `calibration.py`)
 average_question_size = 15.28
 average_answer_size = 94.78
 average_question_text_ratio = 0.14 # sum(question)/sum(text)
 
-# size of empty messages
-empty_extraction_messages_token_count = count_tokens_messages(create_extraction_conversation_messages(text=''))
-empty_answering_messages_token_count = count_tokens_messages(create_answering_conversation_messages(question='', text=''))
+# margin applied to the predicted size of an output to get its `max_tokens`
+max_tokens_margin = 1.5
+min_max_tokens = 64
+
+# empty messages of each stage, and their size for each model (computed on first use)
+empty_stage_messages = {
+    'extraction': create_extraction_conversation_messages(text=''),
+    'answering': create_answering_conversation_messages(question='', text=''),
+    'batch_answering': create_batch_answering_conversation_messages(questions=[], text=''),
+}
+empty_messages_token_counts = {}  # (stage, model) -> number of tokens
+
+# the statistics and the sizes of the empty messages are also used by the threads splitting files, this lock guards their creation
+estimates_lock = threading.Lock()
+
+# tokens needed to wrap each answer of a batch (`{"id": 12, "answer": "..."},`) and number each question (`12. `)
+batch_answer_overhead_token_count = 12
+batch_question_overhead_token_count = 4
+
+
+def get_empty_messages_token_count(stage, model=None):
+    """
+    Returns the number of tokens of the messages of a stage ('extraction', 'answering' or 'batch_answering') with an empty text and no question.
+
+    Args:
+        stage (str): The stage of the pipeline.
+        model (str): The model whose tokenizer is used, defaults to the model of the stage.
+
+    Returns:
+        int: The number of tokens of the empty messages.
+    """
+    model = model or get_stage_model(stage)
+    token_count = empty_messages_token_counts.get((stage, model))
+    if token_count is None:
+        with estimates_lock:
+            token_count = empty_messages_token_counts.get((stage, model))
+            if token_count is None:
+                token_count = count_tokens_messages(empty_stage_messages[stage], model=model)
+                empty_messages_token_counts[(stage, model)] = token_count
+    return token_count
+
+
+# statistics learned from the completions observed, loaded on first use
+token_statistics = None
+
+
+def get_token_statistics():
+    """
+    Returns the statistics of the current models, learned from the completions observed during this and previous runs
+    (questions are produced by the extraction model and answers by the answering model, each pair of models has its own statistics).
+    """
+    global token_statistics
+    if token_statistics is None:
+        with estimates_lock:
+            if token_statistics is None:
+                defaults = {'question_size': average_question_size, 'answer_size': average_answer_size, 'question_text_ratio': average_question_text_ratio}
+                extraction_model, answering_model = get_stage_model('extraction'), get_stage_model('answering')
+                models_name = extraction_model if extraction_model == answering_model else f"{extraction_model}-{answering_model}"
+                path = calibration.calibration_path.with_name(f"{calibration.calibration_path.stem}-{models_name}{calibration.calibration_path.suffix}") if calibration.calibration_enabled else None
+                token_statistics = TokenStatistics(defaults, path=path)
+    return token_statistics
+
+
+def observe_extraction(text_token_count, questions):
+    """
+    Records the sizes observed in the output of an extraction conversation.
+
+    Args:
+        text_token_count (int): The number of tokens in the text questions were extracted from.
+        questions (list of str): The questions extracted.
+    """
+    if (not calibration.calibration_enabled) or (len(questions) == 0) or (text_token_count == 0):
+        return
+    statistics = get_token_statistics()
+    question_token_counts = count_tokens_texts(questions, model=get_stage_model('extraction'))
+    for question_token_count in question_token_counts:
+        statistics.observe('question_size', question_token_count)
+    statistics.observe('question_text_ratio', sum(question_token_counts) / text_token_count)
+
+
+def observe_answer(answer):
+    """
+    Records the size of an answer.
+    """
+    if calibration.calibration_enabled and (answer is not None):
+        get_token_statistics().observe('answer_size', count_tokens_text(answer, model=get_stage_model('answering'), store=False))
+
+
+def get_max_tokens(expected_output_token_count):
+    """
+    Returns the `max_tokens` to request for an output of a predicted size, with a margin.
+
+    Args:
+        expected_output_token_count (float): The predicted (upper bound) size of the output.
+
+    Returns:
+        int: The number of tokens to request.
+    """
+    return max(min_max_tokens, math.ceil(expected_output_token_count * max_tokens_margin))
+
+
+def estimate_extraction_output_tokens(text_token_count, statistics=None):
+    """
+    Estimates an upper bound on the number of tokens of the questions extracted from a text.
+
+    Args:
+        text_token_count (int): The total number of tokens in the input text.
+        statistics (dict): The 'question_size' and 'question_text_ratio' estimates to use, defaults to the live estimates.
+
+    Returns:
+        float: The estimated upper bound on the size of the output.
+    """
+    if statistics is None:
+        token_statistics = get_token_statistics()
+        statistics = {'question_size': token_statistics.mean('question_size'),
+                      'question_text_ratio': token_statistics.upper_bound('question_text_ratio')}
+    # The upper bound is the maximum of an average question size or a number of questions
+    # proportional to the text length, plus half an average question worth of padding
+    return max(statistics['question_size'], text_token_count * statistics['question_text_ratio']) + statistics['question_size'] / 2
+
+
+def estimate_answering_output_tokens(nb_questions=1):
+    """
+    Estimates an upper bound on the number of tokens needed to answer questions (wrapped in a JSON array if there are several).
+
+    Args:
+        nb_questions (int): The number of questions answered in the conversation.
+
+    Returns:
+        float: The estimated upper bound on the size of the output.
+    """
+    answer_size = get_token_statistics().upper_bound('answer_size')
+    if nb_questions == 1:
+        return answer_size
+    return nb_questions * (answer_size + batch_answer_overhead_token_count)
 
 
 def estimate_extraction_conversation_tokens(text_token_count):
@@ -91,17 +421,16 @@ def estimate_extraction_conversation_tokens(text_token_count):
         float: The estimated total number of tokens needed for the extraction conversation.
     """
     # Calculate the upper bound of output tokens based on the input text tokens
-    # The upper bound is the maximum of an average question size or a number of questions
-    # proportional to the text length, plus half an average question worth of padding
-    upper_bound_output_size = max(
-        average_question_size, 
-        text_token_count * average_question_text_ratio
-    ) + average_question_size / 2
+    # (using the statistics fixed for the run, so that the same text is always split the same way)
+    token_statistics = get_token_statistics()
+    upper_bound_output_size = estimate_extraction_output_tokens(text_token_count, statistics={
+        'question_size': token_statistics.splitting_estimate('question_size'),
+        'question_text_ratio': token_statistics.splitting_estimate('question_text_ratio')})
 
     # The total estimated token count includes the extraction messages,
     # input text tokens, and the calculated upper bound output size
     estimated_token_count = (
-        empty_extraction_messages_token_count + 
+        get_empty_messages_token_count('extraction') + 
         text_token_count + 
         upper_bound_output_size
     )
@@ -119,16 +448,15 @@ def estimate_answering_conversation_tokens(text_token_count):
     Returns:
         float: The estimated total number of tokens needed for the answering conversation.
     """
-    # Calculate the upper bound of question tokens: one question plus half a question worth of padding
-    upper_bound_question_size = average_question_size * 1.5
-    
-    # Calculate the upper bound of answer tokens: one answer plus half an answer worth of padding
-    upper_bound_answer_size = average_answer_size * 1.5
+    # Calculate the upper bound of question and answer tokens (learned, or the average plus half an average worth of padding)
+    token_statistics = get_token_statistics()
+    upper_bound_question_size = token_statistics.splitting_estimate('question_size', 'upper_bound')
+    upper_bound_answer_size = token_statistics.splitting_estimate('answer_size', 'upper_bound')
     
     # The total estimated token count includes the answering messages tokens,
     # input text tokens, and the calculated upper bound question and answer sizes
     estimated_token_count = (
-        empty_answering_messages_token_count + 
+        get_empty_messages_token_count('answering') + 
         text_token_count + 
         upper_bound_question_size + 
         upper_bound_answer_size
@@ -136,12 +464,69 @@ def estimate_answering_conversation_tokens(text_token_count):
     
     return estimated_token_count
 
+
+def estimate_batch_answering_conversation_tokens(text_token_count, questions_token_count, nb_questions):
+    """
+    Estimates the total number of tokens needed to answer several questions about a text in a single conversation.
+    
+    Args:
+        text_token_count (int): The total number of tokens in the input text.
+        questions_token_count (int): The total number of tokens in the questions.
+        nb_questions (int): The number of questions.
+        
+    Returns:
+        float: The estimated total number of tokens needed for the batch answering conversation.
+    """
+    # Each question is numbered, each answer is an upper bound answer wrapped in a JSON object
+    input_questions_size = questions_token_count + nb_questions * batch_question_overhead_token_count
+    upper_bound_answer_size = get_token_statistics().splitting_estimate('answer_size', 'upper_bound')
+    upper_bound_answers_size = nb_questions * (upper_bound_answer_size + batch_answer_overhead_token_count)
+
+    estimated_token_count = (
+        get_empty_messages_token_count('batch_answering') +
+        text_token_count +
+        input_questions_size +
+        upper_bound_answers_size
+    )
+
+    return estimated_token_count
+
+
+def split_questions_into_batches(text_token_count, question_token_counts, max_batch_size):
+    """
+    Groups consecutive questions about the same text into batches that can be answered in a single conversation.
+    
+    Args:
+        text_token_count (int): The total number of tokens in the input text.
+        question_token_counts (list of int): The number of tokens of each question.
+        max_batch_size (int): The maximum number of questions per batch.
+    
+    Returns:
+        list of range: The indices of the questions in each batch.
+    """
+    batches = []
+    batch_start = 0
+    batch_questions_token_count = 0
+    for index, question_token_count in enumerate(question_token_counts):
+        nb_questions = index - batch_start + 1
+        estimated_token_count = estimate_batch_answering_conversation_tokens(text_token_count, batch_questions_token_count + question_token_count, nb_questions)
+        # Close the current batch if it is full or if the question does not fit in the remaining budget
+        if (nb_questions > 1) and ((nb_questions > max_batch_size) or (get_available_tokens(estimated_token_count, model=get_stage_model('batch_answering')) <= 0)):
+            batches.append(range(batch_start, index))
+            batch_start = index
+            batch_questions_token_count = 0
+        batch_questions_token_count += question_token_count
+    if batch_start < len(question_token_counts):
+        batches.append(range(batch_start, len(question_token_counts)))
+    return batches
+
 #----------------------------------------------------------------------------------------
 # CHECKING
 
 def are_tokens_available_for_both_conversations(text_token_count):
     """
-    Checks if there are enough tokens available to get an answer from the model for both extraction and answering.
+    Checks if there are enough tokens available to get an answer for both extraction and answering,
+    each conversation being checked against the context window of the model it is routed to (see `models.stage_models`).
     
     Args:
         text_token_count (int): The total number of tokens in the input text.
@@ -151,11 +536,11 @@ def are_tokens_available_for_both_conversations(text_token_count):
     """
     # Calculate tokens needed for extraction conversation
     tokens_needed_extraction = estimate_extraction_conversation_tokens(text_token_count)
-    tokens_available_extraction = get_available_tokens(tokens_needed_extraction)
+    tokens_available_extraction = get_available_tokens(tokens_needed_extraction, model=get_stage_model('extraction'))
     
     # Calculate tokens needed for answering conversation
     tokens_needed_answering = estimate_answering_conversation_tokens(text_token_count)
-    tokens_available_answering = get_available_tokens(tokens_needed_answering)
+    tokens_available_answering = get_available_tokens(tokens_needed_answering, model=get_stage_model('answering'))
     
     # Check if there are enough tokens available for both extraction and answering
     return (tokens_available_extraction > 0) and (tokens_available_answering > 0)
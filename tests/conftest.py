@@ -0,0 +1,57 @@
+import re
+import pytest
+import question_extractor
+from question_extractor import state, cache, calibration, retrying, rate_limiting, deduplication, token_counting, models
+
+
+class RegexEncoding:
+    """
+    Stands for a tiktoken encoding (whose files tiktoken downloads on first use), one token per word, punctuation sign or run of spaces.
+    """
+
+    def encode(self, text):
+        return re.findall(r"\w+|[^\w\s]|\s+", text)
+
+    def encode_batch(self, texts):
+        return [self.encode(text) for text in texts]
+
+
+@pytest.fixture(autouse=True)
+def offline_tokenizer(monkeypatch):
+    """
+    Pins the encoding of every model to a `RegexEncoding`, so that tests count tokens without network access,
+    and empties the token count caches built on the real encodings.
+    """
+    encoding = RegexEncoding()
+    encoding_names = {model['encoding'] for model in models.models.values()}
+    monkeypatch.setattr(token_counting, 'encodings', {encoding_name: encoding for encoding_name in encoding_names})
+    monkeypatch.setattr(token_counting, 'token_count_caches', {})
+    monkeypatch.setattr(token_counting, 'empty_messages_token_counts', {})
+    return encoding
+
+
+@pytest.fixture
+def isolated_pipeline(tmp_path, monkeypatch):
+    """
+    Points the state, dead letters and metrics of the pipeline to a temporary folder, disables the response cache and calibration,
+    and resets the limiters, circuit breakers, splitting counters and indexes of chunks shared by all calls, so that tests do not see each other's calls.
+    Waits between attempts are shortened so that retries run quickly.
+    """
+    monkeypatch.setattr(state, 'state_folder', tmp_path / 'state')
+    monkeypatch.setattr(state, 'manifest', None)
+    monkeypatch.setattr(cache, 'cache_enabled', False)
+    monkeypatch.setattr(cache, 'response_cache', None)
+    monkeypatch.setattr(calibration, 'calibration_enabled', False)
+    monkeypatch.setattr(retrying, 'dead_letters_path', tmp_path / 'dead_letters.jsonl')
+    monkeypatch.setattr(retrying, 'dead_letters', [])
+    monkeypatch.setattr(retrying, 'circuit_breakers', {})
+    monkeypatch.setattr(retrying, 'retry_min_wait', 0.01)
+    monkeypatch.setattr(retrying, 'retry_max_wait', 0.05)
+    monkeypatch.setattr(rate_limiting, 'rate_limiters', {})
+    monkeypatch.setattr(question_extractor, 'throttlers', {})
+    monkeypatch.setattr(question_extractor, 'splitting_stats', {'nb_unpacked_chunks': 0, 'nb_chunks': 0})
+    monkeypatch.setattr(question_extractor, 'chunks_in_flight', {})
+    monkeypatch.setattr(question_extractor, 'answers_in_flight', {})
+    monkeypatch.setattr(deduplication, 'chunk_index', None)
+    monkeypatch.setattr(deduplication, 'corpus_deduplicator', None)
+    return tmp_path
@@ -0,0 +1,91 @@
+import json
+import asyncio
+import pytest
+import question_extractor
+from question_extractor import batching, cache, models, retrying
+from question_extractor.batching import get_result, get_cache_key, write_request_files, run_batch_pipeline
+from question_extractor.cache import ResponseCache
+from question_extractor.fake_server import FakeModel, FakeBackend
+from question_extractor.instrumentation import metrics
+from question_extractor.prompts import create_answering_conversation_messages
+from question_extractor.token_counting import count_tokens_messages, count_tokens_text
+
+#----------------------------------------------------------------------------------------
+# RESULTS
+
+def test_results_are_cached_with_the_token_count_of_their_stage_model(isolated_pipeline, monkeypatch):
+    monkeypatch.setattr(models, 'models', dict(models.models))
+    monkeypatch.setattr(models, 'stage_models', dict(models.stage_models, answering='wide-model'))
+    models.register_model('wide-model', context_window=32768, tokens_per_message=40)
+    response_cache = ResponseCache(isolated_pipeline / 'cache.sqlite')
+    monkeypatch.setattr(cache, 'response_cache', response_cache)
+
+    messages = create_answering_conversation_messages("What is point 1?", "Some documentation text.")
+    assert get_result({'answering:1': (" Point 1 is a point. ", None)}, 'answering:1', messages, 'answering') == "Point 1 is a point."
+    nb_tokens = response_cache.connection.execute("SELECT nb_tokens FROM responses WHERE key = ?", (get_cache_key(messages, 'answering'),)).fetchone()[0]
+    assert nb_tokens == count_tokens_messages(messages, model='wide-model') + count_tokens_text("Point 1 is a point.", model='wide-model')
+    assert nb_tokens != count_tokens_messages(messages) + count_tokens_text("Point 1 is a point.")
+
+
+def test_failed_results_fall_back_on_the_cache_or_become_dead_letters(isolated_pipeline, monkeypatch):
+    response_cache = ResponseCache(isolated_pipeline / 'cache.sqlite')
+    monkeypatch.setattr(cache, 'response_cache', response_cache)
+    cached_messages = create_answering_conversation_messages("What is point 1?", "Some documentation text.")
+    response_cache.set(get_cache_key(cached_messages, 'answering'), "Cached answer.")
+    failed_messages = create_answering_conversation_messages("What is point 2?", "Some documentation text.")
+
+    results = {'answering:1': (None, 'Server error.'), 'answering:2': (None, 'Server error.')}
+    assert get_result(results, 'answering:1', cached_messages, 'answering') == "Cached answer."
+    assert get_result(results, 'answering:2', failed_messages, 'answering') is None
+    assert len(retrying.dead_letters) == 1
+
+#----------------------------------------------------------------------------------------
+# REQUEST FILES
+
+def test_request_files_are_split_by_model_and_size(tmp_path, monkeypatch):
+    monkeypatch.setattr(batching, 'max_requests_per_file', 2)
+    requests = [{'custom_id': str(index), 'body': {'model': 'model-a' if index < 5 else 'model-b'}} for index in range(7)]
+    paths = write_request_files(requests, tmp_path, 'extraction-1')
+    files_requests = [[json.loads(line) for line in path.read_text().splitlines()] for path in paths]
+    assert [[request['custom_id'] for request in file_requests] for file_requests in files_requests] == [['0', '1'], ['2', '3'], ['4'], ['5', '6']]
+
+#----------------------------------------------------------------------------------------
+# PIPELINE
+
+def make_files():
+    return [(f"{name}.md", '\n\n'.join(f"# {name} {section}\n\n" + ' '.join(f"{name}{section}w{index}" for index in range(150)) for section in range(2)))
+            for name in ('a', 'b')]
+
+
+def run_batches(monkeypatch, backend, files, timeout=None):
+    monkeypatch.setattr(question_extractor, 'backend', backend)
+    return asyncio.run(asyncio.wait_for(run_batch_pipeline(files, verbose=False), timeout))
+
+
+def test_all_questions_are_answered_and_done_files_are_not_submitted_again(isolated_pipeline, monkeypatch):
+    fake_model = FakeModel(questions_per_100_tokens=2)
+    files = make_files()
+    records = run_batches(monkeypatch, FakeBackend(fake_model), files)
+    assert len(records) > 0
+    assert {record['source'].split('/')[0] for record in records} == {'a.md', 'b.md'}
+    assert all(len(record['answer']) > 0 for record in records)
+    assert not (isolated_pipeline / 'state' / 'batch_job.json').exists()
+
+    nb_submitted = metrics.get_counter('batches_submitted_total')
+    assert run_batches(monkeypatch, FakeBackend(fake_model), files) == records
+    assert metrics.get_counter('batches_submitted_total') == nb_submitted
+
+
+def test_interrupted_runs_resume_their_batches(isolated_pipeline, monkeypatch):
+    monkeypatch.setattr(batching, 'poll_interval', 0.01)
+    fake_model = FakeModel(questions_per_100_tokens=2)
+    files = make_files()
+    batch_folder = isolated_pipeline / 'batches'
+    nb_submitted = metrics.get_counter('batches_submitted_total', stage='extraction')
+    with pytest.raises(asyncio.TimeoutError):
+        run_batches(monkeypatch, FakeBackend(fake_model, batch_folder=batch_folder, batch_latency=3600), files, timeout=0.2)
+    assert metrics.get_counter('batches_submitted_total', stage='extraction') == nb_submitted + 1
+
+    records = run_batches(monkeypatch, FakeBackend(fake_model, batch_folder=batch_folder), files)
+    assert metrics.get_counter('batches_submitted_total', stage='extraction') == nb_submitted + 1
+    assert {record['source'].split('/')[0] for record in records} == {'a.md', 'b.md'}
@@ -0,0 +1,52 @@
+import time
+import asyncio
+import question_extractor
+from question_extractor import cache
+from question_extractor.cache import ResponseCache, hash_request
+from question_extractor.fake_server import FakeModel, FakeBackend
+from question_extractor.prompts import create_answering_conversation_messages
+
+#----------------------------------------------------------------------------------------
+# CACHE
+
+def test_keys_depend_on_every_parameter_of_the_call():
+    messages = [{'role': 'user', 'content': "What is a node?"}]
+    key = hash_request('gpt-4', 0.0, 100, messages)
+    assert key == hash_request('gpt-4', 0.0, 100, [{'content': "What is a node?", 'role': 'user'}])
+    assert len({key, hash_request('gpt-3.5-turbo', 0.0, 100, messages), hash_request('gpt-4', 0.5, 100, messages),
+                hash_request('gpt-4', 0.0, 200, messages), hash_request('gpt-4', 0.0, 100, [{'role': 'user', 'content': "What is a job?"}])}) == 5
+
+
+def test_outputs_are_shared_by_processes_and_expire(tmp_path):
+    ResponseCache(tmp_path / 'cache.sqlite').set('key', "output", nb_tokens=12)
+    response_cache = ResponseCache(tmp_path / 'cache.sqlite', max_age_seconds=60)
+    assert response_cache.get('key') == "output"
+    assert response_cache.get('other key') is None
+    assert response_cache.stats() == {'hits': 1, 'misses': 1, 'hit_rate': 0.5, 'tokens_saved': 12}
+
+    response_cache.connection.execute("UPDATE responses SET created = ?", (time.time() - 120,))
+    assert response_cache.get('key') is None
+    assert response_cache.evict() == 1
+
+
+def test_least_recently_used_outputs_are_evicted_first(tmp_path):
+    response_cache = ResponseCache(tmp_path / 'cache.sqlite', max_size_bytes=2 * len("k0" + 'x' * 100))
+    for index in range(3):
+        response_cache.set(f"k{index}", 'x' * 100)
+        time.sleep(0.01)
+    response_cache.get('k0')
+    assert response_cache.evict() == 1
+    assert [response_cache.get(f"k{index}") is not None for index in range(3)] == [True, False, True]
+
+#----------------------------------------------------------------------------------------
+# RUN MODEL
+
+def test_identical_calls_are_served_from_the_cache(isolated_pipeline, monkeypatch):
+    fake_model = FakeModel(latency_mean=0.01, latency_sigma=0.0)
+    monkeypatch.setattr(question_extractor, 'backend', FakeBackend(fake_model))
+    monkeypatch.setattr(cache, 'cache_enabled', True)
+    monkeypatch.setattr(cache, 'cache_path', isolated_pipeline / 'cache.sqlite')
+    messages = create_answering_conversation_messages("What is a node?", "Some documentation text.")
+    first_output = asyncio.run(question_extractor.run_model(messages, stage='answering'))
+    assert asyncio.run(question_extractor.run_model(messages, stage='answering')) == first_output
+    assert fake_model.stats['nb_completions'] == 1
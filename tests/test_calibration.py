@@ -0,0 +1,59 @@
+from question_extractor.calibration import RunningStatistic, TokenStatistics
+
+DEFAULTS = {'question_size': 15.0, 'answer_size': 100.0, 'question_text_ratio': 0.1}
+
+#----------------------------------------------------------------------------------------
+# STATISTICS
+
+def test_running_statistics_keep_their_most_recent_samples():
+    statistic = RunningStatistic(window_size=4)
+    for value in [100, 1, 2, 3, 4]:
+        statistic.add(value)
+    assert list(statistic.samples) == [1, 2, 3, 4]
+    assert statistic.mean() == 2.5
+    assert (statistic.quantile(0.5), statistic.quantile(0.95), statistic.quantile(0.0)) == (2, 4, 1)
+
+
+def test_defaults_are_used_until_there_are_enough_samples():
+    statistics = TokenStatistics(DEFAULTS)
+    for _ in range(49):
+        statistics.observe('answer_size', 40)
+    assert (statistics.mean('answer_size'), statistics.upper_bound('answer_size')) == (100.0, 150.0)
+    statistics.observe('answer_size', 40)
+    assert (statistics.mean('answer_size'), statistics.upper_bound('answer_size')) == (40, 40)
+
+#----------------------------------------------------------------------------------------
+# PERSISTENCE
+
+def test_learned_statistics_are_reloaded_by_the_next_run(tmp_path):
+    statistics = TokenStatistics(DEFAULTS, path=tmp_path / 'statistics.json')
+    for _ in range(100):
+        statistics.observe('answer_size', 40)
+    assert statistics.splitting_estimate('answer_size') == 100.0
+    assert statistics.save()
+
+    statistics = TokenStatistics(DEFAULTS, path=tmp_path / 'statistics.json')
+    assert statistics.mean('answer_size') == statistics.splitting_estimate('answer_size') == 40
+    assert statistics.splitting_estimate('question_size') == 15.0
+
+
+def test_splitting_estimates_only_change_when_they_drift(tmp_path):
+    statistics = TokenStatistics(DEFAULTS, path=tmp_path / 'statistics.json')
+    for _ in range(100):
+        statistics.observe('answer_size', 40)
+    statistics.save()
+    for _ in range(100):
+        statistics.observe('answer_size', 42)
+    assert not statistics.save()
+    assert TokenStatistics(DEFAULTS, path=tmp_path / 'statistics.json').splitting_estimate('answer_size') == 40
+    for _ in range(2000):
+        statistics.observe('answer_size', 60)
+    assert statistics.save()
+    assert TokenStatistics(DEFAULTS, path=tmp_path / 'statistics.json').splitting_estimate('answer_size') == 60
+
+
+def test_unreadable_statistics_fall_back_on_the_defaults(tmp_path, capsys):
+    (tmp_path / 'statistics.json').write_text('{"samples": ', encoding='utf-8')
+    statistics = TokenStatistics(DEFAULTS, path=tmp_path / 'statistics.json')
+    assert statistics.splitting_estimate('answer_size') == 100.0
+    assert 'WARNING' in capsys.readouterr().out
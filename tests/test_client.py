@@ -0,0 +1,39 @@
+import asyncio
+import pytest
+from question_extractor.client import APIError, APIConnectionError, read_event_stream
+
+class FakeStreamResponse:
+    """Mimics the `content` of an aiohttp response streaming the given lines."""
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    @property
+    def content(self):
+        async def iterate():
+            for line in self.lines:
+                yield (line + '\n').encode('utf-8')
+        return iterate()
+
+def read(lines):
+    pieces = []
+    result = asyncio.run(read_event_stream(FakeStreamResponse(lines), pieces.append))
+    return result, pieces
+
+def test_stream_is_assembled():
+    result, pieces = read(['data: {"choices": [{"delta": {"content": "1. a"}}]}', '',
+                           'data: {"choices": [{"delta": {"content": "?"}, "finish_reason": "stop"}]}', '',
+                           'data: [DONE]'])
+    assert result['text'] == "1. a?"
+    assert result['finish_reason'] == 'stop'
+    assert pieces == ["1. a", "?"]
+
+def test_error_event_in_data_raises():
+    with pytest.raises(APIConnectionError):
+        read(['data: {"choices": [{"delta": {"content": "1. a"}}]}', '',
+              'data: {"error": {"message": "overloaded", "type": "server_error"}}', ''])
+
+def test_named_error_event_raises():
+    with pytest.raises(APIError) as error:
+        read(['event: error', 'data: {"message": "bad request", "type": "invalid_request_error"}', ''])
+    assert not isinstance(error.value, APIConnectionError)
@@ -0,0 +1,76 @@
+from question_extractor import deduplication
+from question_extractor.deduplication import NearDuplicateIndex, QuestionDeduplicator, compute_fingerprint, get_deduplicator
+
+#----------------------------------------------------------------------------------------
+# NEAR-DUPLICATE INDEX
+
+def test_index_returns_the_smallest_matching_key():
+    text = "how do I submit a job to the cluster queue from a login node"
+    fingerprint = compute_fingerprint(text)
+    for keys in (['b', 'a', 'c'], ['c', 'b', 'a']):
+        index = NearDuplicateIndex(threshold=0.8, max_size=10)
+        for key in keys:
+            index.insert(key, fingerprint)
+        assert index.find(compute_fingerprint(text)) == 'a'
+
+
+def test_index_forgets_its_oldest_texts():
+    index = NearDuplicateIndex(threshold=0.8, max_size=2)
+    texts = ["how do I submit a job", "where are the log files stored", "which compilers are installed"]
+    for key, text in enumerate(texts):
+        index.insert(key, compute_fingerprint(text))
+    assert len(index) == 2
+    assert index.find(compute_fingerprint(texts[0])) is None
+    assert index.find(compute_fingerprint(texts[2])) == 2
+
+#----------------------------------------------------------------------------------------
+# QUESTIONS
+
+def test_questions_differing_by_case_accents_and_punctuation_are_duplicates():
+    deduplicator = QuestionDeduplicator()
+    assert not deduplicator.is_duplicate("How do I submit a job to the cluster queue from a login node?")
+    assert deduplicator.is_duplicate("how do i submit a job to the cluster queue, from a login node")
+    assert deduplicator.is_duplicate("How do I submit a jöb to the cluster queue from a login node !")
+
+
+def test_distinct_questions_are_kept():
+    deduplicator = QuestionDeduplicator()
+    assert not deduplicator.is_duplicate("How do I submit a job to the cluster queue from a login node?")
+    assert not deduplicator.is_duplicate("How do I cancel a job that is waiting in the cluster queue?")
+    assert not deduplicator.is_duplicate("?!")
+    assert len(deduplicator) == 2
+
+
+def test_added_questions_are_checked_against():
+    deduplicator = QuestionDeduplicator()
+    deduplicator.add("Where are the log files of a job stored?")
+    assert deduplicator.is_duplicate("Where are the log files of a job stored")
+
+
+def test_deduplicator_scopes(monkeypatch):
+    monkeypatch.setattr(deduplication, 'corpus_deduplicator', None)
+    monkeypatch.setattr(deduplication, 'deduplication_scope', 'file')
+    assert get_deduplicator() is not get_deduplicator()
+    monkeypatch.setattr(deduplication, 'deduplication_scope', 'corpus')
+    assert get_deduplicator() is get_deduplicator()
+    monkeypatch.setattr(deduplication, 'deduplication_scope', None)
+    assert get_deduplicator() is None
+
+#----------------------------------------------------------------------------------------
+# CHUNKS
+
+def test_near_duplicate_chunks_are_represented_by_the_first_one(monkeypatch):
+    monkeypatch.setattr(deduplication, 'chunk_index', None)
+    text = "To submit a job, write a batch script describing the resources it needs and pass it to the scheduler from a login node. " * 3
+    first = deduplication.find_representative_chunk('first', deduplication.compute_chunk_fingerprint(text))
+    copy = deduplication.find_representative_chunk('copy', deduplication.compute_chunk_fingerprint(text + " Last updated in May."))
+    other = deduplication.find_representative_chunk('other', deduplication.compute_chunk_fingerprint("Log files are written to the scratch folder of the job, and kept for a week."))
+    assert (first, copy, other) == ('first', 'first', 'other')
+
+
+def test_chunks_are_their_own_representative_when_disabled(monkeypatch):
+    monkeypatch.setattr(deduplication, 'chunk_index', None)
+    monkeypatch.setattr(deduplication, 'chunk_deduplication', False)
+    text = "To submit a job, write a batch script and pass it to the scheduler."
+    assert deduplication.compute_chunk_fingerprint(text) is None
+    assert deduplication.find_representative_chunk('copy', deduplication.compute_chunk_fingerprint(text)) == 'copy'
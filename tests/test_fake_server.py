@@ -0,0 +1,64 @@
+import asyncio
+import question_extractor
+from question_extractor.fake_server import FakeModel
+from question_extractor.token_counting import count_tokens_text
+from question_extractor.prompts import create_extraction_conversation_messages, create_answering_conversation_messages, create_batch_answering_conversation_messages
+
+def complete(fake_model, messages, max_tokens=500, model='gpt-3.5-turbo'):
+    return asyncio.run(fake_model.complete(messages, max_tokens, model=model))
+
+
+def get_text(response):
+    status, body, _ = response
+    assert status == 200
+    return body['choices'][0]['message']['content']
+
+#----------------------------------------------------------------------------------------
+# OUTPUTS
+
+def test_outputs_follow_the_prompt_and_are_deterministic():
+    fake_model = FakeModel(latency_mean=0.0, questions_per_100_tokens=5)
+    text = ' '.join(f"word{index}" for index in range(100))
+    questions_output = get_text(complete(fake_model, create_extraction_conversation_messages(text)))
+    questions = question_extractor.extract_questions_from_output(questions_output)
+    assert len(questions) == count_tokens_text(text) * 5 // 100
+    assert get_text(complete(FakeModel(latency_mean=0.0, questions_per_100_tokens=5), create_extraction_conversation_messages(text))) == questions_output
+
+    answers_output = get_text(complete(fake_model, create_batch_answering_conversation_messages(questions, text), max_tokens=2000))
+    assert sorted(question_extractor.extract_answers_from_output(answers_output, len(questions))) == list(range(len(questions)))
+    assert get_text(complete(fake_model, create_answering_conversation_messages(questions[0], text))).startswith("Answer")
+
+
+def test_outputs_are_truncated_to_max_tokens():
+    status, body, _ = complete(FakeModel(latency_mean=0.0, answer_words=200), create_answering_conversation_messages("What is a node?", "Text."), max_tokens=20)
+    assert body['choices'][0]['finish_reason'] == 'length'
+    assert body['usage']['completion_tokens'] <= 20
+
+#----------------------------------------------------------------------------------------
+# ERRORS
+
+def test_calls_past_the_context_window_are_rejected():
+    status, body, _ = complete(FakeModel(latency_mean=0.0), create_answering_conversation_messages("What is a node?", "Text."), max_tokens=10**6)
+    assert (status, body['error']['type']) == (400, 'context_length_exceeded')
+
+
+def test_rate_limits_and_overload_are_reported_with_a_delay():
+    messages = create_answering_conversation_messages("What is a node?", "Text.")
+    fake_model = FakeModel(latency_mean=0.0, requests_per_minute=1)
+    assert complete(fake_model, messages)[0] == 200
+    status, _, headers = complete(fake_model, messages)
+    assert (status, fake_model.stats['nb_rate_limited']) == (429, 1)
+    assert float(headers['Retry-After']) > 0
+
+    async def run():
+        fake_model = FakeModel(latency_mean=0.05, latency_sigma=0.0, max_concurrent_requests=2)
+        responses = await asyncio.gather(*[fake_model.complete(messages, 100) for _ in range(3)])
+        return [status for status, _, _ in responses]
+    assert sorted(asyncio.run(run())) == [200, 200, 429]
+
+
+def test_failures_are_drawn_at_the_given_rate():
+    fake_model = FakeModel(latency_mean=0.0, failure_rate=0.5)
+    statuses = [complete(fake_model, create_answering_conversation_messages(f"What is point {index}?", "Text."))[0] for index in range(200)]
+    assert set(statuses) == {200, 500}
+    assert 60 < statuses.count(500) < 140
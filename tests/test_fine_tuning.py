@@ -0,0 +1,74 @@
+import io
+import json
+import pytest
+from question_extractor import fine_tuning
+from question_extractor.fine_tuning import read_json_array, convert_to_fine_tuning_formats
+
+def make_records(nb_records):
+    return [{'source': f"doc{index}.md", 'question': f"What is point {index}?", 'answer': f"Point {index} is a point, [described] in \"doc{index}\"."}
+            for index in range(nb_records)]
+
+
+def read_lines(paths):
+    return [json.loads(line) for path in paths for line in open(path, encoding='utf-8')]
+
+#----------------------------------------------------------------------------------------
+# READING
+
+def test_json_arrays_are_read_across_buffer_boundaries(monkeypatch):
+    records = make_records(20)
+    monkeypatch.setattr(fine_tuning, 'read_size', 7)
+    assert list(read_json_array(io.StringIO(json.dumps(records, indent=2)))) == records
+    assert list(read_json_array(io.StringIO(' [ ] '))) == []
+
+#----------------------------------------------------------------------------------------
+# CONVERSION
+
+def test_json_arrays_and_jsonl_files_give_the_same_examples(tmp_path):
+    records = make_records(5)
+    (tmp_path / 'records.json').write_text(json.dumps(records), encoding='utf-8')
+    (tmp_path / 'records.jsonl').write_text(''.join(json.dumps(record) + '\n' for record in records), encoding='utf-8')
+    reports = [convert_to_fine_tuning_formats(tmp_path / name, tmp_path / name.replace('.', '_'), "System prompt.", max_workers=1, verbose=False)
+               for name in ('records.json', 'records.jsonl')]
+    for output_type in fine_tuning.fine_tune_types:
+        assert read_lines(reports[0]['files'][output_type]) == read_lines(reports[1]['files'][output_type])
+    assert read_lines(reports[0]['files']['palm2']) == [{'input_text': record['question'], 'output_text': record['answer']} for record in records]
+    assert read_lines(reports[0]['files']['openai'])[0]['messages'][0] == {'role': 'system', 'content': "System prompt."}
+
+
+def test_workers_keep_the_order_of_the_input(tmp_path, monkeypatch):
+    records = make_records(25)
+    monkeypatch.setattr(fine_tuning, 'records_per_task', 2)
+    (tmp_path / 'records.json').write_text(json.dumps(records), encoding='utf-8')
+    report = convert_to_fine_tuning_formats(tmp_path / 'records.json', tmp_path, "System prompt.", output_types=['azure_openai'], max_workers=2, verbose=False)
+    assert report['nb_records'] == 25
+    assert read_lines(report['files']['azure_openai']) == [{'prompt': record['question'], 'completion': record['answer']} for record in records]
+
+
+def test_shards_replace_the_files_of_a_previous_conversion(tmp_path, monkeypatch):
+    (tmp_path / 'records.json').write_text(json.dumps(make_records(5)), encoding='utf-8')
+    monkeypatch.setattr(fine_tuning, 'max_shard_bytes', None)
+    monkeypatch.setattr(fine_tuning, 'max_shard_records', 1)
+    convert_to_fine_tuning_formats(tmp_path / 'records.json', tmp_path / 'output', "System prompt.", output_types=['palm2'], max_workers=1, verbose=False)
+    assert len(list((tmp_path / 'output').iterdir())) == 5
+
+    monkeypatch.setattr(fine_tuning, 'max_shard_records', 2)
+    report = convert_to_fine_tuning_formats(tmp_path / 'records.json', tmp_path / 'output', "System prompt.", output_types=['palm2'], max_workers=1, verbose=False)
+    assert sorted(path.name for path in (tmp_path / 'output').iterdir()) == ['fine_tune_palm2-00000.jsonl', 'fine_tune_palm2-00001.jsonl', 'fine_tune_palm2-00002.jsonl']
+    assert len(read_lines(report['files']['palm2'])) == 5
+
+
+def test_oversized_examples_are_left_out_and_reported(tmp_path, monkeypatch, capsys):
+    records = make_records(3)
+    records[1]['answer'] = ' '.join(['word'] * 200)
+    (tmp_path / 'records.json').write_text(json.dumps(records), encoding='utf-8')
+    monkeypatch.setattr(fine_tuning, 'max_example_tokens', 100)
+    report = convert_to_fine_tuning_formats(tmp_path / 'records.json', tmp_path, "System prompt.", output_types=['palm2'], max_workers=1)
+    assert report['nb_oversized'] == 1
+    assert [example['input_text'] for example in read_lines(report['files']['palm2'])] == ["What is point 0?", "What is point 2?"]
+    assert "What is point 1?" in capsys.readouterr().out
+
+
+def test_unknown_formats_are_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        convert_to_fine_tuning_formats(tmp_path / 'records.json', tmp_path, "System prompt.", output_types=['unknown'], verbose=False)
@@ -0,0 +1,67 @@
+import json
+import time
+import asyncio
+from question_extractor import instrumentation
+from question_extractor.instrumentation import Metrics, format_duration
+
+#----------------------------------------------------------------------------------------
+# METRICS
+
+def test_counters_are_summed_over_matching_labels():
+    metrics = Metrics()
+    metrics.increment('calls_total', stage='extraction', outcome='success')
+    metrics.increment('calls_total', 2, stage='answering', outcome='success')
+    metrics.increment('calls_total', stage='answering', outcome='error')
+    assert metrics.get_counter('calls_total') == 4
+    assert metrics.get_counter('calls_total', stage='answering') == 3
+    assert metrics.get_counter('calls_total', outcome='error') == 1
+    assert metrics.get_counter('other_total') == 0
+
+
+def test_metrics_are_exported_in_the_prometheus_format(tmp_path):
+    metrics = Metrics()
+    metrics.increment('calls_total', stage='answering')
+    metrics.set('concurrency_limit', 8)
+    metrics.observe('latency_seconds', 1.0)
+    metrics.observe('latency_seconds', 3.0)
+    lines = metrics.to_prometheus_text().splitlines()
+    assert 'question_extractor_calls_total{stage="answering"} 1' in lines
+    assert 'question_extractor_concurrency_limit 8' in lines
+    assert ['question_extractor_latency_seconds_count 2', 'question_extractor_latency_seconds_sum 4.0', 'question_extractor_latency_seconds_max 3.0'] == \
+           [line for line in lines if line.startswith('question_extractor_latency_seconds')]
+
+    metrics.export(tmp_path)
+    assert (tmp_path / 'metrics.prom').read_text(encoding='utf-8') == metrics.to_prometheus_text()
+    assert json.loads((tmp_path / 'trace.json').read_text(encoding='utf-8')) == {'traceEvents': []}
+
+#----------------------------------------------------------------------------------------
+# TRACE
+
+def test_spans_of_a_task_share_a_row_of_the_trace(monkeypatch):
+    metrics = Metrics()
+
+    async def run(name):
+        with metrics.span('call', stage=name):
+            await asyncio.sleep(0.01)
+        with metrics.span('call', stage=name):
+            pass
+
+    async def run_all():
+        await asyncio.gather(run('extraction'), run('answering'))
+    asyncio.run(run_all())
+    rows = {}
+    for event in metrics.trace_events:
+        rows.setdefault(event['args']['stage'], set()).add(event['tid'])
+    assert len(rows['extraction']) == len(rows['answering']) == 1
+    assert rows['extraction'] != rows['answering']
+    assert metrics.get_summary('call_seconds')['count'] == 4
+    assert metrics.get_summary('call_seconds')['sum'] >= 0.02
+
+    monkeypatch.setattr(instrumentation, 'max_trace_events', 4)
+    metrics.record_span('call', time.time(), duration=1.0)
+    assert len(metrics.trace_events) == 4
+    assert metrics.get_summary('call_seconds')['count'] == 5
+
+
+def test_durations_are_formatted_as_hours_minutes_seconds():
+    assert format_duration(3725.6) == "1:02:05"
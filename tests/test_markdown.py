@@ -0,0 +1,138 @@
+import os
+import random
+from question_extractor.markdown import parse_markdown_tree, cut_markdown_tree, is_body_line, scan_markdown_files, load_markdown_files_from_directory
+
+
+def count_words(text):
+    return len(text.split())
+
+
+def cut(text, budget):
+    """
+    Splits a text into chunks of at most `budget` words.
+    """
+    return cut_markdown_tree(parse_markdown_tree(text, count_words), 'f.md', lambda token_count: token_count <= budget)
+
+
+def words(nb_words, prefix='w'):
+    return ' '.join(f"{prefix}{index}" for index in range(nb_words))
+
+#----------------------------------------------------------------------------------------
+# LOADING
+
+def make_corpus(folder):
+    for relative_path in ['a.md', 'notes.txt', 'guide/b.md', 'guide/deep/c.md', 'drafts/d.md', 'guide/e.draft.md']:
+        (folder / relative_path).parent.mkdir(parents=True, exist_ok=True)
+        (folder / relative_path).write_text(f"# {relative_path}\n", encoding='utf-8')
+
+
+def test_scan_finds_markdown_files_in_all_subfolders(tmp_path):
+    make_corpus(tmp_path)
+    markdown_files = list(scan_markdown_files(tmp_path, max_workers=2))
+    assert sorted(markdown_file.relative_path for markdown_file in markdown_files) == ['a.md', 'drafts/d.md', 'guide/b.md', 'guide/deep/c.md', 'guide/e.draft.md']
+    assert all(markdown_file.size == len(markdown_file.read()) for markdown_file in markdown_files)
+    assert sorted(load_markdown_files_from_directory(tmp_path)) == sorted((markdown_file.path, markdown_file.read()) for markdown_file in markdown_files)
+
+
+def test_excluded_folders_and_files_are_skipped(tmp_path):
+    make_corpus(tmp_path)
+    markdown_files = scan_markdown_files(tmp_path, include_patterns=('*.md', '*.txt'), exclude_patterns=('drafts', '*.draft.md'))
+    assert sorted(markdown_file.relative_path for markdown_file in markdown_files) == ['a.md', 'guide/b.md', 'guide/deep/c.md', 'notes.txt']
+
+
+def test_symbolic_link_loops_are_not_followed(tmp_path):
+    make_corpus(tmp_path)
+    os.symlink(tmp_path, tmp_path / 'guide' / 'loop')
+    assert len(list(scan_markdown_files(tmp_path))) == 5
+
+#----------------------------------------------------------------------------------------
+# HEADINGS
+
+def test_no_chunk_is_made_of_headings_only():
+    text = f"# T\n\n## T1\n\n{words(8, 'a')}\n\n## T2\n\n{words(8, 'b')}\n\n{words(8, 'c')}\n\n## T3\n"
+    chunks = cut(text, 12)
+    assert len(chunks) > 0
+    for _, chunk_text in chunks:
+        assert any(is_body_line(line) for line in chunk_text.split('\n')), chunk_text
+
+
+def test_headings_go_with_the_first_piece_of_their_body():
+    chunks = dict(cut(f"# T\n\n## T2\n\n{words(8, 'b')}\n\n{words(8, 'c')}\n", 12))
+    assert chunks['f.md/##t2/part-1'].startswith('# T\n\n## T2\n\nb0')
+
+
+def test_heading_of_a_section_without_body_goes_with_its_first_subsection():
+    text = f"# T\n\n## A\n\n### A1\n\n{words(8, 'a')}\n\n### A2\n\n{words(8, 'b')}\n"
+    chunks = cut(text, 12)
+    assert chunks[0][1].startswith('# T\n\n## A\n\n### A1\n\na0')
+    assert sum(chunk_text.count('## A\n') for _, chunk_text in chunks) == 1
+
+
+def test_headings_go_with_the_first_piece_of_an_overlong_line():
+    chunks = cut(f"# T\n\n## A\n\n{words(30, 'a')}\n", 12)
+    assert chunks[0][1].startswith('# T\n\n## A\n\na0')
+    assert all(count_words(chunk_text) <= 12 for _, chunk_text in chunks)
+
+#----------------------------------------------------------------------------------------
+# INVARIANTS
+
+def make_document(seed):
+    """
+    Builds a random markdown document mixing nested headings, paragraphs, lists and overlong lines,
+    every body word being unique so that it can be tracked across chunks.
+    """
+    rng = random.Random(seed)
+    lines = []
+    nb_words = 0
+    for section in range(rng.randint(1, 6)):
+        lines.append(f"{'#' * rng.randint(1, 4)} Title {section}")
+        lines.append('')
+        for _ in range(rng.randint(0, 4)):
+            prefix = rng.choice(['', '- ', '1. '])
+            nb_line_words = rng.choice([1, 3, 7, 15, 40])
+            lines.append(prefix + ' '.join(f"s{section}w{nb_words + index}." if (index % 5 == 4) else f"s{section}w{nb_words + index}"
+                                           for index in range(nb_line_words)))
+            lines.append('')
+            nb_words += nb_line_words
+    return '\n'.join(lines) + '\n'
+
+
+def body_words(text):
+    return [word.strip('.') for line in text.split('\n') if is_body_line(line) for word in line.split() if word not in ('-', '1.')]
+
+
+def test_cutting_loses_no_text_and_respects_the_budget():
+    for seed in range(200):
+        text = make_document(seed)
+        for budget in (12, 20, 50, 1000):
+            chunks = cut(text, budget)
+            assert len({chunk_path for chunk_path, _ in chunks}) == len(chunks)
+            for _, chunk_text in chunks:
+                assert count_words(chunk_text) <= budget, (seed, budget, chunk_text)
+            chunked_words = [word for _, chunk_text in chunks for word in body_words(chunk_text)]
+            assert sorted(chunked_words) == sorted(body_words(text)), (seed, budget)
+
+#----------------------------------------------------------------------------------------
+# OVERLONG LINES
+
+def count_characters(text):
+    return len(text)
+
+
+def test_overlong_lines_keep_their_whitespace():
+    line = '    ' + ' '.join(f"w{index}\t=  {index};" for index in range(40))
+    chunks = cut(f"# T\n\n{line}\n", 12)
+    assert len(chunks) > 1
+    for _, chunk_text in chunks:
+        body = chunk_text.split('\n\n', 1)[1] if chunk_text.startswith('# T') else chunk_text
+        assert body in line, body
+    assert chunks[0][1].startswith('# T\n\n    w0\t=  0;')
+
+
+def test_overlong_words_are_cut_rather_than_dropped():
+    blob = ''.join(chr(ord('a') + index % 26) for index in range(1000))
+    text = f"# T\n\nSee {blob} for details.\n"
+    chunks = cut_markdown_tree(parse_markdown_tree(text, count_characters), 'f.md', lambda token_count: token_count <= 100)
+    assert all(len(chunk_text) <= 100 for _, chunk_text in chunks)
+    bodies = [chunk_text.split('\n\n', 1)[1] if chunk_text.startswith('# T') else chunk_text for _, chunk_text in chunks]
+    assert ''.join(body.replace(' ', '') for body in bodies) == f"See{blob}fordetails."
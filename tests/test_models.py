@@ -0,0 +1,59 @@
+import asyncio
+import pytest
+import question_extractor
+from question_extractor import models, token_counting
+from question_extractor.models import register_model, get_model, get_stage_model
+from question_extractor.fake_server import FakeModel, FakeBackend
+from question_extractor.prompts import create_extraction_conversation_messages, create_answering_conversation_messages
+from question_extractor.token_counting import count_tokens_messages, are_tokens_available_for_both_conversations
+
+@pytest.fixture
+def registry(monkeypatch):
+    """
+    Gives each test its own copy of the registry and of the routing of stages.
+    """
+    monkeypatch.setattr(models, 'models', dict(models.models))
+    monkeypatch.setattr(models, 'stage_models', dict(models.stage_models))
+    monkeypatch.setattr(token_counting, 'token_statistics', None)
+    return models.models
+
+#----------------------------------------------------------------------------------------
+# REGISTRY
+
+def test_registered_models_can_be_routed_to(registry):
+    register_model('local-model', context_window=32768, tokens_per_message=5, tokens_per_name=0)
+    models.stage_models['answering'] = 'local-model'
+    assert get_stage_model('answering') == 'local-model'
+    assert get_stage_model('unknown stage') == models.default_model
+    assert get_model('local-model')['context_window'] == 32768
+    messages = create_answering_conversation_messages("What is a node?", "Text.")
+    assert count_tokens_messages(messages, model='local-model') - count_tokens_messages(messages, model='gpt-4') == 3 * (5 - 3) + 3 * (0 - 1)
+
+
+def test_unknown_models_are_rejected(registry):
+    with pytest.raises(ValueError, match='register_model'):
+        get_model('unknown-model')
+
+#----------------------------------------------------------------------------------------
+# ROUTING
+
+def test_chunks_fit_the_context_of_the_model_of_each_stage(isolated_pipeline, registry):
+    register_model('wide-model', context_window=16384)
+    assert not are_tokens_available_for_both_conversations(4000)
+    models.stage_models['answering'] = 'wide-model'
+    assert not are_tokens_available_for_both_conversations(4000)
+    models.stage_models['extraction'] = 'wide-model'
+    assert are_tokens_available_for_both_conversations(4000)
+
+
+def test_calls_are_sent_to_the_model_of_their_stage(isolated_pipeline, registry, monkeypatch):
+    register_model('local-model', context_window=16384)
+    models.stage_models['extraction'] = 'local-model'
+    fake_model = FakeModel(latency_mean=0.01, latency_sigma=0.0)
+    monkeypatch.setattr(question_extractor, 'backend', FakeBackend(fake_model))
+
+    async def run():
+        await question_extractor.run_model(create_extraction_conversation_messages("Some documentation text."), stage='extraction')
+        await question_extractor.run_model(create_answering_conversation_messages("What is a node?", "Some documentation text."), stage='answering')
+    asyncio.run(run())
+    assert fake_model.stats['nb_requests_per_model'] == {'local-model': 1, 'gpt-3.5-turbo': 1}
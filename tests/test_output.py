@@ -0,0 +1,39 @@
+from question_extractor.state import Manifest
+from question_extractor.output import write_normalized_output, read_normalized_output, read_jsonl
+
+def make_manifest(folder):
+    """
+    Returns a manifest holding two files: `a.md` with two chunks (the second one without any answer yet) and `b.md` with one chunk.
+    """
+    manifest = Manifest(folder / 'manifest.sqlite')
+    manifest.set_file('a.md', 'ha', [('a.md/part-1', 'c1'), ('a.md/part-2', 'c2')])
+    manifest.set_file('b.md', 'hb', [('b.md', 'c3')])
+    manifest.set_questions('c1', ['q1', 'q2', 'q3'], text='text of part 1')
+    manifest.set_answer('c1', 0, 'a1')
+    manifest.set_answer('c1', 2, 'a3')
+    manifest.set_questions('c2', ['q4'], text='text of part 2')
+    manifest.set_questions('c3', ['q5'], text='text of b')
+    manifest.set_answer('c3', 0, 'a5')
+    return manifest
+
+#----------------------------------------------------------------------------------------
+# NORMALIZED OUTPUT
+
+def test_records_survive_a_round_trip(tmp_path):
+    manifest = make_manifest(tmp_path)
+    assert write_normalized_output(manifest, tmp_path / 'output') == 3
+    expected_records = manifest.get_records('a.md', max_qa_pairs=10) + manifest.get_records('b.md', max_qa_pairs=10)
+    assert list(read_normalized_output(tmp_path / 'output')) == expected_records
+
+
+def test_chunk_texts_are_stored_once(tmp_path):
+    write_normalized_output(make_manifest(tmp_path), tmp_path / 'output')
+    chunks = list(read_jsonl(tmp_path / 'output' / 'chunks.jsonl'))
+    assert [(chunk['source'], chunk['text']) for chunk in chunks] == [('a.md/part-1', 'text of part 1'), ('b.md', 'text of b')]
+    records = list(read_normalized_output(tmp_path / 'output', include_text=True))
+    assert [record['text'] for record in records] == ['text of part 1', 'text of part 1', 'text of b']
+
+
+def test_questions_past_the_limit_are_not_written(tmp_path):
+    assert write_normalized_output(make_manifest(tmp_path), tmp_path / 'output', max_qa_pairs=2) == 2
+    assert [record['question'] for record in read_normalized_output(tmp_path / 'output')] == ['q1', 'q5']
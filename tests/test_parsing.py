@@ -0,0 +1,99 @@
+import random
+from question_extractor import extract_questions_from_output, extract_answers_from_output, QuestionStreamParser
+
+#----------------------------------------------------------------------------------------
+# QUESTIONS
+
+extraction_output = """Here are some questions:
+1. What is a node?
+2. How do I submit a job (with sbatch)
+3. Where is the scratch storage?
+  4. What is the quota
+5. Which compiler should I use?
+6. How do I log"""
+
+
+def feed_in_pieces(output, piece_sizes):
+    """
+    Feeds an output to a `QuestionStreamParser` in pieces of the given sizes, returning the questions emitted.
+    """
+    parser = QuestionStreamParser()
+    questions = []
+    position = 0
+    for piece_size in piece_sizes:
+        questions.extend(parser.feed(output[position:position + piece_size]))
+        position += piece_size
+    questions.extend(parser.feed(output[position:]))
+    questions.extend(parser.finish())
+    return questions
+
+
+def test_questions_are_read_from_a_numbered_list():
+    assert extract_questions_from_output(extraction_output) == ['What is a node?', 'How do I submit a job (with sbatch)', 'Where is the scratch storage?',
+                                                                'What is the quota', 'Which compiler should I use?']
+
+
+def test_streamed_questions_match_the_full_output_whatever_the_pieces():
+    expected_questions = extract_questions_from_output(extraction_output)
+    assert feed_in_pieces(extraction_output, [1] * len(extraction_output)) == expected_questions
+    assert feed_in_pieces(extraction_output, [len(extraction_output)]) == expected_questions
+    generator = random.Random(0)
+    for _ in range(20):
+        assert feed_in_pieces(extraction_output, [generator.randint(1, 15) for _ in range(20)]) == expected_questions
+
+
+def test_questions_are_emitted_as_soon_as_they_are_complete():
+    parser = QuestionStreamParser()
+    assert parser.feed("1. What is a node?") == []
+    assert parser.feed("\n2. What is the quota") == ['What is a node?']
+    # A question without final punctuation is held until the next question shows it was not the last one
+    assert parser.feed("\n") == []
+    assert parser.feed("3. Where is scratch?\n") == ['What is the quota', 'Where is scratch?']
+    assert parser.finish() == []
+
+
+def test_restarted_calls_do_not_emit_questions_twice():
+    parser = QuestionStreamParser()
+    assert parser.feed("1. What is a node?\n2. What is a job?\n") == ['What is a node?', 'What is a job?']
+    parser.feed(None)
+    assert parser.feed("1. What is a node?\n2. What is a job?\n3. What is a queue?\n") == ['What is a queue?']
+    assert parser.finish() == []
+    assert parser.questions == ['What is a node?', 'What is a job?', 'What is a queue?']
+
+#----------------------------------------------------------------------------------------
+# BATCH ANSWERS
+
+def test_answers_are_read_from_a_json_array():
+    output = 'Here are the answers:\n[{"id": 1, "answer": "First."}, {"id": "2", "answer": " Second. "}]\nDone.'
+    assert extract_answers_from_output(output, 2) == {0: 'First.', 1: 'Second.'}
+
+
+def test_json_answers_with_unknown_ids_or_empty_answers_are_dropped():
+    output = '[{"id": 1, "answer": ""}, {"id": 2, "answer": "Second."}, {"id": 3, "answer": "Third."}, {"answer": "No id."}]'
+    assert extract_answers_from_output(output, 2) == {1: 'Second.'}
+
+
+def test_numbered_answers_are_accepted_as_a_fallback():
+    output = "1. First answer,\non two lines.\n2) Second answer.\n3. Answer to a question that was not asked."
+    assert extract_answers_from_output(output, 2) == {0: 'First answer,\non two lines.', 1: 'Second answer.'}
+
+
+def test_indented_numbered_lists_stay_inside_their_answer():
+    output = "1. Install it:\n   1. download the archive,\n   2. run the installer.\n2. Second answer."
+    answers = extract_answers_from_output(output, 2)
+    assert answers[0] == "Install it:\n   1. download the archive,\n   2. run the installer."
+    assert answers[1] == "Second answer."
+
+
+def test_unindented_numbered_lists_stay_inside_their_answer():
+    output = "1. Install it:\n1. download the archive,\n2. run the installer.\n2. Second answer.\n3. Third answer:\n1. one\n2. two\n3. three\n4. four\n4. Fourth answer."
+    answers = extract_answers_from_output(output, 4)
+    assert answers[0] == "Install it:\n1. download the archive,\n2. run the installer."
+    assert answers[1] == "Second answer."
+    assert answers[2] == "Third answer:\n1. one\n2. two\n3. three\n4. four"
+    assert answers[3] == "Fourth answer."
+
+
+def test_numbers_inside_sentences_are_not_answer_markers():
+    output = "1. It needs\n2.5 GB of memory.\n2. Second answer."
+    assert extract_answers_from_output(output, 2) == {0: "It needs\n2.5 GB of memory.", 1: "Second answer."}
@@ -0,0 +1,231 @@
+import json
+import time
+import random
+import asyncio
+import question_extractor
+from question_extractor import state, models, deduplication, split_and_fingerprint_text, split_and_fingerprint_text_in_thread, ChunkQuestionCollector
+from question_extractor.deduplication import QuestionDeduplicator
+from question_extractor.fake_server import FakeModel, FakeBackend
+from question_extractor.instrumentation import metrics
+
+def make_document(nb_sections, nb_words=400):
+    return '\n\n'.join(f"# Section {section}\n\n" + ' '.join(f"s{section}w{index}" for index in range(nb_words)) for section in range(nb_sections))
+
+#----------------------------------------------------------------------------------------
+# SPLITTING
+
+def test_splitting_threads_do_not_touch_shared_statistics(isolated_pipeline):
+    chunks, stats = split_and_fingerprint_text('f.md', make_document(3))
+    assert question_extractor.splitting_stats == {'nb_unpacked_chunks': 0, 'nb_chunks': 0}
+    assert stats['nb_chunks'] == len(chunks) > 0
+    assert stats['duration'] >= 0
+
+
+def test_splitting_statistics_are_recorded_on_the_event_loop(isolated_pipeline):
+    nb_spans = metrics.get_summary('splitting_seconds')['count']
+
+    async def run():
+        return await asyncio.gather(*[split_and_fingerprint_text_in_thread(f"f{index}.md", make_document(index + 1)) for index in range(8)])
+
+    files_chunks = asyncio.run(run())
+    assert question_extractor.splitting_stats['nb_chunks'] == sum(len(chunks) for chunks in files_chunks)
+    assert metrics.get_summary('splitting_seconds')['count'] == nb_spans + 8
+
+#----------------------------------------------------------------------------------------
+# PROCESSING FILES
+
+def process_files(files, max_qa_pairs=300):
+    """
+    Processes `(path, text)` files concurrently, returning their records and saving the manifest.
+    """
+    async def run():
+        progress_counter = {'nb_files_done': 0, 'nb_files': len(files), 'start_time': time.time()}
+        results = await asyncio.gather(*[question_extractor.process_file(file_path, text, progress_counter, verbose=False, max_qa_pairs=max_qa_pairs)
+                                         for file_path, text in files])
+        await question_extractor.save_manifest([file_path for file_path, _ in files], verbose=False)
+        return results
+    return asyncio.run(run())
+
+
+def use_fake_model(monkeypatch):
+    fake_model = FakeModel(latency_mean=0.01, latency_sigma=0.0, questions_per_100_tokens=2)
+    monkeypatch.setattr(question_extractor, 'backend', FakeBackend(fake_model))
+    return fake_model
+
+
+def test_copies_of_a_chunk_are_extracted_and_answered_once(isolated_pipeline, monkeypatch):
+    fake_model = use_fake_model(monkeypatch)
+    text = make_document(1, nb_words=200)
+    [records] = process_files([('a.md', text)])
+    nb_calls = fake_model.stats['nb_completions']
+
+    state.get_manifest().close()
+    monkeypatch.setattr(state, 'state_folder', isolated_pipeline / 'other_state')
+    monkeypatch.setattr(state, 'manifest', None)
+    monkeypatch.setattr(deduplication, 'chunk_index', None)
+    copies_records = process_files([('b.md', text), ('c.md', text)])
+    assert fake_model.stats['nb_completions'] == 2 * nb_calls
+    for file_path, file_records in zip(['b.md', 'c.md'], copies_records):
+        assert [(record['question'], record['answer']) for record in file_records] == [(record['question'], record['answer']) for record in records]
+        assert all(record['source'].startswith(file_path) for record in file_records)
+
+
+def test_unchanged_files_are_replayed_from_the_manifest(isolated_pipeline, monkeypatch):
+    fake_model = use_fake_model(monkeypatch)
+    files = [('a.md', make_document(2, nb_words=200)), ('b.md', make_document(1, nb_words=100))]
+    results = process_files(files)
+    nb_calls = fake_model.stats['nb_completions']
+
+    # A new run reads the manifest from disk
+    state.get_manifest().close()
+    monkeypatch.setattr(state, 'manifest', None)
+    assert process_files(files) == results
+    assert fake_model.stats['nb_completions'] == nb_calls
+
+
+def test_only_the_changed_chunks_of_an_edited_file_are_extracted_again(isolated_pipeline, monkeypatch):
+    fake_model = use_fake_model(monkeypatch)
+    monkeypatch.setitem(models.models['gpt-3.5-turbo'], 'context_window', 1200)
+    [records] = process_files([('a.md', make_page("A", 1, make_paragraph('footer')))])
+    nb_calls = fake_model.stats['nb_completions']
+
+    state.get_manifest().close()
+    monkeypatch.setattr(state, 'manifest', None)
+    [edited_records] = process_files([('a.md', make_page("A", 1, make_paragraph('new footer')))])
+    assert 0 < fake_model.stats['nb_completions'] - nb_calls < nb_calls
+    assert [record for record in edited_records if 'getting-help' not in record['source']] == [record for record in records if 'getting-help' not in record['source']]
+    assert len(state.get_manifest().chunks) == 2
+
+
+def test_questions_past_the_limit_are_not_in_the_records(isolated_pipeline, monkeypatch):
+    use_fake_model(monkeypatch)
+    [records] = process_files([('a.md', make_document(2, nb_words=200))], max_qa_pairs=3)
+    assert len(records) == 3
+
+#----------------------------------------------------------------------------------------
+# STREAMING
+
+def stream_files_to_jsonl(files, output_path):
+    """
+    Streams `(path, text)` files to a JSONL file, returning the records written and saving the manifest.
+    """
+    async def run():
+        await question_extractor.write_records_to_jsonl(question_extractor.stream_files(files, verbose=False), output_path)
+        await question_extractor.save_manifest([file_path for file_path, _ in files], verbose=False)
+    asyncio.run(run())
+    return [json.loads(line) for line in open(output_path, encoding='utf-8')]
+
+
+def test_files_are_read_only_when_a_worker_is_free(isolated_pipeline, monkeypatch):
+    use_fake_model(monkeypatch)
+    monkeypatch.setattr(question_extractor, 'max_files_in_flight', 2)
+    nb_files_read = []
+
+    def read_files():
+        for index in range(6):
+            nb_files_read.append(index)
+            yield f"f{index}.md", make_document(1, nb_words=100 + index)
+
+    async def run():
+        async for _ in question_extractor.stream_files(read_files(), verbose=False):
+            return len(nb_files_read)
+    assert asyncio.run(run()) < 6
+
+
+def test_resumed_streams_rewrite_their_output(isolated_pipeline, monkeypatch):
+    fake_model = use_fake_model(monkeypatch)
+    files = [(f"f{index}.md", make_document(2, nb_words=100 + index)) for index in range(4)]
+    records = stream_files_to_jsonl(files, isolated_pipeline / 'questions.jsonl')
+    assert {record['source'].split('/')[0] for record in records} == {file_path for file_path, _ in files}
+    nb_calls = fake_model.stats['nb_completions']
+
+    state.get_manifest().close()
+    monkeypatch.setattr(state, 'manifest', None)
+    resumed_records = stream_files_to_jsonl(files, isolated_pipeline / 'questions.jsonl')
+    assert sorted(map(json.dumps, resumed_records)) == sorted(map(json.dumps, records))
+    assert fake_model.stats['nb_completions'] == nb_calls
+
+#----------------------------------------------------------------------------------------
+# EARLY ANSWERING
+
+def collect_questions(monkeypatch, questions, deduplicator=None, max_qa_pairs=300, batch_answering=False):
+    """
+    Streams questions to a `ChunkQuestionCollector`, returning it and the batches of question indices it started answering.
+    """
+    started_batches = []
+    monkeypatch.setattr(question_extractor, 'batch_answering', batch_answering)
+    monkeypatch.setattr(question_extractor, 'start_answering', lambda chunk_path, chunk_text, chunk_hash, indices, batch_questions: started_batches.append(indices) or len(started_batches))
+    file_extraction = {'deduplicator': deduplicator, 'max_qa_pairs': max_qa_pairs, 'nb_questions_extracted': 0, 'answering_tasks': set()}
+    collector = ChunkQuestionCollector('a.md', "Some documentation text.", 'hash', file_extraction)
+    for index, question in enumerate(questions):
+        collector.on_question(index, question)
+    collector.answer_remaining_questions()
+    return collector, started_batches
+
+
+def test_questions_are_answered_as_they_are_streamed(isolated_pipeline, monkeypatch):
+    _, started_batches = collect_questions(monkeypatch, ["What is a node?", "What is a queue?", "What is a job?"])
+    assert started_batches == [[0], [1], [2]]
+
+
+def test_near_duplicate_questions_are_not_answered(isolated_pipeline, monkeypatch):
+    collector, started_batches = collect_questions(monkeypatch, ["What is a compute node?", "What is a compute node ?", "How do I submit a job?"],
+                                                   deduplicator=QuestionDeduplicator())
+    assert collector.kept_questions == ["What is a compute node?", "How do I submit a job?"]
+    assert started_batches == [[0], [1]]
+
+
+def test_questions_past_the_limit_are_kept_but_not_answered_early(isolated_pipeline, monkeypatch):
+    collector, started_batches = collect_questions(monkeypatch, ["What is a node?", "What is a queue?", "What is a job?"], max_qa_pairs=2)
+    assert len(collector.kept_questions) == 3
+    assert started_batches == [[0], [1]]
+
+
+def test_streamed_questions_are_answered_in_batches(isolated_pipeline, monkeypatch):
+    monkeypatch.setattr(question_extractor, 'max_questions_per_batch', 2)
+    _, started_batches = collect_questions(monkeypatch, ["What is a node?", "What is a queue?", "What is a job?"], batch_answering=True)
+    assert started_batches == [[0, 1], [2]]
+
+#----------------------------------------------------------------------------------------
+# NEAR-DUPLICATE CHUNKS
+
+def make_paragraph(seed, nb_words=300):
+    rng = random.Random(seed)
+    vocabulary = "cluster node job queue module storage quota login network compiler library scratch".split()
+    return ' '.join(rng.choice(vocabulary) for _ in range(nb_words)) + '.'
+
+
+def make_page(title, seed, footer):
+    return f"# {title}\n\n{make_paragraph(seed)}\n\n## Getting help\n\n{footer}\n"
+
+
+def test_near_duplicate_chunks_keep_their_representative_across_runs(isolated_pipeline, monkeypatch):
+    monkeypatch.setitem(models.models['gpt-3.5-turbo'], 'context_window', 1200)
+    use_fake_model(monkeypatch)
+    footer = make_paragraph('footer')
+    near_footer = footer.replace('cluster', 'clusters', 3)
+    [a_records] = process_files([('a.md', make_page("A", 1, footer))])
+    [c_records] = process_files([('c.md', make_page("C", 2, near_footer))])
+    a_footer_answers = [record['answer'] for record in a_records if 'getting-help' in record['source']]
+    assert [record['answer'] for record in c_records if 'getting-help' in record['source']] == a_footer_answers
+
+    # The next run edits the body of the page: its footer is mapped to the same chunk, with no new extraction for it
+    state.get_manifest().close()
+    monkeypatch.setattr(state, 'manifest', None)
+    monkeypatch.setattr(deduplication, 'chunk_index', None)
+    [c_records] = process_files([('a.md', make_page("A", 1, footer)), ('c.md', make_page("C", 3, near_footer))])[1:]
+    assert [record['answer'] for record in c_records if 'getting-help' in record['source']] == a_footer_answers
+
+
+def test_known_chunks_are_not_replaced_by_near_duplicates(isolated_pipeline, monkeypatch):
+    monkeypatch.setitem(models.models['gpt-3.5-turbo'], 'context_window', 1200)
+    use_fake_model(monkeypatch)
+    footer = make_paragraph('footer')
+    near_footer = footer.replace('cluster', 'clusters', 3)
+    # Both footers are extracted (chunk deduplication disabled), then a run sees the near copy first
+    monkeypatch.setattr(deduplication, 'chunk_deduplication', False)
+    [a_records, c_records] = process_files([('a.md', make_page("A", 1, footer)), ('c.md', make_page("C", 2, near_footer))])
+    monkeypatch.setattr(deduplication, 'chunk_deduplication', True)
+    [c_records_2, a_records_2] = process_files([('c.md', make_page("C", 4, near_footer)), ('a.md', make_page("A", 5, footer))])
+    for records, records_2 in [(a_records, a_records_2), (c_records, c_records_2)]:
+        assert [record['answer'] for record in records_2 if 'getting-help' in record['source']] == [record['answer'] for record in records if 'getting-help' in record['source']]
@@ -0,0 +1,53 @@
+import csv
+import pytest
+from question_extractor import token_counting
+from question_extractor.planning import plan_chunk, plan_directory, write_breakdown, estimate_minimum_wall_time, compute_cost
+
+@pytest.fixture
+def default_statistics(isolated_pipeline, monkeypatch):
+    """
+    Predicts with the default token statistics, rather than those learned by previous runs.
+    """
+    monkeypatch.setattr(token_counting, 'token_statistics', None)
+    return isolated_pipeline
+
+#----------------------------------------------------------------------------------------
+# PREDICTING
+
+def test_batches_answer_the_same_questions_with_fewer_calls(default_statistics):
+    plan = plan_chunk(2000, batch_answering=False, max_questions_per_batch=10, max_questions=300)
+    batched_plan = plan_chunk(2000, batch_answering=True, max_questions_per_batch=10, max_questions=300)
+    assert plan['nb_questions'] == batched_plan['nb_questions'] > 10
+    assert (plan['nb_extraction_calls'], plan['nb_answering_calls'], plan['nb_batch_answering_calls']) == (1, plan['nb_questions'], 0)
+    assert batched_plan['nb_answering_calls'] == batched_plan['nb_batch_answering_calls'] < plan['nb_answering_calls']
+    assert batched_plan['input_tokens'] < plan['input_tokens']
+    assert batched_plan['cost'] < plan['cost']
+    assert plan['cost'] == pytest.approx(compute_cost(plan['input_tokens'], plan['output_tokens']))
+
+
+def test_questions_past_the_limit_are_not_planned(default_statistics):
+    assert plan_chunk(2000, batch_answering=False, max_questions_per_batch=10, max_questions=3)['nb_answering_calls'] == 3
+
+
+def test_wall_time_is_bounded_by_the_scarcest_limit():
+    rate_limits = {'requests_per_minute': 100, 'tokens_per_minute': 10000}
+    assert estimate_minimum_wall_time(50, 5000, rate_limits) == 0.0
+    assert estimate_minimum_wall_time(300, 5000, rate_limits) == 120.0
+    assert estimate_minimum_wall_time(300, 100000, rate_limits) == 540.0
+
+#----------------------------------------------------------------------------------------
+# PLANNING
+
+def test_directory_plans_sum_their_files(default_statistics, tmp_path):
+    (tmp_path / 'docs').mkdir()
+    for index, nb_words in enumerate([50, 2000, 400]):
+        (tmp_path / 'docs' / f"f{index}.md").write_text(f"# File {index}\n\n" + ' '.join(f"w{word}" for word in range(nb_words)), encoding='utf-8')
+    plan = plan_directory(tmp_path / 'docs', max_workers=1)
+    assert [file_plan['path'].rsplit('/', 1)[-1] for file_plan in plan['files']] == ['f1.md', 'f2.md', 'f0.md']
+    for key in ['nb_chunks', 'nb_questions', 'nb_extraction_calls', 'nb_answering_calls', 'input_tokens']:
+        assert plan['totals'][key] == sum(file_plan[key] for file_plan in plan['files'])
+    assert plan['totals']['nb_extraction_calls'] == plan['totals']['nb_chunks'] >= 3
+
+    write_breakdown(plan, tmp_path / 'plan.csv')
+    with open(tmp_path / 'plan.csv', newline='', encoding='utf-8') as input_file:
+        assert [row['path'] for row in csv.DictReader(input_file)] == [file_plan['path'] for file_plan in plan['files']]
@@ -0,0 +1,86 @@
+import time
+import asyncio
+from question_extractor import rate_limiting
+from question_extractor.rate_limiting import RateLimiter, TokenBucket, get_rate_limiter
+
+def make_empty_limiter(requests_per_minute=1200, tokens_per_minute=60000):
+    """
+    Returns a limiter whose buckets are empty, so that every request has to wait (a few tens of milliseconds).
+    """
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    limiter.requests_bucket.level = 0
+    limiter.tokens_bucket.level = 0
+    return limiter
+
+async def admit_all(limiter, requests):
+    """
+    Queues the `(name, num_tokens, priority)` requests, in order, and returns their names in order of admission.
+    """
+    admitted = []
+    async def acquire(name, num_tokens, priority):
+        await limiter.acquire(num_tokens, priority)
+        admitted.append(name)
+    tasks = []
+    for request in requests:
+        tasks.append(asyncio.create_task(acquire(*request)))
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    return admitted
+
+#----------------------------------------------------------------------------------------
+# PRIORITY ADMISSION
+
+def test_lower_priorities_are_admitted_first():
+    admitted = asyncio.run(admit_all(make_empty_limiter(), [('c', 1, (3,)), ('a', 1, (1,)), ('b', 1, (2,)), ('a2', 1, (1,))]))
+    assert admitted == ['a', 'a2', 'b', 'c']
+
+
+def test_large_requests_are_not_starved_by_smaller_ones():
+    admitted = asyncio.run(admit_all(make_empty_limiter(), [('large', 50, (1,))] + [(f"small{index}", 1, (1,)) for index in range(5)]))
+    assert admitted[0] == 'large'
+
+
+def test_cancelled_request_does_not_block_the_queue():
+    async def run():
+        limiter = make_empty_limiter()
+        head = asyncio.create_task(limiter.acquire(10**6, (0,)))
+        await asyncio.sleep(0)
+        other = asyncio.create_task(limiter.acquire(1, (1,)))
+        await asyncio.sleep(0.01)
+        head.cancel()
+        await asyncio.wait_for(other, timeout=1.0)
+        return len(limiter.waiters)
+    assert asyncio.run(run()) == 0
+
+#----------------------------------------------------------------------------------------
+# TOKENS PER MINUTE
+
+def test_bucket_waits_for_the_missing_units():
+    bucket = TokenBucket(capacity=600, period=60.0)
+    bucket.consume(600)
+    assert 0.9 < bucket.time_until_available(10) <= 1.0
+    # debts are paid back before anything else is admitted, requests larger than the bucket wait for it to be full
+    bucket.consume(600)
+    assert 119 < bucket.time_until_available(10**6) <= 120
+
+
+def test_requests_wait_for_their_tokens_and_refunds_admit_them_earlier():
+    async def run():
+        limiter = RateLimiter(requests_per_minute=1000, tokens_per_minute=6000)
+        await limiter.acquire(6000)
+        waiting = asyncio.create_task(limiter.acquire(3000))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        start = time.monotonic()
+        limiter.refund(reserved_tokens=6000, used_tokens=1000)
+        await asyncio.wait_for(waiting, timeout=1.0)
+        return time.monotonic() - start
+    assert asyncio.run(run()) < 0.1
+
+
+def test_limits_are_shared_by_model_and_api_key(monkeypatch):
+    monkeypatch.setattr(rate_limiting, 'rate_limiters', {})
+    monkeypatch.setattr(rate_limiting, 'api_key_rate_limits', {'small-key': {'gpt-4': {'requests_per_minute': 10, 'tokens_per_minute': 1000}}})
+    assert get_rate_limiter('gpt-4', 'key') is get_rate_limiter('gpt-4', 'key')
+    assert get_rate_limiter('gpt-4', 'key') is not get_rate_limiter('gpt-3.5-turbo', 'key')
+    assert get_rate_limiter('gpt-4', 'small-key').tokens_bucket.capacity == 1000 * rate_limiting.rate_limit_usage_ratio
@@ -0,0 +1,180 @@
+import time
+import asyncio
+import pytest
+import question_extractor
+from question_extractor import retrying
+from question_extractor.retrying import AdaptiveConcurrencyLimiter, CircuitBreaker, CircuitOpenError, get_circuit_breaker
+from question_extractor.models import get_stage_model
+from question_extractor.prompts import create_answering_conversation_messages
+from question_extractor.fake_server import FakeModel, FakeBackend
+
+#----------------------------------------------------------------------------------------
+# ADAPTIVE CONCURRENCY
+
+def test_limiter_blocks_past_its_limit():
+    async def run():
+        limiter = AdaptiveConcurrencyLimiter(max_concurrency=10, initial=2)
+        first_start = await limiter.acquire()
+        await limiter.acquire()
+        third_call = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0.01)
+        assert not third_call.done()
+        limiter.release(first_start, 'failure')
+        await asyncio.wait_for(third_call, timeout=1)
+        assert limiter.nb_in_flight == 2
+    asyncio.run(run())
+
+
+def test_limiter_grows_on_success_and_halves_once_per_congestion():
+    limiter = AdaptiveConcurrencyLimiter(max_concurrency=100, initial=8)
+    # Slow start: each success adds a call until the first congestion
+    for _ in range(8):
+        limiter.nb_in_flight += 1
+        limiter.release(time.monotonic(), 'success')
+    assert limiter.limit == 16
+
+    # A burst of congestion signals from calls started before the decrease counts once
+    start_times = [time.monotonic() for _ in range(4)]
+    limiter.nb_in_flight += len(start_times)
+    for start_time in start_times:
+        limiter.release(start_time, 'congestion')
+    assert limiter.limit == 8
+
+    # After a congestion, the limit grows by one per round of successful calls
+    for _ in range(8):
+        limiter.nb_in_flight += 1
+        limiter.release(time.monotonic(), 'success')
+    assert limiter.limit == pytest.approx(9, abs=0.1)
+
+
+def test_limiter_never_exceeds_its_bounds():
+    limiter = AdaptiveConcurrencyLimiter(max_concurrency=4, initial=4)
+    for _ in range(10):
+        limiter.nb_in_flight += 1
+        limiter.release(time.monotonic(), 'success')
+    assert limiter.limit == 4
+    for _ in range(10):
+        limiter.nb_in_flight += 1
+        limiter.release(time.monotonic(), 'congestion')
+    assert limiter.limit >= retrying.min_concurrency
+
+#----------------------------------------------------------------------------------------
+# CIRCUIT BREAKER
+
+def open_circuit(circuit_breaker):
+    for _ in range(retrying.circuit_breaker_threshold):
+        circuit_breaker.record_failure()
+
+
+def test_circuit_opens_after_consecutive_failures(monkeypatch):
+    monkeypatch.setattr(retrying, 'circuit_breaker_threshold', 3)
+    circuit_breaker = CircuitBreaker('endpoint')
+    circuit_breaker.record_failure()
+    circuit_breaker.record_failure()
+    assert circuit_breaker.check() is False
+    circuit_breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        circuit_breaker.check()
+
+
+def test_half_open_circuit_lets_a_single_trial_through(monkeypatch):
+    monkeypatch.setattr(retrying, 'circuit_breaker_threshold', 3)
+    monkeypatch.setattr(retrying, 'circuit_breaker_cooldown', 0.0)
+
+    async def run():
+        circuit_breaker = CircuitBreaker('endpoint')
+        open_circuit(circuit_breaker)
+        assert circuit_breaker.check() is True
+        with pytest.raises(CircuitOpenError):
+            circuit_breaker.check()
+        circuit_breaker.record_success(is_trial=True)
+        assert circuit_breaker.check() is False
+    asyncio.run(run())
+
+
+def test_waiting_calls_learn_the_outcome_of_the_trial(monkeypatch):
+    monkeypatch.setattr(retrying, 'circuit_breaker_threshold', 3)
+    monkeypatch.setattr(retrying, 'circuit_breaker_cooldown', 0.0)
+
+    async def run(is_trial_successful):
+        circuit_breaker = CircuitBreaker('endpoint')
+        open_circuit(circuit_breaker)
+        circuit_breaker.check()
+        waiting_call = asyncio.create_task(circuit_breaker.wait_for_recovery())
+        await asyncio.sleep(0.01)
+        # The call keeps waiting for as long as the trial is in flight
+        assert not waiting_call.done()
+        if is_trial_successful:
+            circuit_breaker.record_success(is_trial=True)
+        else:
+            circuit_breaker.record_failure(is_trial=True)
+        return await asyncio.wait_for(waiting_call, timeout=1)
+
+    assert asyncio.run(run(True)) is True
+    assert asyncio.run(run(False)) is False
+
+#----------------------------------------------------------------------------------------
+# RUN MODEL
+
+def run_calls(nb_calls, stage='answering'):
+    """
+    Runs `nb_calls` distinct answering calls concurrently, returning their outputs.
+    """
+    async def run():
+        messages = [create_answering_conversation_messages(f"What is point {index}?", "Some documentation text.") for index in range(nb_calls)]
+        return await asyncio.gather(*[question_extractor.run_model(call_messages, stage=stage) for call_messages in messages])
+    return asyncio.run(run())
+
+
+def test_run_model_retries_server_errors(isolated_pipeline, monkeypatch):
+    fake_model = FakeModel(latency_mean=0.01, latency_sigma=0.0, failure_rate=0.3)
+    monkeypatch.setattr(question_extractor, 'backend', FakeBackend(fake_model))
+    outputs = run_calls(20)
+    assert fake_model.stats['nb_failures'] > 0
+    assert all(output is not None for output in outputs)
+    assert retrying.dead_letters == []
+
+
+def test_run_model_backs_off_on_rate_limits(isolated_pipeline, monkeypatch):
+    fake_model = FakeModel(latency_mean=0.02, latency_sigma=0.0, max_concurrent_requests=2)
+    monkeypatch.setattr(question_extractor, 'backend', FakeBackend(fake_model))
+    outputs = run_calls(20)
+    assert fake_model.stats['nb_rate_limited'] > 0
+    assert all(output is not None for output in outputs)
+    # The 429s shrank the number of calls in flight
+    assert question_extractor.get_throttler(get_stage_model('answering')).limit < retrying.initial_concurrency
+
+
+def test_run_model_dead_letters_calls_that_keep_failing(isolated_pipeline, monkeypatch):
+    monkeypatch.setattr(retrying, 'max_attempts', 3)
+    fake_model = FakeModel(latency_mean=0.0, latency_sigma=0.0, failure_rate=1.0)
+    monkeypatch.setattr(question_extractor, 'backend', FakeBackend(fake_model))
+    outputs = run_calls(2)
+    assert outputs == [None, None]
+    assert [dead_letter['nb_attempts'] for dead_letter in retrying.read_dead_letters()] == [3, 3]
+
+
+def test_calls_wait_for_a_slow_trial_call(isolated_pipeline, monkeypatch):
+    # Calls queued behind the trial call of a recovering endpoint wait for it rather than using up their attempts
+    monkeypatch.setattr(retrying, 'max_attempts', 2)
+    monkeypatch.setattr(retrying, 'circuit_breaker_cooldown', 0.0)
+    fake_model = FakeModel(latency_mean=0.3, latency_sigma=0.0)
+    monkeypatch.setattr(question_extractor, 'backend', FakeBackend(fake_model))
+    open_circuit(get_circuit_breaker(f"FakeBackend/{get_stage_model('answering')}"))
+    outputs = run_calls(10)
+    assert all(output is not None for output in outputs)
+    assert retrying.dead_letters == []
+
+
+def test_calls_give_up_while_trial_calls_fail(isolated_pipeline, monkeypatch):
+    # Each failed trial call uses up an attempt of the calls waiting for it, without them calling the endpoint
+    monkeypatch.setattr(retrying, 'max_attempts', 2)
+    monkeypatch.setattr(retrying, 'circuit_breaker_cooldown', 0.05)
+    fake_model = FakeModel(latency_mean=0.0, latency_sigma=0.0, failure_rate=1.0)
+    monkeypatch.setattr(question_extractor, 'backend', FakeBackend(fake_model))
+    circuit_breaker = get_circuit_breaker(f"FakeBackend/{get_stage_model('answering')}")
+    open_circuit(circuit_breaker)
+    circuit_breaker.opened_at -= retrying.circuit_breaker_cooldown
+    outputs = run_calls(10)
+    assert outputs == [None] * 10
+    assert fake_model.stats['nb_requests'] < 10
@@ -0,0 +1,74 @@
+import os
+import json
+import time
+import pytest
+from question_extractor import sharding
+from question_extractor.output import NormalizedWriter, read_normalized_output
+from question_extractor.sharding import get_shard_index, get_shard_folder, claim_shard, merge_shards, merge_normalized_shards
+
+def make_done_shards(folder, shards_records):
+    """
+    Writes the outputs of done shards, each given as a list of `{source, question, answer}` records.
+    """
+    for shard_index, records in enumerate(shards_records):
+        shard_folder = get_shard_folder(folder, shard_index, len(shards_records))
+        shard_folder.mkdir(parents=True)
+        (shard_folder / 'questions.jsonl').write_text(''.join(json.dumps(record) + '\n' for record in records), encoding='utf-8')
+        with NormalizedWriter(shard_folder / 'normalized') as writer:
+            for record in records:
+                writer.write_qa_pair(writer.write_chunk(record['source'], f"text of {record['source']}"), record['question'], record['answer'])
+        (shard_folder / 'done.json').write_text('{}', encoding='utf-8')
+
+
+def make_records(prefix, nb_records):
+    return [{'source': f"{prefix}{index}.md", 'question': f"What is {prefix}{index}?", 'answer': f"It is {prefix}{index}."} for index in range(nb_records)]
+
+#----------------------------------------------------------------------------------------
+# SHARDS
+
+def test_files_are_spread_over_all_shards():
+    shard_indices = [get_shard_index(f"docs/page-{index}.md", 4) for index in range(400)]
+    assert shard_indices == [get_shard_index(f"docs/page-{index}.md", 4) for index in range(400)]
+    assert all(60 < shard_indices.count(shard_index) < 140 for shard_index in range(4))
+
+#----------------------------------------------------------------------------------------
+# CLAIMS
+
+def test_a_shard_is_claimed_once_until_its_claim_is_abandoned(tmp_path, monkeypatch, capsys):
+    shard_folder = get_shard_folder(tmp_path, 0, 2)
+    assert claim_shard(shard_folder)
+    assert not claim_shard(shard_folder)
+
+    monkeypatch.setattr(sharding, 'claim_timeout', 60)
+    os.utime(shard_folder / 'claim.json', (time.time() - 120, time.time() - 120))
+    assert claim_shard(shard_folder)
+    assert 'Taking over' in capsys.readouterr().out
+    assert not claim_shard(shard_folder)
+
+
+def test_done_shards_are_not_claimed(tmp_path):
+    make_done_shards(tmp_path, [make_records('a', 1)])
+    assert not claim_shard(get_shard_folder(tmp_path, 0, 1))
+
+#----------------------------------------------------------------------------------------
+# MERGING
+
+def test_merged_output_holds_the_records_of_all_shards(tmp_path):
+    shards_records = [make_records('a', 2), [], make_records('c', 3)]
+    make_done_shards(tmp_path / 'shards', shards_records)
+    assert merge_shards(tmp_path / 'shards', 3, tmp_path / 'questions.json') == 5
+    assert (tmp_path / 'questions.json').read_text(encoding='utf-8') == json.dumps(shards_records[0] + shards_records[2], indent=4)
+
+    assert merge_normalized_shards(tmp_path / 'shards', 3, tmp_path / 'normalized') == 5
+    records = list(read_normalized_output(tmp_path / 'normalized', include_text=True))
+    assert [record['source'] for record in records] == ['a0.md', 'a1.md', 'c0.md', 'c1.md', 'c2.md']
+    assert all(record['text'] == f"text of {record['source']}" for record in records)
+
+
+def test_shards_are_not_merged_before_they_are_done(tmp_path):
+    make_done_shards(tmp_path / 'shards', [make_records('a', 1), make_records('b', 1)])
+    (get_shard_folder(tmp_path / 'shards', 1, 2) / 'done.json').unlink()
+    with pytest.raises(RuntimeError):
+        merge_shards(tmp_path / 'shards', 2, tmp_path / 'questions.json')
+    with pytest.raises(RuntimeError):
+        merge_normalized_shards(tmp_path / 'shards', 2, tmp_path / 'normalized')
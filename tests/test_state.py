@@ -0,0 +1,86 @@
+import asyncio
+from question_extractor.state import Journal, Manifest
+
+def open_manifest(folder):
+    return Manifest(folder / 'manifest.sqlite', Journal(folder / 'journal.jsonl'))
+
+def crash(manifest):
+    """
+    Simulates a crash: the manifest is never saved, its transaction is rolled back.
+    """
+    manifest.connection.close()
+
+def record_changes(manifest, changes):
+    """
+    Applies changes to the manifest, then waits for the journal to be flushed.
+    """
+    async def run():
+        for change in changes:
+            change(manifest)
+        await manifest.journal.close()
+    asyncio.run(run())
+
+#----------------------------------------------------------------------------------------
+# JOURNAL REPLAY
+
+def test_unsaved_changes_are_replayed_from_the_journal(tmp_path):
+    manifest = open_manifest(tmp_path)
+    record_changes(manifest, [lambda m: m.set_file('a.md', 'h1', [('a.md/part-1', 'c1')])])
+    manifest.save()
+    record_changes(manifest, [lambda m: m.set_questions('c1', ['q1', 'q2'], text='text'),
+                              lambda m: m.set_answer('c1', 0, 'a1')])
+    crash(manifest)
+
+    manifest = open_manifest(tmp_path)
+    assert manifest.get_answers('c1') == ['a1', None]
+    assert manifest.get_records('a.md', max_qa_pairs=10) == [{'source': 'a.md/part-1', 'question': 'q1', 'answer': 'a1'}]
+
+
+def test_torn_last_line_is_skipped_and_cut(tmp_path, capsys):
+    manifest = open_manifest(tmp_path)
+    record_changes(manifest, [lambda m: m.set_file('a.md', 'h1', [('a.md/part-1', 'c1')]),
+                              lambda m: m.set_questions('c1', ['q1', 'q2'], text='text'),
+                              lambda m: m.set_answer('c1', 0, 'a1')])
+    crash(manifest)
+    with open(tmp_path / 'journal.jsonl', 'a', encoding='utf-8') as journal_file:
+        journal_file.write('{"type": "answer", "chunk": "c1", "ind')
+
+    manifest = open_manifest(tmp_path)
+    assert 'truncated record' in capsys.readouterr().out
+    assert manifest.get_answers('c1') == ['a1', None]
+
+    # The next record is not glued to the torn one, so a second crash loses nothing
+    record_changes(manifest, [lambda m: m.set_answer('c1', 1, 'a2')])
+    crash(manifest)
+    manifest = open_manifest(tmp_path)
+    assert manifest.get_answers('c1') == ['a1', 'a2']
+    manifest.close()
+
+
+def test_saved_manifest_empties_the_journal(tmp_path):
+    manifest = open_manifest(tmp_path)
+    record_changes(manifest, [lambda m: m.set_file('a.md', 'h1', [('a.md/part-1', 'c1')])])
+    assert (tmp_path / 'journal.jsonl').exists()
+    asyncio.run(manifest.checkpoint(force=True))
+    assert not (tmp_path / 'journal.jsonl').exists()
+    manifest.close()
+
+    manifest = open_manifest(tmp_path)
+    assert manifest.files['a.md'] == {'hash': 'h1', 'chunks': [['a.md/part-1', 'c1']]}
+    manifest.close()
+
+
+def test_representatives_are_replayed_and_pruned(tmp_path):
+    manifest = open_manifest(tmp_path)
+    record_changes(manifest, [lambda m: m.set_file('a.md', 'h1', [('a.md/part-1', 'c1')]),
+                              lambda m: m.set_questions('c1', ['q1'], text='text'),
+                              lambda m: m.set_representative('c2', 'c1')])
+    crash(manifest)
+
+    manifest = open_manifest(tmp_path)
+    assert manifest.get_representative('c1') == 'c1'
+    assert manifest.get_representative('c2') == 'c1'
+    assert manifest.get_representative('c3') is None
+    manifest.prune([])
+    assert manifest.get_representative('c2') is None
+    manifest.close()
@@ -0,0 +1,99 @@
+import sys
+import threading
+from question_extractor import token_counting, models
+from question_extractor.token_counting import TokenCountCache, count_tokens_messages, get_token_count_cache_stats
+from question_extractor.prompts import create_extraction_conversation_messages, create_answering_conversation_messages
+
+class WordEncoding:
+    """
+    Stands for a tiktoken encoding, one token per word, counting the texts it encodes.
+    """
+
+    def __init__(self):
+        self.nb_encoded_texts = 0
+
+    def encode(self, text):
+        self.nb_encoded_texts += 1
+        return text.split()
+
+    def encode_batch(self, texts):
+        return [self.encode(text) for text in texts]
+
+#----------------------------------------------------------------------------------------
+# TOKEN COUNT CACHE
+
+def test_texts_are_tokenized_once():
+    encoding = WordEncoding()
+    cache = TokenCountCache(encoding, max_characters=1000)
+    assert cache.count("a b c") == 3
+    assert cache.count("a b c") == 3
+    assert cache.count_many(["a b c", "d e", "d e"]) == [3, 2, 2]
+    assert encoding.nb_encoded_texts == 2
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (2, 2)
+
+
+def test_least_recently_used_texts_are_evicted():
+    cache = TokenCountCache(WordEncoding(), max_characters=10)
+    cache.count("aaa b")
+    cache.count("ccc d")
+    cache.count("aaa b")
+    cache.count("eee f")
+    assert list(cache.token_counts) == ["aaa b", "eee f"]
+    assert cache.nb_characters == 10
+
+
+def test_unstored_and_pinned_texts():
+    cache = TokenCountCache(WordEncoding(), max_characters=5)
+    cache.pin("a system prompt longer than the cache")
+    cache.count("x y", store=False)
+    cache.count("aaa b")
+    cache.count("ccc d")
+    assert "x y" not in cache.token_counts
+    assert cache.lookup("a system prompt longer than the cache") == 7
+
+
+def test_cache_is_consistent_when_shared_by_threads():
+    cache = TokenCountCache(WordEncoding(), max_characters=200)
+    texts = [' '.join(['w'] * (index % 7 + 1)) + f" {index}" for index in range(300)]
+    errors = []
+
+    def count_texts(offset):
+        try:
+            for _ in range(50):
+                for index in range(offset, len(texts), 3):
+                    assert cache.count(texts[index]) == index % 7 + 2
+                assert cache.count_many(texts[offset::5]) == [index % 7 + 2 for index in range(offset, len(texts), 5)]
+        except Exception as e:
+            errors.append(e)
+
+    # Threads are switched as often as possible, to make races likely
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=count_texts, args=(offset,)) for offset in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert errors == []
+    assert cache.nb_characters == sum(len(text) for text in cache.token_counts) <= 200
+
+
+#----------------------------------------------------------------------------------------
+# MESSAGES
+
+def test_texts_shared_by_prompts_are_encoded_once(monkeypatch):
+    encoding = WordEncoding()
+    monkeypatch.setattr(token_counting, 'encodings', {model['encoding']: encoding for model in models.models.values()})
+    text = "some documentation text " * 50
+    questions = [f"What is point {index}?" for index in range(5)]
+    nb_tokens = count_tokens_messages(create_extraction_conversation_messages(text))
+    nb_encoded_texts = encoding.nb_encoded_texts  # the system prompts, pinned when the cache is created, and the text
+    for question in questions:
+        count_tokens_messages(create_answering_conversation_messages(question, text))
+    assert encoding.nb_encoded_texts == nb_encoded_texts + len(questions)
+    assert count_tokens_messages(create_extraction_conversation_messages(text)) == nb_tokens
+    assert encoding.nb_encoded_texts == nb_encoded_texts + len(questions)
+    assert get_token_count_cache_stats()['hits'] > 0